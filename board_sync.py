@@ -0,0 +1,231 @@
+"""Sharded, resumable sticker syncs for entire Trello boards.
+
+Sync'ing every card on a board inside a single task can blow through the
+request deadline on a full board. Instead, a board sync snapshots the board's
+card ids, then works through 'em CHUNK_SIZE cards at a time, one task per
+chunk. Each chunk advances a cursor saved in the datastore, so a failed chunk
+is retried (and an abandoned sync resumed) right where it stopped rather than
+starting over from the first card.
+"""
+import datetime
+import logging
+import uuid
+
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+import custom_stickers
+import perf_stats
+import rate_limit
+import stickers
+import thread_pool
+import trello_util
+
+# Number of cards sync'd per task
+CHUNK_SIZE = 20
+
+# A chunk's task is assumed to still be queued or running until this long
+# after it was deferred (or last failed), and resuming the sync before then
+# doesn't defer the chunk again. Matches the default queue's max retry backoff.
+CHUNK_LEASE = datetime.timedelta(hours=1)
+
+
+class BoardStickerSync(ndb.Model):
+    """Progress of the latest sticker sync for a board, keyed by board name."""
+    # Unique id of the sync run, so stale tasks from older runs can bail
+    run_id = ndb.StringProperty(indexed=False)
+    # Ids of all cards on the board when the sync started
+    card_ids = ndb.StringProperty(repeated=True, indexed=False)
+    # Index into card_ids of the next card to sync
+    cursor = ndb.IntegerProperty(default=0, indexed=False)
+    # Number of chunks that have failed (and been retried) during this run
+    failed_chunks = ndb.IntegerProperty(default=0, indexed=False)
+    # When the task for the chunk at cursor was deferred or last failed
+    chunk_deferred = ndb.DateTimeProperty(indexed=False)
+    started = ndb.DateTimeProperty(indexed=False)
+    updated = ndb.DateTimeProperty(indexed=False)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+    @property
+    def board_name(self):
+        return self.key.id()
+
+    def progress(self):
+        """Return dict describing progress and throughput of this sync."""
+        elapsed_seconds = ((self.finished or self.updated) -
+                self.started).total_seconds()
+        cards_per_second = None
+        if elapsed_seconds > 0:
+            cards_per_second = round(self.cursor / elapsed_seconds, 2)
+
+        return {
+            "board": self.board_name,
+            "cards_synced": self.cursor,
+            "cards_total": len(self.card_ids),
+            "failed_chunks": self.failed_chunks,
+            "elapsed_seconds": round(elapsed_seconds, 1),
+            "cards_per_second": cards_per_second,
+            "done": self.finished is not None,
+        }
+
+
+def sync_board_stickers(board_name, resume=True):
+    """Start (or resume) a sharded sticker sync of every card on a board.
+
+    Arguments:
+        board_name: one of the names in trello_util.BOARD_NAME_TO_ID
+        resume: if True and a previous sync of this board never finished,
+            pick it back up from its cursor instead of starting over. If the
+            task for the chunk at its cursor may still be queued or running
+            (see CHUNK_LEASE), it's left to carry on instead.
+    """
+    if not trello_util.get_board_id_by_name(board_name):
+        raise ValueError("Unknown board: %s" % board_name)
+
+    sync = BoardStickerSync.get_by_id(board_name)
+    if resume and sync and not sync.finished:
+        sync = _renew_chunk_lease(board_name, sync.run_id)
+        if not sync:
+            logging.info("Sticker sync of %s is still running" % board_name)
+            return
+
+        logging.info("Resuming sticker sync of %s at card %s of %s" %
+                (board_name, sync.cursor, len(sync.card_ids)))
+    else:
+        now = datetime.datetime.utcnow()
+        card_ids = trello_util.get_board_card_ids(board_name,
+                client=trello_util.get_client(rate_limit.BULK))
+        sync = BoardStickerSync(id=board_name,
+                run_id=uuid.uuid4().hex,
+                # Newest first, so each chunk is a contiguous range of card
+                # ids that can be fetched on its own (see _get_chunk_cards)
+                card_ids=sorted(card_ids, reverse=True),
+                started=now, updated=now, chunk_deferred=now)
+        sync.put()
+        logging.info("Starting sticker sync of %s (%s cards)" %
+                (board_name, len(sync.card_ids)))
+
+    _defer_chunk(sync)
+
+
+def get_all_progress():
+    """Return progress dicts for the latest sync of every board."""
+    keys = [ndb.Key(BoardStickerSync, name)
+            for name in sorted(trello_util.BOARD_NAME_TO_ID)]
+    return [sync.progress() for sync in ndb.get_multi(keys) if sync]
+
+
+def _defer_chunk(sync):
+    deferred.defer(sync_chunk, sync.board_name, sync.run_id, sync.cursor)
+
+
+def sync_chunk(board_name, run_id, cursor):
+    """Sync the chunk of cards starting at cursor (triggered by task queue).
+
+    Any exception fails the task so the same chunk is retried.
+    """
+    sync = BoardStickerSync.get_by_id(board_name)
+    if not sync or sync.run_id != run_id or sync.cursor != cursor:
+        # A newer sync has started, or this chunk was already sync'd by a
+        # previous attempt of this task.
+        logging.info("Skipping stale sticker sync chunk for %s at %s" %
+                (board_name, cursor))
+        return
+
+    card_ids = sync.card_ids[cursor:cursor + CHUNK_SIZE]
+
+    try:
+        # Board syncs are bulk work, so they yield rate limit budget to
+        # webhook handling
+        client = trello_util.get_client(rate_limit.BULK)
+        custom_stickers.CustomStickers.populate_trello_properties(client)
+
+        cards = _get_chunk_cards(sync, cursor, client)
+
+        thread_pool.map_in_parallel(lambda card: stickers.update(client, card),
+                cards, stickers.MAX_CARD_WORKERS)
+    except Exception:
+        _record_failed_chunk(board_name, run_id)
+        raise
+
+    sync = _advance_cursor(board_name, run_id, cursor, len(card_ids))
+    if not sync:
+        # Another attempt at this chunk beat us to it and will carry on
+        return
+
+    perf_stats.incr("board_sync.%s.cards_synced" % board_name, len(card_ids))
+
+    progress = sync.progress()
+    logging.info("Sticker sync of %(board)s: %(cards_synced)s/%(cards_total)s "
+            "cards in %(elapsed_seconds)ss (%(cards_per_second)s cards/s)" %
+            progress)
+
+    if not sync.finished:
+        _defer_chunk(sync)
+
+
+def _get_chunk_cards(sync, cursor, client):
+    """Return CardSnapshots (w/ stickers) of the chunk's cards still on board.
+
+    The chunk's cards are fetched together, stickers included, which is much
+    cheaper than fetching each card and then its stickers. Only cards whose
+    ids fall between the neighboring chunks' are requested, so a full sync
+    fetches each card once no matter how many chunks the board takes. Cards
+    that have left the board since the sync started are skipped.
+    """
+    end = cursor + CHUNK_SIZE
+    chunk_card_ids = set(sync.card_ids[cursor:end])
+    before = sync.card_ids[cursor - 1] if cursor > 0 else None
+    since = sync.card_ids[end] if end < len(sync.card_ids) else None
+
+    return [card for card in trello_util.iter_board_cards(sync.board_name,
+                client=client, before=before, since=since, stickers=True)
+            if card._id in chunk_card_ids]
+
+
+@ndb.transactional
+def _advance_cursor(board_name, run_id, cursor, count):
+    """Move cursor past a sync'd chunk. Returns None if already moved."""
+    sync = BoardStickerSync.get_by_id(board_name)
+    if not sync or sync.run_id != run_id or sync.cursor != cursor:
+        return None
+
+    sync.cursor = cursor + count
+    sync.updated = datetime.datetime.utcnow()
+    if sync.cursor >= len(sync.card_ids):
+        sync.finished = sync.updated
+    else:
+        # The caller defers the next chunk
+        sync.chunk_deferred = sync.updated
+    sync.put()
+    return sync
+
+
+@ndb.transactional
+def _renew_chunk_lease(board_name, run_id):
+    """Take over an unfinished sync whose chunk task's lease has expired.
+
+    Returns the sync, or None if its chunk task may still be queued or
+    running.
+    """
+    sync = BoardStickerSync.get_by_id(board_name)
+    if not sync or sync.run_id != run_id or sync.finished:
+        return None
+
+    now = datetime.datetime.utcnow()
+    if sync.chunk_deferred and now - sync.chunk_deferred < CHUNK_LEASE:
+        return None
+
+    sync.chunk_deferred = now
+    sync.put()
+    return sync
+
+
+@ndb.transactional
+def _record_failed_chunk(board_name, run_id):
+    sync = BoardStickerSync.get_by_id(board_name)
+    if sync and sync.run_id == run_id:
+        sync.failed_chunks += 1
+        # The task queue retries the chunk
+        sync.chunk_deferred = datetime.datetime.utcnow()
+        sync.put()
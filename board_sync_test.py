@@ -0,0 +1,147 @@
+"""Unit tests for sharded, resumable board-wide sticker syncs."""
+
+import datetime
+import mock
+import unittest
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import board_sync
+
+CARD_IDS = ["card%s" % i for i in range(5)]
+
+
+class BoardSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+
+        self.patches = [
+            mock.patch('board_sync.CHUNK_SIZE', 2),
+            mock.patch('trello_util.get_client'),
+            mock.patch('trello_util.get_board_card_ids',
+                return_value=CARD_IDS),
+            mock.patch('trello_util.iter_board_cards',
+                side_effect=self._iter_board_cards),
+            mock.patch(
+                'custom_stickers.CustomStickers.populate_trello_properties'),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+        # Ids of every card fetched from Trello by sync chunks
+        self.fetched_card_ids = []
+
+        self.update_patch = mock.patch('stickers.update')
+        self.update_stickers = self.update_patch.start()
+
+        # Keep deferred chunks around so tests can run 'em one at a time
+        self.deferred_chunks = []
+        self.defer_patch = mock.patch('google.appengine.ext.deferred.defer',
+                side_effect=lambda func, *args: self.deferred_chunks.append(
+                    args))
+        self.defer_patch.start()
+
+    def tearDown(self):
+        self.defer_patch.stop()
+        self.update_patch.stop()
+        for patch in self.patches:
+            patch.stop()
+        self.testbed.deactivate()
+
+    def _iter_board_cards(self, name, client=None, before=None, since=None,
+            stickers=False):
+        for card_id in sorted(CARD_IDS, reverse=True):
+            if ((before is None or card_id < before) and
+                    (since is None or card_id > since)):
+                self.fetched_card_ids.append(card_id)
+                yield mock.Mock(_id=card_id)
+
+    def _run_next_chunk(self):
+        board_sync.sync_chunk(*self.deferred_chunks.pop(0))
+
+    def _synced_card_ids(self):
+        return [c[0][1]._id for c in self.update_stickers.call_args_list]
+
+    def test_sync_runs_in_chunks(self):
+        board_sync.sync_board_stickers("BIG_BOARD")
+
+        while self.deferred_chunks:
+            self._run_next_chunk()
+
+        self.assertEqual(CARD_IDS, sorted(self._synced_card_ids()))
+
+        # Each chunk only fetched its own cards
+        self.assertEqual(sorted(CARD_IDS, reverse=True),
+                self.fetched_card_ids)
+
+        progress = board_sync.get_all_progress()[0]
+        self.assertEqual("BIG_BOARD", progress["board"])
+        self.assertEqual(5, progress["cards_synced"])
+        self.assertTrue(progress["done"])
+
+    def test_failed_chunk_is_retried_from_cursor(self):
+        board_sync.sync_board_stickers("BIG_BOARD")
+        self._run_next_chunk()
+
+        # Second chunk blows up
+        self.update_stickers.side_effect = Exception("Trello is down")
+        chunk = self.deferred_chunks[0]
+        with self.assertRaises(Exception):
+            board_sync.sync_chunk(*chunk)
+
+        progress = board_sync.get_all_progress()[0]
+        self.assertEqual(2, progress["cards_synced"])
+        self.assertEqual(1, progress["failed_chunks"])
+        self.assertFalse(progress["done"])
+
+        # Retrying the same task picks up where we stopped
+        self.update_stickers.side_effect = None
+        self.update_stickers.reset_mock()
+        while self.deferred_chunks:
+            self._run_next_chunk()
+
+        # Chunks go newest card first, so the oldest cards were left
+        self.assertEqual(CARD_IDS[:3], sorted(self._synced_card_ids()))
+        self.assertTrue(board_sync.get_all_progress()[0]["done"])
+
+    def test_resuming_unfinished_sync(self):
+        board_sync.sync_board_stickers("BIG_BOARD")
+        self._run_next_chunk()
+
+        # The next chunk's task is still queued, so resuming leaves it be
+        board_sync.sync_board_stickers("BIG_BOARD")
+        self.assertEqual(1, len(self.deferred_chunks))
+
+        # Once its lease is up, the task is presumed lost and re-deferred
+        self.deferred_chunks = []
+        with mock.patch('board_sync.CHUNK_LEASE', datetime.timedelta(0)):
+            board_sync.sync_board_stickers("BIG_BOARD")
+        self.assertEqual(2, self.deferred_chunks[0][2])
+
+        # ...but only once
+        board_sync.sync_board_stickers("BIG_BOARD")
+        self.assertEqual(1, len(self.deferred_chunks))
+
+    def test_cards_that_left_the_board_are_skipped(self):
+        board_sync.sync_board_stickers("BIG_BOARD")
+
+        with mock.patch('board_sync_test.CARD_IDS', CARD_IDS[:-1]):
+            while self.deferred_chunks:
+                self._run_next_chunk()
+
+        self.assertEqual(CARD_IDS[:-1], sorted(self._synced_card_ids()))
+        self.assertTrue(board_sync.get_all_progress()[0]["done"])
+
+    def test_stale_chunks_are_skipped(self):
+        board_sync.sync_board_stickers("BIG_BOARD")
+        stale_chunk = self.deferred_chunks.pop(0)
+
+        board_sync.sync_board_stickers("BIG_BOARD", resume=False)
+        board_sync.sync_chunk(*stale_chunk)
+        self.assertFalse(self.update_stickers.called)
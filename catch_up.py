@@ -0,0 +1,172 @@
+"""Catches up on Trello actions whose webhooks we never handled.
+
+Trello gives up on webhook deliveries that fail for long enough (e.g. while
+we're down), and then stickers, retro reminders, etc. stay wrong until someone
+edits the card again or reruns a full board sync. Instead, a periodic job (see
+cron.yaml) reads each board's actions feed since the last action it saw and
+replays any that weren't already processed through the usual webhook
+handlers. Actions are deduped by id against actions we processed and recent
+webhook deliveries still waiting to be processed (see
+webhook_queue.claim_delivery), so ones that did make it through aren't
+handled twice. Deliveries whose processing never finished are replayed once
+their claim goes stale.
+
+A board's first run only records where its actions feed currently ends.
+Whatever happened before then predates catching up, and replaying it would
+resend retro emails and the like that already went out.
+"""
+import json
+import logging
+
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+import board_sync
+import perf_stats
+import rate_limit
+import trello_util
+import webhook_queue
+import webhooks
+
+# Action types our webhook handlers care about
+ACTION_TYPES = ["createCard", "updateCard", "moveCardToBoard"]
+
+# Number of actions fetched per request (Trello allows up to 1000)
+PAGE_SIZE = 100
+
+# Max number of actions replayed per board per run. If more than this were
+# missed, the board gets a full sticker sync instead.
+MAX_ACTIONS = 500
+
+# What _replay did w/ an action
+REPLAYED = "replayed"
+PROCESSED = "processed"
+PENDING = "pending"
+
+
+class BoardActionCursor(ndb.Model):
+    """Newest Trello action caught up on for a board, keyed by board id."""
+    last_action_id = ndb.StringProperty(indexed=False)
+    updated = ndb.DateTimeProperty(indexed=False, auto_now=True)
+
+
+def catch_up_all_boards():
+    """Queue up a catch-up task for every board."""
+    for board_id in sorted(set(trello_util.BOARD_NAME_TO_ID.values())):
+        deferred.defer(catch_up_board, board_id)
+
+
+def catch_up_board(board_id):
+    """Replay any of the board's actions we missed (triggered by task queue).
+
+    If a replayed action fails, the cursor is saved just before it and the
+    exception fails the task, so the retry picks up at the failed action.
+    The cursor also stays put before any action whose webhook delivery is
+    still pending, so it's looked at again if that delivery never finishes.
+    """
+    cursor = BoardActionCursor.get_by_id(board_id)
+    if not cursor:
+        newest_action_id = get_newest_action_id(board_id)
+        if newest_action_id:
+            BoardActionCursor(id=board_id,
+                    last_action_id=newest_action_id).put()
+        logging.info("Started catching up on board %s after action %s" %
+                (board_id, newest_action_id))
+        return
+
+    actions, complete = get_actions_since(board_id, cursor.last_action_id)
+    if not complete:
+        logging.warning("Missed more than %s actions on board %s, syncing "
+                "the whole board's stickers instead" % (MAX_ACTIONS, board_id))
+        perf_stats.incr("catch_up.overflows")
+        _sync_board_stickers(board_id)
+
+    counts = {REPLAYED: 0, PROCESSED: 0, PENDING: 0}
+    try:
+        # Replay in the order they happened
+        for action in reversed(actions):
+            outcome = _replay(action)
+            counts[outcome] += 1
+            if not counts[PENDING]:
+                cursor.last_action_id = action["id"]
+    finally:
+        if actions:
+            cursor.put()
+
+        perf_stats.incr("catch_up.actions_replayed", counts[REPLAYED])
+        perf_stats.incr("catch_up.actions_skipped", counts[PROCESSED])
+        perf_stats.incr("catch_up.actions_pending", counts[PENDING])
+        logging.info("Caught up on board %s: %s actions replayed, %s already "
+                "processed, %s still pending" % (board_id, counts[REPLAYED],
+                    counts[PROCESSED], counts[PENDING]))
+
+
+def get_newest_action_id(board_id):
+    """Return the id of the board's newest action, or None if it has none."""
+    client = trello_util.get_client(rate_limit.BULK)
+    actions = json.loads(client.get('/boards/%s/actions' % board_id, {
+        'filter': ','.join(ACTION_TYPES),
+        'limit': 1,
+    }))
+    return actions[0]["id"] if actions else None
+
+
+def get_actions_since(board_id, since):
+    """Return the board's actions since the given action id.
+
+    Actions come back newest first, paged through PAGE_SIZE at a time.
+
+    Returns tuple of (list of actions, whether every action since was
+    fetched rather than just the newest MAX_ACTIONS).
+    """
+    client = trello_util.get_client(rate_limit.BULK)
+    path = '/boards/%s/actions' % board_id
+    params = {
+        'filter': ','.join(ACTION_TYPES),
+        'since': since,
+        'limit': PAGE_SIZE,
+    }
+
+    actions = []
+    while len(actions) < MAX_ACTIONS:
+        page = json.loads(client.get(path, params))
+        actions += page
+        if len(page) < PAGE_SIZE:
+            return (actions, True)
+        params['before'] = page[-1]['id']
+
+    return (actions[:MAX_ACTIONS], False)
+
+
+def _replay(action):
+    """Run webhook handlers for an action unless it's already been handled.
+
+    Actions that were processed are skipped, and so are ones whose webhook
+    was received recently and is presumably still queued up.
+
+    Returns REPLAYED, PROCESSED or PENDING.
+    """
+    if webhook_queue.was_processed(action["id"]):
+        return PROCESSED
+
+    event = webhook_queue.WebhookEvent.from_webhook_body({"action": action})
+    if event:
+        if not webhook_queue.claim_delivery(event):
+            return PENDING
+
+        logging.info("Replaying missed %s" % event)
+        try:
+            webhooks.trigger_update_handlers(event)
+        except Exception:
+            # Let the retry of this catch-up (or a late webhook) handle it
+            webhook_queue.release_delivery(event)
+            raise
+
+    webhook_queue.mark_processed(action["id"])
+    return REPLAYED
+
+
+def _sync_board_stickers(board_id):
+    for name, known_board_id in trello_util.BOARD_NAME_TO_ID.iteritems():
+        if known_board_id == board_id:
+            board_sync.sync_board_stickers(name, resume=False)
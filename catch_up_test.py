@@ -0,0 +1,163 @@
+"""Unit tests for catching up on Trello actions we missed webhooks for."""
+
+import datetime
+import json
+import mock
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import catch_up
+import webhook_queue
+
+
+def _action(action_id, card_id="card1"):
+    return {
+        "id": action_id,
+        "type": "updateCard",
+        "idMemberCreator": "member1",
+        "data": {
+            "card": {"id": card_id},
+            "board": {"id": "board1"},
+            "old": {"name": "old name"},
+        },
+    }
+
+
+class CatchUpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+
+        # Trello's actions feed, newest first
+        self.actions = [_action("a%s" % i) for i in range(5, 0, -1)]
+        self.requested_params = []
+
+        self.patches = [
+            mock.patch('catch_up.PAGE_SIZE', 2),
+            mock.patch('trello_util.get_client'),
+            mock.patch('webhooks.trigger_update_handlers'),
+        ]
+        _, get_client, self.trigger_update_handlers = [patch.start()
+                for patch in self.patches]
+        get_client.return_value.get.side_effect = self._get_actions
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.testbed.deactivate()
+
+    def _get_actions(self, path, params):
+        self.requested_params.append(dict(params))
+        actions = [a for a in self.actions
+                if a["id"] > params.get("since", "") and
+                a["id"] < params.get("before", "z")]
+        return json.dumps(actions[:params["limit"]])
+
+    def _replayed_action_ids(self):
+        return [call[0][0].action_id
+                for call in self.trigger_update_handlers.call_args_list]
+
+    def test_get_actions_since_pages_through_feed(self):
+        actions, complete = catch_up.get_actions_since("board1", "a1")
+        self.assertTrue(complete)
+        self.assertEqual(["a5", "a4", "a3", "a2"], [a["id"] for a in actions])
+        self.assertEqual([None, "a4", "a2"],
+                [params.get("before") for params in self.requested_params])
+
+        with mock.patch('catch_up.MAX_ACTIONS', 3):
+            actions, complete = catch_up.get_actions_since("board1", "a1")
+        self.assertFalse(complete)
+        self.assertEqual(["a5", "a4", "a3"], [a["id"] for a in actions])
+
+    def test_replays_missed_actions_in_order(self):
+        catch_up.BoardActionCursor(id="board1", last_action_id="a2").put()
+        webhook_queue.mark_processed("a4")
+
+        catch_up.catch_up_board("board1")
+
+        self.assertEqual(["a3", "a5"], self._replayed_action_ids())
+        self.assertEqual("a5",
+                catch_up.BoardActionCursor.get_by_id("board1").last_action_id)
+
+        # Nothing new the next time around
+        catch_up.catch_up_board("board1")
+        self.assertEqual(2, self.trigger_update_handlers.call_count)
+
+    def test_failed_replay_is_retried(self):
+        catch_up.BoardActionCursor(id="board1", last_action_id="a2").put()
+        self.trigger_update_handlers.side_effect = [None, Exception(), None,
+                None]
+
+        with self.assertRaises(Exception):
+            catch_up.catch_up_board("board1")
+        self.assertEqual("a3",
+                catch_up.BoardActionCursor.get_by_id("board1").last_action_id)
+        self.assertFalse(webhook_queue.was_processed("a4"))
+
+        catch_up.catch_up_board("board1")
+        self.assertEqual(["a3", "a4", "a4", "a5"], self._replayed_action_ids())
+
+    def test_first_run_starts_from_newest_action(self):
+        catch_up.catch_up_board("board1")
+
+        # Nothing from before catching up started is replayed
+        self.assertFalse(self.trigger_update_handlers.called)
+        self.assertEqual("a5",
+                catch_up.BoardActionCursor.get_by_id("board1").last_action_id)
+
+    def test_received_actions_are_not_replayed(self):
+        catch_up.BoardActionCursor(id="board1", last_action_id="a3").put()
+
+        # a5's webhook is queued up but hasn't been processed yet
+        received = webhook_queue.WebhookEvent.from_webhook_body(
+                {"action": self.actions[0]})
+        self.assertTrue(webhook_queue.claim_delivery(received))
+
+        catch_up.catch_up_board("board1")
+        self.assertEqual(["a4"], self._replayed_action_ids())
+
+        # And a late webhook for a replayed action is dropped
+        late = webhook_queue.WebhookEvent.from_webhook_body(
+                {"action": self.actions[1]})
+        self.assertFalse(webhook_queue.claim_delivery(late))
+
+        # The cursor waits for a5 in case its task never finishes
+        self.assertEqual("a4",
+                catch_up.BoardActionCursor.get_by_id("board1").last_action_id)
+
+    def test_stale_received_actions_are_replayed(self):
+        catch_up.BoardActionCursor(id="board1", last_action_id="a4").put()
+
+        # a5's webhook was received, but its task gave up long ago
+        received = webhook_queue.WebhookEvent.from_webhook_body(
+                {"action": self.actions[0]})
+        self.assertTrue(webhook_queue.claim_delivery(received))
+        memcache.flush_all()  # its memcache marker would've expired, too
+        action = webhook_queue.WebhookAction.get_by_id("a5")
+        action.received -= datetime.timedelta(
+                seconds=webhook_queue.CLAIM_TIMEOUT_SECONDS)
+        action.put()
+
+        catch_up.catch_up_board("board1")
+        self.assertEqual(["a5"], self._replayed_action_ids())
+        self.assertTrue(webhook_queue.was_processed("a5"))
+        self.assertEqual("a5",
+                catch_up.BoardActionCursor.get_by_id("board1").last_action_id)
+
+    @mock.patch('board_sync.sync_board_stickers')
+    def test_too_many_missed_actions_resyncs_board(self, sync_board_stickers):
+        catch_up.BoardActionCursor(id="board1", last_action_id="a1").put()
+        with mock.patch('trello_util.BOARD_NAME_TO_ID',
+                {"BIG_BOARD": "board1"}):
+            with mock.patch('catch_up.MAX_ACTIONS', 2):
+                catch_up.catch_up_board("board1")
+
+        sync_board_stickers.assert_called_once_with("BIG_BOARD", resume=False)
+        self.assertEqual(["a4", "a5"], self._replayed_action_ids())
@@ -0,0 +1,83 @@
+"""Coalesces bursts of webhooks for the same card into a single sticker sync.
+
+A single editing session on a card fires a whole bunch of updateCard webhooks,
+and each full sticker sync fetches the card and its stickers (and maybe removes
+and re-pastes all of 'em). Instead of syncing on every webhook, the first
+webhook for a card opens a coalescing window and schedules one sync for when
+the window closes. Webhooks that show up for the same card during the window
+are merged into that sync, which reads the card's latest state.
+
+Pending counts live in memcache so that webhooks processed by different
+instances still get merged.
+"""
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+
+import perf_stats
+import stickers
+
+# How long to wait for more webhooks for the same card before syncing. Set to
+# 0 to sync on every webhook.
+WINDOW_SECONDS = 5
+
+# Pending counts expire on their own after this long, so a sync that never
+# got scheduled (or whose task was lost) can't block that card's syncs forever
+PENDING_EXPIRY_SECONDS = WINDOW_SECONDS * 2
+
+
+def _pending_key(card_id):
+    return "sticker-sync-pending:%s" % card_id
+
+
+def request_sticker_sync(card_id):
+    """Sync card stickers once this card's coalescing window closes."""
+    perf_stats.incr("coalescing.events")
+
+    if WINDOW_SECONDS <= 0:
+        _sync(card_id, 1)
+        return
+
+    # incr is atomic across instances, so exactly one webhook per window sees
+    # a count of 1 and becomes responsible for scheduling the sync.
+    key = _pending_key(card_id)
+    memcache.add(key, 0, time=PENDING_EXPIRY_SECONDS)
+    pending_count = memcache.incr(key)
+
+    if pending_count is None:
+        # Memcache is unavailable, so we can't coalesce. Just sync now.
+        _sync(card_id, 1)
+    elif pending_count == 1:
+        try:
+            deferred.defer(flush_sticker_sync, card_id,
+                    _countdown=WINDOW_SECONDS)
+        except Exception:
+            # Nothing's going to flush this window, so let the next webhook
+            # (or this one's retry) open a new one
+            memcache.delete(key)
+            raise
+    else:
+        logging.info("Merging webhook #%s into pending sticker sync for: %s" %
+                (pending_count, card_id))
+
+
+def flush_sticker_sync(card_id):
+    """Run the pending sticker sync for card (triggered by task queue)."""
+    key = _pending_key(card_id)
+    pending_count = memcache.get(key) or 1
+
+    # Clear the pending count *before* syncing so that any webhook arriving
+    # from here on opens a new window. Webhooks that arrived before this point
+    # describe edits that already happened, so this sync picks 'em up.
+    memcache.delete(key)
+
+    _sync(card_id, pending_count)
+
+
+def _sync(card_id, event_count):
+    logging.info("Syncing stickers for %s (merged %s webhook events)" %
+            (card_id, event_count))
+    perf_stats.incr("coalescing.syncs")
+    perf_stats.incr("coalescing.merged_events", event_count - 1)
+    stickers.sync_card_stickers(card_id)
@@ -0,0 +1,72 @@
+"""Unit tests for coalescing bursts of card webhooks into one sticker sync."""
+
+import mock
+import unittest
+
+from google.appengine.ext import testbed
+
+import coalescing
+import perf_stats
+
+
+class CoalescingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+
+        self.sync_patch = mock.patch('stickers.sync_card_stickers')
+        self.sync_card_stickers = self.sync_patch.start()
+        self.defer_patch = mock.patch('google.appengine.ext.deferred.defer')
+        self.defer = self.defer_patch.start()
+
+        perf_stats.reset()
+
+    def tearDown(self):
+        self.defer_patch.stop()
+        self.sync_patch.stop()
+        self.testbed.deactivate()
+
+    def test_burst_is_merged_into_one_sync(self):
+        for _ in range(5):
+            coalescing.request_sticker_sync("card1")
+
+        # Only the first webhook schedules a sync, and nothing syncs yet
+        self.defer.assert_called_once_with(coalescing.flush_sticker_sync,
+                "card1", _countdown=coalescing.WINDOW_SECONDS)
+        self.assertFalse(self.sync_card_stickers.called)
+
+        coalescing.flush_sticker_sync("card1")
+        self.sync_card_stickers.assert_called_once_with("card1")
+        self.assertEqual(4, perf_stats.get("coalescing.merged_events"))
+
+        # The next webhook for the same card opens a new window
+        coalescing.request_sticker_sync("card1")
+        self.assertEqual(2, self.defer.call_count)
+
+    def test_cards_are_coalesced_separately(self):
+        coalescing.request_sticker_sync("card1")
+        coalescing.request_sticker_sync("card2")
+        self.assertEqual(2, self.defer.call_count)
+
+    def test_failed_defer_reopens_window(self):
+        self.defer.side_effect = [Exception("Task queue is down"), None]
+        with self.assertRaises(Exception):
+            coalescing.request_sticker_sync("card1")
+
+        # The retry isn't merged into a sync that was never scheduled
+        coalescing.request_sticker_sync("card1")
+        self.assertEqual(2, self.defer.call_count)
+
+    def test_pending_count_expires(self):
+        with mock.patch('google.appengine.api.memcache.add') as add:
+            coalescing.request_sticker_sync("card1")
+        add.assert_called_once_with(coalescing._pending_key("card1"), 0,
+                time=coalescing.PENDING_EXPIRY_SECONDS)
+
+    def test_zero_window_syncs_immediately(self):
+        with mock.patch('coalescing.WINDOW_SECONDS', 0):
+            coalescing.request_sticker_sync("card1")
+        self.sync_card_stickers.assert_called_once_with("card1")
+        self.assertFalse(self.defer.called)
@@ -8,6 +8,14 @@ bigboard@khanacademy.org Trello role account).
 TODO(kamens): in the future it'd be cool to have this app automatically upload
 the custom stickers, but right now that's a manual step described in README.md.
 """
+import logging
+
+from google.appengine.api import memcache
+
+# Memcache key and lifetime for the Trello properties of our custom stickers,
+# shared by all instances so cold instances don't have to hit Trello for 'em.
+TRELLO_PROPERTIES_CACHE_KEY = "custom-sticker-trello-properties"
+TRELLO_PROPERTIES_CACHE_SECONDS = 24 * 60 * 60
 
 
 class CustomSticker(object):
@@ -70,27 +78,87 @@ class CustomStickers(object):
     def populate_trello_properties(cls, client):
         """Populate the trello-specific properties on our in-memory stickers.
 
-        This hits Trello's API, grabs all custom stickers, and inflates the
-        Trello id and Trello URL properties for all the big board custom
-        stickers."""
+        These are cached in memcache so they only need to be fetched from
+        Trello's API when they've expired or been invalidated. Otherwise this
+        hits Trello's API, grabs all custom stickers, and inflates the Trello
+        id and Trello URL properties for all the big board custom stickers."""
         if cls.has_populated_trello_properties:
             return
 
-        trello_custom_stickers = client.me.customStickers
+        cached_properties = memcache.get(TRELLO_PROPERTIES_CACHE_KEY)
+        if cached_properties and cls._apply_trello_properties(
+                cached_properties):
+            cls.has_populated_trello_properties = True
+            return
+
+        trello_properties = {}
+        for trello_sticker in client.me.customStickers:
+            trello_properties[trello_sticker.url] = trello_sticker._id
+
+        if not cls._apply_trello_properties(trello_properties):
+            # Assert that we found Trello custom stickers for all expected big
+            # board sticker colors
+            raise Exception("Unable to populate trello properties for all"
+                            "expected custom stickers.")
+
+        memcache.set(TRELLO_PROPERTIES_CACHE_KEY, trello_properties,
+                time=TRELLO_PROPERTIES_CACHE_SECONDS)
+        cls.has_populated_trello_properties = True
+
+    @classmethod
+    def invalidate_trello_properties(cls):
+        """Forget cached Trello properties so they're refetched next time.
+
+        The in-memory properties are left in place until the refetch replaces
+        'em, since other threads may be pasting stickers w/ 'em right now.
+        """
+        memcache.delete(TRELLO_PROPERTIES_CACHE_KEY)
+        cls.has_populated_trello_properties = False
+
+    @classmethod
+    def invalidate_if_stale(cls, client):
+        """Invalidate our cached sticker ids if Trello no longer knows 'em.
+
+        Call this when Trello rejects a sticker paste. The ids only go stale
+        when the custom stickers have been re-uploaded, so this looks up our
+        custom stickers rather than assuming every failure means stale ids.
+
+        Returns True if the cached ids were stale.
+        """
+        known_ids = set(trello_sticker._id
+                for trello_sticker in client.me.customStickers)
+        if all(custom_sticker.trello_id in known_ids
+                for custom_sticker in cls.all()):
+            return False
+
+        logging.warning("Cached custom sticker ids are stale, refetching")
+        cls.invalidate_trello_properties()
+        return True
+
+    @classmethod
+    def _apply_trello_properties(cls, trello_properties):
+        """Set trello properties from dict of Trello image url -> sticker id.
+
+        Returns False if that dict is missing any expected custom sticker.
+        """
         expected_custom_stickers = CustomStickers.all()
 
-        for trello_sticker in trello_custom_stickers:
+        # shortname => (Trello image url, Trello id)
+        found_properties = {}
+        for trello_image_url, trello_id in trello_properties.iteritems():
             for expected_sticker in expected_custom_stickers:
-                if trello_sticker.url.endswith(expected_sticker.filename):
-                    expected_sticker.trello_image_url = trello_sticker.url
-                    expected_sticker.trello_id = trello_sticker._id
+                if trello_image_url.endswith(expected_sticker.filename):
+                    found_properties[expected_sticker.shortname] = (
+                            trello_image_url, trello_id)
+
+        # Only replace the current properties once we know we have all of
+        # 'em, so other threads never see a missing one
+        if len(found_properties) < len(expected_custom_stickers):
+            return False
 
-        # Assert that we found Trello custom stickers for all expected big
-        # board sticker colors
         for expected_sticker in expected_custom_stickers:
-            if (not expected_sticker.trello_id or
-                    not expected_sticker.trello_image_url):
-                raise Exception("Unable to populate trello properties for all"
-                                "expected custom stickers.")
+            (expected_sticker.trello_image_url,
+                    expected_sticker.trello_id) = found_properties[
+                            expected_sticker.shortname]
 
-        cls.has_populated_trello_properties = True
+        return True
@@ -0,0 +1,89 @@
+"""Unit tests for caching our custom stickers' Trello properties."""
+
+import mock
+import unittest
+
+from google.appengine.ext import testbed
+
+import custom_stickers
+
+
+def _mock_client():
+    client = mock.Mock()
+    client.me.customStickers = [
+        mock.Mock(url="https://trello.com/stickers/%s" % s.filename,
+            _id="id-%s" % s.shortname)
+        for s in custom_stickers.CustomStickers.all()]
+    return client
+
+
+class CustomStickersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        custom_stickers.CustomStickers.invalidate_trello_properties()
+
+    def tearDown(self):
+        custom_stickers.CustomStickers.invalidate_trello_properties()
+        self.testbed.deactivate()
+
+    def test_properties_are_shared_across_instances(self):
+        client = _mock_client()
+        custom_stickers.CustomStickers.populate_trello_properties(client)
+        self.assertEqual("id-G",
+                custom_stickers.CustomStickers.Green.trello_id)
+
+        # Simulate a cold instance, which should populate from memcache
+        # instead of asking Trello
+        custom_stickers.CustomStickers.has_populated_trello_properties = False
+        cold_client = mock.Mock()
+        custom_stickers.CustomStickers.populate_trello_properties(cold_client)
+        self.assertFalse(cold_client.mock_calls)
+        self.assertEqual("id-G",
+                custom_stickers.CustomStickers.Green.trello_id)
+
+    def test_invalidating_properties(self):
+        custom_stickers.CustomStickers.populate_trello_properties(
+                _mock_client())
+        custom_stickers.CustomStickers.invalidate_trello_properties()
+
+        # Other threads can keep using the old ids until they're refetched
+        self.assertEqual("id-G",
+                custom_stickers.CustomStickers.Green.trello_id)
+
+        client = _mock_client()
+        client.me.customStickers[0]._id = "new-id-G"
+        custom_stickers.CustomStickers.populate_trello_properties(client)
+        self.assertEqual("new-id-G",
+                custom_stickers.CustomStickers.Green.trello_id)
+
+    def test_invalidating_only_stale_properties(self):
+        custom_stickers.CustomStickers.populate_trello_properties(
+                _mock_client())
+
+        self.assertFalse(custom_stickers.CustomStickers.invalidate_if_stale(
+                _mock_client()))
+        self.assertTrue(
+                custom_stickers.CustomStickers.has_populated_trello_properties)
+
+        # The stickers were re-uploaded, so they have new ids
+        client = _mock_client()
+        client.me.customStickers[0]._id = "new-id-G"
+        self.assertTrue(custom_stickers.CustomStickers.invalidate_if_stale(
+                client))
+        self.assertFalse(
+                custom_stickers.CustomStickers.has_populated_trello_properties)
+
+    def test_incomplete_properties_leave_current_ones_alone(self):
+        custom_stickers.CustomStickers.populate_trello_properties(
+                _mock_client())
+        custom_stickers.CustomStickers.invalidate_trello_properties()
+
+        client = _mock_client()
+        client.me.customStickers.pop()
+        with self.assertRaises(Exception):
+            custom_stickers.CustomStickers.populate_trello_properties(client)
+        self.assertEqual("id-G",
+                custom_stickers.CustomStickers.Green.trello_id)
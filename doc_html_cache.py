@@ -0,0 +1,125 @@
+"""Cache of Google Docs' exported HTML, keyed by each doc's revision.
+
+The same project doc gets pulled over and over: every time it's linked in an
+email to new-projects@, and again when its retro doc is created. Exports of
+big docs are slow to download, so the HTML is cached by doc id along w/ the
+version of the doc it came from (its Drive etag, which changes whenever the
+doc does). Drive's metadata for a doc is always fetched first anyway (it's
+cheap and batched, see google_drive.pull_docs_metadata), so an unchanged doc
+is never downloaded twice and a changed one is never served stale.
+
+HTML is zlib-compressed and kept in memory, w/ the least recently used docs
+evicted once MAX_BYTES of compressed HTML is cached. Docs are also stored in
+memcache so other instances can skip the download, too.
+"""
+import collections
+import threading
+import zlib
+
+from google.appengine.api import memcache
+
+import perf_stats
+
+# Max bytes of compressed HTML kept in memory by each instance
+MAX_BYTES = 16 * 1024 * 1024
+
+# Docs whose compressed HTML is bigger than this aren't stored in memcache,
+# which won't take values over 1MB
+MAX_MEMCACHE_BYTES = 900 * 1024
+MEMCACHE_SECONDS = 7 * 24 * 60 * 60
+
+
+def get_doc_version(metadata):
+    """Return a string identifying the revision of a doc's Drive metadata."""
+    return metadata.get("etag") or metadata.get("modifiedDate")
+
+
+def _memcache_key(doc_id):
+    return "doc-html:%s" % doc_id
+
+
+class DocHtmlCache(object):
+    """Thread-safe LRU cache of compressed doc HTML, bounded by total size."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # doc id => (version, compressed html), oldest first
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+    @property
+    def size(self):
+        """Total bytes of compressed HTML currently cached in memory."""
+        return self._size
+
+    def get(self, doc_id, version):
+        """Return the doc's html if cached for this version, or None."""
+        with self._lock:
+            entry = self._entries.pop(doc_id, None)
+            if entry:
+                # Move to the back of the line for LRU eviction
+                self._entries[doc_id] = entry
+
+        if not entry or entry[0] != version:
+            entry = memcache.get(_memcache_key(doc_id))
+            if not entry or entry[0] != version:
+                perf_stats.incr("doc_html_cache.misses")
+                return None
+
+            perf_stats.incr("doc_html_cache.memcache_hits")
+            self._set_local(doc_id, entry)
+        else:
+            perf_stats.incr("doc_html_cache.hits")
+
+        return zlib.decompress(entry[1])
+
+    def set(self, doc_id, version, html):
+        """Cache the doc's html as of this version."""
+        entry = (version, zlib.compress(html))
+        self._set_local(doc_id, entry)
+
+        if len(entry[1]) <= MAX_MEMCACHE_BYTES:
+            memcache.set(_memcache_key(doc_id), entry, time=MEMCACHE_SECONDS)
+
+    def _set_local(self, doc_id, entry):
+        if len(entry[1]) > self.max_bytes:
+            return
+
+        with self._lock:
+            old_entry = self._entries.pop(doc_id, None)
+            if old_entry:
+                self._size -= len(old_entry[1])
+
+            self._entries[doc_id] = entry
+            self._size += len(entry[1])
+
+            while self._size > self.max_bytes:
+                _, (_, evicted_html) = self._entries.popitem(last=False)
+                self._size -= len(evicted_html)
+                perf_stats.incr("doc_html_cache.evictions")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+_cache = DocHtmlCache(MAX_BYTES)
+
+
+def get_html(doc_id, version):
+    """Return the doc's cached html for this version, or None."""
+    if not version:
+        return None
+    return _cache.get(doc_id, version)
+
+
+def set_html(doc_id, version, html):
+    """Cache the doc's html as of this version."""
+    if version:
+        _cache.set(doc_id, version, html)
+
+
+def clear():
+    """Drop everything cached in memory, e.g. between unit tests."""
+    _cache.clear()
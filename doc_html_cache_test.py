@@ -0,0 +1,57 @@
+"""Unit tests for caching exported Google Doc HTML."""
+
+import unittest
+import zlib
+
+from google.appengine.ext import testbed
+
+import doc_html_cache
+import perf_stats
+
+
+class DocHtmlCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        perf_stats.reset()
+
+        self.html = "<html>%s</html>" % ("monkey " * 1000)
+        self.compressed_size = len(zlib.compress(self.html))
+        self.cache = doc_html_cache.DocHtmlCache(self.compressed_size * 2)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_html_is_cached_per_version(self):
+        self.cache.set("doc1", "v1", self.html)
+        self.assertEqual(self.html, self.cache.get("doc1", "v1"))
+        self.assertIsNone(self.cache.get("doc1", "v2"))
+
+        self.assertEqual(self.compressed_size, self.cache.size)
+        self.assertLess(self.cache.size, len(self.html))
+        self.assertEqual(1, perf_stats.get("doc_html_cache.hits"))
+        self.assertEqual(1, perf_stats.get("doc_html_cache.misses"))
+
+    def test_least_recently_used_docs_are_evicted(self):
+        self.cache.set("doc1", "v1", self.html)
+        self.cache.set("doc2", "v1", self.html)
+        self.cache.get("doc1", "v1")
+        self.cache.set("doc3", "v1", self.html)
+
+        self.assertEqual(self.compressed_size * 2, self.cache.size)
+        self.assertEqual(1, perf_stats.get("doc_html_cache.evictions"))
+        self.assertEqual(["doc1", "doc3"], list(self.cache._entries))
+
+    def test_other_instances_share_cached_html(self):
+        self.cache.set("doc1", "v1", self.html)
+
+        other_instance_cache = doc_html_cache.DocHtmlCache(
+                self.compressed_size * 2)
+        self.assertEqual(self.html, other_instance_cache.get("doc1", "v1"))
+        self.assertEqual(1, perf_stats.get("doc_html_cache.memcache_hits"))
+
+    def test_docs_wo_versions_are_not_cached(self):
+        doc_html_cache.set_html("doc1", None, self.html)
+        self.assertIsNone(doc_html_cache.get_html("doc1", None))
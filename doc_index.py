@@ -0,0 +1,137 @@
+"""Persistent index from Google Doc ids to the Trello cards that link to 'em.
+
+Finding the card for a project doc used to mean loading every card on every
+board and checking each description, and the completed board only ever grows.
+Instead, we keep a datastore entity per doc id pointing at its card. The index
+is built by scanning all boards once (see rebuild) and then kept up-to-date by
+the createCard/updateCard webhooks we already receive, as well as by
+proposals_board when it creates cards itself.
+"""
+import datetime
+import logging
+
+from google.appengine.ext import ndb
+
+import google_drive
+import perf_stats
+import trello_util
+
+# Index misses only fall back to rescanning every board if the last full scan
+# is at least this old. New projects always miss, so without this every
+# new-projects@ email would scan everything. More recent misses only rescan
+# the active boards (see get_card_by_doc_id).
+MIN_RESCAN_INTERVAL = datetime.timedelta(hours=1)
+
+
+class DocCard(ndb.Model):
+    """Trello card that links to a Google Doc, keyed by the doc's id."""
+    card_id = ndb.StringProperty(indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class DocIndexScan(ndb.Model):
+    """When all boards were last scanned to build the index (singleton)."""
+    SINGLETON_ID = "latest"
+    scanned = ndb.DateTimeProperty(indexed=False)
+
+
+def get_card_by_doc_id(doc_id):
+    """Return the card, if it exists, corresponding to this project doc id.
+
+    Looks the card up in the index, and falls back to rescanning boards
+    (indexing what's found along the way) on a miss. Errors talking to
+    Trello are raised rather than mistaken for a missing card.
+    """
+    doc_card = DocCard.get_by_id(doc_id)
+    if doc_card:
+        card = _get_card_if_it_links_to_doc(doc_card.card_id, doc_id)
+        if card:
+            perf_stats.incr("doc_index.hits")
+            return card
+
+        # Card was deleted or no longer links to this doc
+        doc_card.key.delete()
+
+    perf_stats.incr("doc_index.misses")
+
+    last_scan = DocIndexScan.get_by_id(DocIndexScan.SINGLETON_ID)
+    if (last_scan and datetime.datetime.utcnow() - last_scan.scanned <
+            MIN_RESCAN_INTERVAL):
+        # The index was recently rebuilt and has been kept up-to-date by
+        # webhooks since, but only for cards whose desc we saw change. Cards
+        # moved or copied over from other boards land on the active boards,
+        # so rescan just those rather than everything.
+        perf_stats.incr("doc_index.active_rescans")
+        return _index_cards(trello_util.iter_active_board_cards(), doc_id)
+
+    return rebuild(doc_id)
+
+
+def rebuild(doc_id=None):
+    """Rebuild the index by scanning every card on every board.
+
+    Returns the card linking to doc_id, if one is passed and found.
+    """
+    logging.info("Rebuilding doc id index from all boards")
+    perf_stats.incr("doc_index.rebuilds")
+
+    found_card = _index_cards(trello_util.iter_all_board_cards(), doc_id)
+    DocIndexScan(id=DocIndexScan.SINGLETON_ID,
+            scanned=datetime.datetime.utcnow()).put()
+
+    return found_card
+
+
+def _index_cards(cards, doc_id=None):
+    """Index the docs linked from each card.
+
+    Returns the first card linking to doc_id, if one is passed and found.
+    """
+    found_card = None
+    doc_cards = []
+    for card in cards:
+        doc_ids = google_drive.extract_doc_ids(card.desc)
+        doc_cards += [DocCard(id=d, card_id=card._id) for d in doc_ids]
+        if doc_id in doc_ids and not found_card:
+            found_card = card
+
+    ndb.put_multi(doc_cards)
+    return found_card
+
+
+def index_card(card_id, doc_ids, old_doc_ids=None):
+    """Point each of doc_ids at card_id in the index.
+
+    Arguments:
+        card_id: Trello card id
+        doc_ids: ids of the Google Docs linked from the card's description
+        old_doc_ids: ids of docs the card used to link to, if known. Entries
+            for any of these that are no longer linked are removed.
+    """
+    ndb.put_multi([DocCard(id=doc_id, card_id=card_id) for doc_id in doc_ids])
+
+    removed_doc_ids = set(old_doc_ids or []) - set(doc_ids)
+    if removed_doc_ids:
+        doc_cards = ndb.get_multi([ndb.Key(DocCard, doc_id)
+                for doc_id in removed_doc_ids])
+        ndb.delete_multi([doc_card.key for doc_card in doc_cards
+                if doc_card and doc_card.card_id == card_id])
+
+
+def _get_card_if_it_links_to_doc(card_id, doc_id):
+    """Return the indexed card, or None if it's gone or doesn't link to doc.
+
+    Any failure other than Trello saying the card doesn't exist is raised,
+    since dropping the entry then would get the project a duplicate card.
+    """
+    try:
+        card = trello_util.get_card_snapshot(card_id)
+    except trello_util.TrelloBatchError as e:
+        if str(e.status_code) != "404":
+            raise
+        logging.info("Indexed card %s no longer exists" % card_id)
+        return None
+
+    if doc_id in card.desc:
+        return card
+    return None
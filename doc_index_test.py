@@ -0,0 +1,130 @@
+"""Unit tests for the Google Doc id => Trello card index."""
+
+import datetime
+import mock
+import unittest
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import doc_index
+import trello_util
+
+DOC_URL = "https://docs.google.com/document/d/%s/edit"
+
+
+def _card(card_id, doc_id):
+    return mock.Mock(_id=card_id, desc="Project doc: %s" % DOC_URL % doc_id)
+
+
+class DocIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+
+        self.cards = {
+            "card1": _card("card1", "doc1"),
+            "card2": _card("card2", "doc2"),
+        }
+        # Cards on the active boards, as opposed to the archive boards
+        self.active_cards = {}
+
+        self.patches = [
+            mock.patch('trello_util.iter_all_board_cards',
+                side_effect=lambda: iter(self.cards.values())),
+            mock.patch('trello_util.iter_active_board_cards',
+                side_effect=lambda: iter(self.active_cards.values())),
+            mock.patch('trello_util.get_card_snapshot',
+                side_effect=self.get_card_snapshot),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def get_card_snapshot(self, card_id):
+        if card_id not in self.cards:
+            raise trello_util.TrelloBatchError("404",
+                    "The requested resource was not found.")
+        return self.cards[card_id]
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.testbed.deactivate()
+
+    def test_miss_rebuilds_index(self):
+        card = doc_index.get_card_by_doc_id("doc2")
+        self.assertEqual("card2", card._id)
+
+        # Now it's in the index
+        self.assertEqual("card1", doc_index.DocCard.get_by_id("doc1").card_id)
+        with mock.patch('doc_index.rebuild') as rebuild:
+            self.assertEqual("card1",
+                    doc_index.get_card_by_doc_id("doc1")._id)
+            self.assertFalse(rebuild.called)
+
+    def test_recent_rebuild_only_rescans_active_boards(self):
+        doc_index.rebuild()
+        with mock.patch('doc_index.rebuild') as rebuild:
+            self.assertIsNone(doc_index.get_card_by_doc_id("doc3"))
+            self.assertFalse(rebuild.called)
+
+            # A card moved onto one of our boards w/o its desc changing is
+            # still found
+            self.cards["card3"] = self.active_cards["card3"] = _card("card3",
+                    "doc3")
+            self.assertEqual("card3",
+                    doc_index.get_card_by_doc_id("doc3")._id)
+            self.assertFalse(rebuild.called)
+        self.assertEqual("card3", doc_index.DocCard.get_by_id("doc3").card_id)
+
+        with mock.patch('doc_index.MIN_RESCAN_INTERVAL',
+                datetime.timedelta(0)):
+            with mock.patch('doc_index.rebuild') as rebuild:
+                doc_index.get_card_by_doc_id("doc4")
+                rebuild.assert_called_once_with("doc4")
+
+    def test_index_card(self):
+        doc_index.index_card("card3", ["doc3", "doc4"])
+        self.assertEqual("card3", doc_index.DocCard.get_by_id("doc3").card_id)
+
+        # Unlinking doc4 from the card removes its entry
+        doc_index.index_card("card3", ["doc3"], old_doc_ids=["doc3", "doc4"])
+        self.assertIsNone(doc_index.DocCard.get_by_id("doc4"))
+
+    def test_stale_entries_are_dropped(self):
+        doc_index.rebuild()
+        doc_index.DocCard(id="doc2", card_id="card1").put()
+
+        # card1 doesn't actually link to doc2, so the lookup falls through
+        # and the bad entry goes away
+        with mock.patch('doc_index.MIN_RESCAN_INTERVAL',
+                datetime.timedelta(0)):
+            self.assertEqual("card2",
+                    doc_index.get_card_by_doc_id("doc2")._id)
+        self.assertEqual("card2", doc_index.DocCard.get_by_id("doc2").card_id)
+
+    def test_deleted_cards_are_dropped(self):
+        doc_index.rebuild()
+        del self.cards["card1"]
+
+        self.assertIsNone(doc_index.get_card_by_doc_id("doc1"))
+        self.assertIsNone(doc_index.DocCard.get_by_id("doc1"))
+
+    def test_trello_errors_are_not_misses(self):
+        doc_index.rebuild()
+
+        errors = [trello_util.TrelloBatchError(429, "API_TOKEN_LIMIT"),
+                IOError("timed out")]
+        for error in errors:
+            with mock.patch('trello_util.get_card_snapshot',
+                    side_effect=error):
+                with self.assertRaises(type(error)):
+                    doc_index.get_card_by_doc_id("doc1")
+
+            # The entry is still there for when Trello's back
+            self.assertEqual("card1",
+                    doc_index.DocCard.get_by_id("doc1").card_id)
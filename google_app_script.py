@@ -44,7 +44,7 @@ def send_action_request(action, params):
     """
     logging.info("Sending request to app script w/ action %s and params %s" %
             (action, params))
-    service, http = google_drive.get_authenticated_drive_service()
+    http = google_drive.get_authenticated_drive_http()
 
     params.update({"action": action})
 
@@ -0,0 +1,194 @@
+"""Process-wide cache of Google credentials and API services.
+
+We talk to Google as a preconfigured service account impersonating
+bigboard@khanacademy.org. Getting an authorized API service from scratch means
+reading our private key from disk, signing a JWT assertion, trading it for an
+access token, and building the service from its discovery doc. None of that
+changes from one call to the next, so:
+
+- the private key is read once per process,
+- credentials (and so their access tokens) are shared by every thread and
+  only refreshed when the token is close to expiring,
+- authorized http objects and services are kept per thread, since httplib2
+  isn't thread-safe, and
+- services are built from discovery docs bundled w/ the app (see
+  refresh_discovery_docs.py), each parsed once per process, rather than
+  downloading the doc from Google first.
+
+See perf_stats for how often the caches are hit and tokens refreshed.
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+import googleapiclient.discovery
+import httplib2
+import oauth2client.client
+
+import perf_stats
+import secrets
+
+# Private key of our Google service account. See README.md.
+PRIVATE_KEY_PATH = "khan-big-board-key.pem"
+
+# Access tokens that'll expire within this long are refreshed before use
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+# Directory of bundled discovery docs, named like drive.v2.json
+DISCOVERY_DOCS_DIR = os.path.join(os.path.dirname(__file__), "discovery_docs")
+
+_lock = threading.Lock()
+_private_key = None
+# (scope, user) => SignedJwtAssertionCredentials, and a lock held while each
+# one's access token is refreshed
+_credentials = {}
+_refresh_locks = {}
+# (api name, version) => parsed discovery doc, or None if not bundled
+_discovery_docs = {}
+# Per-thread dicts of (scope, user) => authorized http, and of
+# (api name, version, scope, user) => service
+_local = threading.local()
+
+
+def _get_private_key():
+    global _private_key
+    if _private_key is None:
+        with open(PRIVATE_KEY_PATH) as f:
+            _private_key = f.read()
+    return _private_key
+
+
+def get_credentials(scope, user):
+    """Return shared credentials for impersonating user w/ the given scope.
+
+    The credentials' access token is refreshed first if it's missing or close
+    to expiring. Only threads that need these same credentials wait on the
+    refresh.
+    """
+    key = (scope, user)
+    with _lock:
+        creds = _credentials.get(key)
+        if not creds:
+            creds = oauth2client.client.SignedJwtAssertionCredentials(
+                    secrets.google_service_account_email, _get_private_key(),
+                    scope, sub=user)
+            _credentials[key] = creds
+            _refresh_locks[key] = threading.Lock()
+        refresh_lock = _refresh_locks[key]
+
+    if _needs_refresh(creds):
+        with refresh_lock:
+            # Another thread may have refreshed 'em while we waited
+            if _needs_refresh(creds):
+                creds.refresh(httplib2.Http())
+                perf_stats.incr("google_auth.token_refreshes")
+
+    return creds
+
+
+def _needs_refresh(creds):
+    if not creds.access_token or not creds.token_expiry:
+        return True
+    return (creds.token_expiry - datetime.datetime.utcnow() <
+            TOKEN_REFRESH_MARGIN)
+
+
+def get_authorized_http(scope, user):
+    """Return this thread's http object authorized as user w/ scope."""
+    # Always go through get_credentials so the shared token stays fresh
+    creds = get_credentials(scope, user)
+
+    https = _get_thread_cache("https")
+    http = https.get((scope, user))
+    if not http:
+        http = creds.authorize(httplib2.Http())
+        https[(scope, user)] = http
+    return http
+
+
+def get_service(api_name, version, scope, user):
+    """Return tuple of (this thread's API service, its authorized http).
+
+    Services are built once per thread, scope and user.
+    """
+    http = get_authorized_http(scope, user)
+
+    services = _get_thread_cache("services")
+    key = (api_name, version, scope, user)
+    service = services.get(key)
+    if service:
+        perf_stats.incr("google_auth.service_cache.hits")
+    else:
+        perf_stats.incr("google_auth.service_cache.misses")
+        service = _build_service(api_name, version, http)
+        services[key] = service
+
+    return (service, http)
+
+
+def get_discovery_doc_path(api_name, version):
+    return os.path.join(DISCOVERY_DOCS_DIR, "%s.%s.json" % (api_name, version))
+
+
+def get_discovery_doc(api_name, version):
+    """Return the bundled discovery doc for an API, or None if there isn't one.
+
+    Each doc is read and parsed once per process.
+    """
+    with _lock:
+        if (api_name, version) not in _discovery_docs:
+            doc = None
+            path = get_discovery_doc_path(api_name, version)
+            if os.path.exists(path):
+                with open(path) as f:
+                    doc = json.load(f)
+            else:
+                logging.warning("No bundled discovery doc for %s %s, run "
+                        "refresh_discovery_docs.py" % (api_name, version))
+            _discovery_docs[(api_name, version)] = doc
+
+        return _discovery_docs[(api_name, version)]
+
+
+def _build_service(api_name, version, http):
+    """Build a service from its bundled discovery doc if we have one.
+
+    How long builds take is tracked separately for bundled and downloaded
+    discovery docs (google_auth.build.{bundled,downloaded}.ms).
+    """
+    start = time.time()
+
+    doc = get_discovery_doc(api_name, version)
+    if doc:
+        source = "bundled"
+        service = googleapiclient.discovery.build_from_document(doc,
+                http=http)
+    else:
+        source = "downloaded"
+        service = googleapiclient.discovery.build(api_name, version,
+                http=http)
+
+    perf_stats.incr("google_auth.build.%s.count" % source)
+    perf_stats.incr("google_auth.build.%s.ms" % source,
+            int((time.time() - start) * 1000))
+    return service
+
+
+def _get_thread_cache(name):
+    if not hasattr(_local, name):
+        setattr(_local, name, {})
+    return getattr(_local, name)
+
+
+def clear():
+    """Forget all cached credentials, docs and services, e.g. for tests."""
+    global _private_key
+    with _lock:
+        _private_key = None
+        _credentials.clear()
+        _refresh_locks.clear()
+        _discovery_docs.clear()
+    _local.__dict__.clear()
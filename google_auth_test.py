@@ -0,0 +1,193 @@
+"""Unit tests for caching Google credentials and API services."""
+
+import datetime
+import json
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import googleapiclient.discovery
+import httplib2
+
+import google_auth
+import perf_stats
+import refresh_discovery_docs
+
+SCOPE = "https://www.googleapis.com/auth/drive"
+USER = "bigboard@khanacademy.org"
+
+
+class GoogleAuthTest(unittest.TestCase):
+
+    def setUp(self):
+        google_auth.clear()
+        perf_stats.reset()
+
+        self.patches = [
+            mock.patch('google_auth.open', mock.mock_open(read_data="key"),
+                create=True),
+            mock.patch('oauth2client.client.SignedJwtAssertionCredentials'),
+            mock.patch('google_auth._build_service'),
+        ]
+        self.open, self.Credentials, self.build = [patch.start()
+                for patch in self.patches]
+
+        self.creds = self.Credentials.return_value
+        self.creds.access_token = None
+        self.creds.token_expiry = None
+
+        def refresh(http):
+            self.creds.access_token = "token"
+            self.creds.token_expiry = (datetime.datetime.utcnow() +
+                    datetime.timedelta(hours=1))
+        self.creds.refresh.side_effect = refresh
+        self.creds.authorize.side_effect = lambda http: mock.Mock()
+        self.build.side_effect = lambda *args, **kwargs: mock.Mock()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        google_auth.clear()
+
+    def test_services_are_cached(self):
+        service, http = google_auth.get_service("drive", "v2", SCOPE, USER)
+        self.assertEqual((service, http),
+                google_auth.get_service("drive", "v2", SCOPE, USER))
+
+        self.assertEqual(1, self.open.call_count)
+        self.assertEqual(1, self.Credentials.call_count)
+        self.assertEqual(1, self.build.call_count)
+        self.assertEqual(1, perf_stats.get("google_auth.service_cache.hits"))
+        self.assertEqual(1,
+                perf_stats.get("google_auth.service_cache.misses"))
+
+    def test_tokens_are_refreshed_when_close_to_expiring(self):
+        google_auth.get_authorized_http(SCOPE, USER)
+        google_auth.get_authorized_http(SCOPE, USER)
+        self.assertEqual(1, perf_stats.get("google_auth.token_refreshes"))
+
+        self.creds.token_expiry = (datetime.datetime.utcnow() +
+                datetime.timedelta(minutes=1))
+        google_auth.get_authorized_http(SCOPE, USER)
+        self.assertEqual(2, perf_stats.get("google_auth.token_refreshes"))
+
+    def test_services_are_per_thread(self):
+        services = []
+
+        def get_service():
+            services.append(google_auth.get_service("drive", "v2", SCOPE,
+                    USER)[0])
+
+        get_service()
+        thread = threading.Thread(target=get_service)
+        thread.start()
+        thread.join()
+
+        self.assertNotEqual(services[0], services[1])
+
+        # ...but they share credentials, and so access tokens
+        self.assertEqual(1, self.Credentials.call_count)
+        self.assertEqual(1, perf_stats.get("google_auth.token_refreshes"))
+
+    def test_refreshes_only_block_their_own_credentials(self):
+        refresh_started = threading.Event()
+        finish_refresh = threading.Event()
+        refresh = self.creds.refresh.side_effect
+
+        def slow_refresh(http):
+            refresh_started.set()
+            finish_refresh.wait(5)
+            refresh(http)
+        self.creds.refresh.side_effect = slow_refresh
+
+        threads = [threading.Thread(target=google_auth.get_credentials,
+                args=(SCOPE, USER)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(refresh_started.wait(5))
+
+        # Other credentials don't wait on the slow refresh
+        other_creds = mock.Mock(access_token="token",
+                token_expiry=datetime.datetime.utcnow() +
+                    datetime.timedelta(hours=1))
+        self.Credentials.return_value = other_creds
+        self.assertEqual(other_creds,
+                google_auth.get_credentials(SCOPE, "other@khanacademy.org"))
+        self.assertIsNone(self.creds.access_token)
+
+        finish_refresh.set()
+        for thread in threads:
+            thread.join()
+
+        # The thread that waited on the refresh didn't redo it
+        self.assertEqual(1, perf_stats.get("google_auth.token_refreshes"))
+
+
+class DiscoveryDocTest(unittest.TestCase):
+
+    def setUp(self):
+        google_auth.clear()
+        perf_stats.reset()
+
+        self.docs_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.docs_dir, "drive.v2.json"), "w") as f:
+            json.dump({"name": "drive"}, f)
+
+        self.patches = [
+            mock.patch('google_auth.DISCOVERY_DOCS_DIR', self.docs_dir),
+            mock.patch('googleapiclient.discovery.build'),
+            mock.patch('googleapiclient.discovery.build_from_document'),
+        ]
+        _, self.build, self.build_from_document = [patch.start()
+                for patch in self.patches]
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.docs_dir)
+        google_auth.clear()
+
+    def test_services_are_built_from_bundled_docs(self):
+        http = mock.Mock()
+        google_auth._build_service("drive", "v2", http)
+        google_auth._build_service("drive", "v2", http)
+
+        self.build_from_document.assert_called_with({"name": "drive"},
+                http=http)
+        self.assertFalse(self.build.called)
+        self.assertEqual(2,
+                perf_stats.get("google_auth.build.bundled.count"))
+
+        # Docs are only parsed once
+        with mock.patch('json.load') as load:
+            google_auth._build_service("drive", "v2", http)
+            self.assertFalse(load.called)
+
+    def test_missing_docs_are_downloaded(self):
+        http = mock.Mock()
+        google_auth._build_service("admin", "directory_v1", http)
+        self.build.assert_called_once_with("admin", "directory_v1",
+                http=http)
+        self.assertEqual(1,
+                perf_stats.get("google_auth.build.downloaded.count"))
+
+
+class BundledDiscoveryDocTest(unittest.TestCase):
+
+    def setUp(self):
+        google_auth.clear()
+
+    def tearDown(self):
+        google_auth.clear()
+
+    def test_bundled_docs_build_services(self):
+        for api_name, version in refresh_discovery_docs.BUNDLED_APIS:
+            doc = google_auth.get_discovery_doc(api_name, version)
+            self.assertIsNotNone(doc, "%s %s isn't bundled" % (api_name,
+                    version))
+            self.assertEqual(version, doc["version"])
+            googleapiclient.discovery.build_from_document(doc,
+                    http=httplib2.Http())
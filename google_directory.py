@@ -3,39 +3,28 @@
 We use this to query for domain emails by full names.
 """
 
-import googleapiclient.discovery
-import googleapiclient.http
-import httplib2
-import oauth2client.client
-
-import secrets
+import google_auth
 
 # When authenticating to access Google Drive docs, we'll impersonate this user.
 # This impersonation is allowed because we're logging in as a preconfigured
 # Google Service account that's been given read-only Google Directory API scope
 # for the KA domain.
 GOOGLE_DIRECTORY_USER = "bigboard@khanacademy.org"
+GOOGLE_DIRECTORY_SCOPE = (
+        "https://www.googleapis.com/auth/admin.directory.user.readonly")
 
 
 def get_authenticated_directory_service():
     """Get an authenticated Google Directory API service.
 
     Will be authenticated as the bigboard@khanacademy.org user (by way of
-    impersonation using a preconfigured Google Service account).
+    impersonation using a preconfigured Google Service account). Services are
+    cached per thread (see google_auth.py).
 
     Returns a tuple of (authorized_google_service, authorized_http_object)
     """
-    with open("khan-big-board-key.pem") as f:
-        private_key = f.read()
-
-    creds = oauth2client.client.SignedJwtAssertionCredentials(
-            secrets.google_service_account_email, private_key,
-            "https://www.googleapis.com/auth/admin.directory.user.readonly",
-            sub=GOOGLE_DIRECTORY_USER)
-    http = creds.authorize(httplib2.Http())
-    service = googleapiclient.discovery.build("admin", "directory_v1",
-            http=http)
-    return (service, http)
+    return google_auth.get_service("admin", "directory_v1",
+            GOOGLE_DIRECTORY_SCOPE, GOOGLE_DIRECTORY_USER)
 
 
 def query_for_user_email_by_name(name):
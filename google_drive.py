@@ -9,15 +9,12 @@ setup. See README.md for more.
 """
 import re
 
-import googleapiclient.discovery
-import googleapiclient.http
-import httplib2
-import oauth2client.client
-
+import doc_html_cache
 import google_app_script
+import google_auth
 import google_drive
 import project_docs
-import secrets
+import thread_pool
 import trello_util
 
 # When authenticating to access Google Drive docs, we'll impersonate this user.
@@ -25,11 +22,18 @@ import trello_util
 # Google Service account that's been given Google Drive API scope for the KA
 # domain.
 GOOGLE_DRIVE_USER = "bigboard@khanacademy.org"
+GOOGLE_DRIVE_SCOPE = "https://www.googleapis.com/auth/drive"
 
 # Google doc id for the retrospective template that gets copied when making new
 # retrospectives
 RETRO_TEMPLATE_GOOGLE_DOC_ID = "1gbejuiityqZR9LDq-tyJGL0RHkAbCFe9Wc5IULPSQqw"
 
+# Max number of docs whose HTML is downloaded at once by pull_docs_data
+MAX_DOC_WORKERS = 5
+
+# Max number of requests Drive accepts in a single batch request
+MAX_BATCH_SIZE = 100
+
 GOOGLE_DOC_RE = r'https?://docs.google.com/?[^\s]*/document/[^\>\s]+'
 GOOGLE_DRIVE_RE = r'https?://drive.google.com/open.*[?&]id=[^\>\s]+'
 
@@ -38,20 +42,22 @@ def get_authenticated_drive_service():
     """Get an authenticated Google Drive API service.
 
     Will be authenticated as the bigboard@khanacademy.org user (by way of
-    impersonation using a preconfigured Google Service account).
+    impersonation using a preconfigured Google Service account). Services are
+    cached per thread (see google_auth.py).
 
     Returns a tuple of (authorized_google_service, authorized_http_object)
     """
-    with open("khan-big-board-key.pem") as f:
-        private_key = f.read()
+    return google_auth.get_service("drive", "v2", GOOGLE_DRIVE_SCOPE,
+            GOOGLE_DRIVE_USER)
 
-    creds = oauth2client.client.SignedJwtAssertionCredentials(
-            secrets.google_service_account_email, private_key,
-            "https://www.googleapis.com/auth/drive",
-            sub=GOOGLE_DRIVE_USER)
-    http = creds.authorize(httplib2.Http())
-    service = googleapiclient.discovery.build("drive", "v2", http=http)
-    return (service, http)
+
+def get_authenticated_drive_http():
+    """Get an http object authorized like get_authenticated_drive_service's.
+
+    This skips building the Drive service for callers that only need http.
+    """
+    return google_auth.get_authorized_http(GOOGLE_DRIVE_SCOPE,
+            GOOGLE_DRIVE_USER)
 
 
 def pull_doc_data(doc_id):
@@ -66,13 +72,85 @@ def pull_doc_data(doc_id):
 
     # Pull doc metadata, including title and HTML URL
     results = service.files().get(fileId=doc_id).execute()
-    title = results["title"]
 
-    # Use HTML URL to pull doc's html body
-    html_url = results["exportLinks"]["text/html"]
-    response, html = http.request(html_url)
+    return _export_doc_data(http, results)
+
+
+def pull_docs_data(doc_ids):
+    """Return many Google Docs' data from Drive API at once.
+
+    Metadata for all the docs is pulled in batch requests, and then the docs'
+    html bodies are downloaded in parallel.
+
+    Arguments:
+        doc_ids: list of google drive doc ids
+    Returns:
+        list w/ an item for each doc id, in the same order: either a tuple of
+        (document title, document html), or the exception raised when
+        pulling that doc
+    """
+    metadata = pull_docs_metadata(doc_ids)
+
+    def pull_html(doc_metadata):
+        if isinstance(doc_metadata, Exception):
+            return doc_metadata
+        try:
+            # Each thread gets its own http object, see google_auth.py
+            return _export_doc_data(get_authenticated_drive_http(),
+                    doc_metadata)
+        except Exception as e:
+            return e
 
-    return (title, html)
+    return thread_pool.map_in_parallel(pull_html, metadata, MAX_DOC_WORKERS)
+
+
+def pull_docs_metadata(doc_ids):
+    """Return Drive API metadata for many Google Docs via batch requests.
+
+    Returns list w/ an item for each doc id, in the same order: either the
+    doc's metadata or the exception raised when getting it.
+    """
+    service, http = get_authenticated_drive_service()
+    results = [None] * len(doc_ids)
+
+    def callback(request_id, response, exception):
+        results[int(request_id)] = exception or response
+
+    for start in range(0, len(doc_ids), MAX_BATCH_SIZE):
+        # Drive's own batch endpoint, since Google's global one is retired
+        batch = service.new_batch_http_request(callback=callback)
+        for i in range(start, min(start + MAX_BATCH_SIZE, len(doc_ids))):
+            batch.add(service.files().get(fileId=doc_ids[i]),
+                    request_id=str(i))
+
+        try:
+            batch.execute(http=http)
+        except Exception as e:
+            # The whole batch failed, so every doc in it without a result did
+            for i in range(start, min(start + MAX_BATCH_SIZE, len(doc_ids))):
+                results[i] = results[i] or e
+
+    return results
+
+
+def _export_doc_data(http, metadata):
+    """Return tuple of (document title, document html) for a doc's metadata.
+
+    The html is only downloaded if we don't already have it cached for this
+    revision of the doc (see doc_html_cache.py).
+    """
+    doc_id = metadata["id"]
+    version = doc_html_cache.get_doc_version(metadata)
+
+    html = doc_html_cache.get_html(doc_id, version)
+    if html is None:
+        # Use HTML URL to pull doc's html body
+        html_url = metadata["exportLinks"]["text/html"]
+        response, html = http.request(html_url)
+        if response.status == 200:
+            doc_html_cache.set_html(doc_id, version, html)
+
+    return (metadata["title"], html)
 
 
 def copy_retro_template(card):
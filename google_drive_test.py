@@ -1,8 +1,15 @@
 """Unit tests for testing Google drive project doc interactions."""
 
+import googleapiclient.discovery
+import httplib2
+import mock
 import unittest
 
+from google.appengine.ext import testbed
+
+import doc_html_cache
 import google_app_script
+import google_auth
 import google_drive
 
 
@@ -20,6 +27,12 @@ EXAMPLE_PRIVATE_GOOGLE_DOC_ID = (
 class AddTrelloLinkToDocTest(unittest.TestCase):
 
     def setUp(self):
+        # Exported doc html is cached in memcache
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        doc_html_cache.clear()
+
         # Remove Trello links that were inserted during previous fail test
         google_drive.remove_trello_links(EXAMPLE_GOOGLE_DOC_ID)
 
@@ -27,6 +40,9 @@ class AddTrelloLinkToDocTest(unittest.TestCase):
         # Remove Trello links that were inserted during unit test
         google_drive.remove_trello_links(EXAMPLE_GOOGLE_DOC_ID)
 
+        doc_html_cache.clear()
+        self.testbed.deactivate()
+
     def test_add_trello_link_to_doc(self):
         # Make sure no Trello URL exists already
         title, html = google_drive.pull_doc_data(EXAMPLE_GOOGLE_DOC_ID)
@@ -50,3 +66,110 @@ class AddTrelloLinkToDocTest(unittest.TestCase):
         with self.assertRaises(google_app_script.PermissionError):
             google_drive.add_trello_link(EXAMPLE_PRIVATE_GOOGLE_DOC_ID,
                     EXAMPLE_TRELLO_CARD_ID)
+
+
+class FakeBatchHttpRequest(object):
+    """Runs batched requests one by one, reporting each to the callback."""
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self, http):
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except Exception as e:
+                self.callback(request_id, None, e)
+
+
+class PullDocsDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        doc_html_cache.clear()
+
+        self.metadata = {
+            "doc1": {"id": "doc1", "title": "Monkey", "etag": "v1",
+                "exportLinks": {"text/html": "1"}},
+            "doc3": {"id": "doc3", "title": "Gorilla", "etag": "v1",
+                "exportLinks": {"text/html": "3"}},
+        }
+
+        service = mock.Mock()
+        service.files.return_value.get.side_effect = (
+                lambda fileId: mock.Mock(execute=lambda: self._get(fileId)))
+        service.new_batch_http_request.side_effect = FakeBatchHttpRequest
+
+        self.http = http = mock.Mock()
+        http.request.side_effect = lambda url: (mock.Mock(status=200),
+                "<html>%s</html>" % url)
+
+        self.patches = [
+            mock.patch('google_drive.get_authenticated_drive_service',
+                return_value=(service, http)),
+            mock.patch('google_drive.get_authenticated_drive_http',
+                return_value=http),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        doc_html_cache.clear()
+        self.testbed.deactivate()
+
+    def _get(self, doc_id):
+        if doc_id not in self.metadata:
+            raise IOError("404: %s" % doc_id)
+        return self.metadata[doc_id]
+
+    def test_failures_are_isolated_per_doc(self):
+        results = google_drive.pull_docs_data(["doc1", "doc2", "doc3"])
+
+        self.assertEqual(("Monkey", "<html>1</html>"), results[0])
+        self.assertIsInstance(results[1], IOError)
+        self.assertEqual(("Gorilla", "<html>3</html>"), results[2])
+
+    def test_unchanged_docs_are_not_downloaded_again(self):
+        google_drive.pull_docs_data(["doc1", "doc3"])
+        self.assertEqual(("Monkey", "<html>1</html>"),
+                google_drive.pull_docs_data(["doc1"])[0])
+        self.assertEqual(2, self.http.request.call_count)
+
+        # ...but changed ones are
+        self.metadata["doc1"]["etag"] = "v2"
+        google_drive.pull_docs_data(["doc1", "doc3"])
+        self.assertEqual(3, self.http.request.call_count)
+
+    def test_metadata_is_batched(self):
+        with mock.patch('google_drive.MAX_BATCH_SIZE', 2):
+            with mock.patch.object(FakeBatchHttpRequest, 'execute',
+                    autospec=True,
+                    side_effect=FakeBatchHttpRequest.execute) as execute:
+                results = google_drive.pull_docs_metadata(
+                        ["doc1", "doc2", "doc3"])
+
+        self.assertEqual(2, execute.call_count)
+        self.assertEqual("Monkey", results[0]["title"])
+        self.assertIsInstance(results[1], IOError)
+        self.assertEqual("Gorilla", results[2]["title"])
+
+    @mock.patch('googleapiclient.http.BatchHttpRequest.execute',
+            autospec=True)
+    def test_batches_go_to_drive_batch_endpoint(self, execute):
+        service = googleapiclient.discovery.build_from_document(
+                google_auth.get_discovery_doc("drive", "v2"),
+                http=httplib2.Http())
+        with mock.patch('google_drive.get_authenticated_drive_service',
+                return_value=(service, self.http)):
+            google_drive.pull_docs_metadata(["doc1"])
+
+        batch = execute.call_args[0][0]
+        self.assertEqual("https://www.googleapis.com/batch/drive/v2",
+                batch._batch_uri)
@@ -19,10 +19,16 @@ import logging
 import os
 
 from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
 import webapp2
 
+import board_sync
+import catch_up
+import doc_index
+import perf_stats
 import retrospective
-import stickers
+import trello_util
+import webhook_queue
 import webhooks
 
 
@@ -44,9 +50,46 @@ class Setup(RequestHandler):
         """Run initial big board+webhook setup (triggered by task queue)."""
         webhooks.setup()
 
-        # Update all stickers on big board (but only big board, don't waste
-        # time on completed and pipeline) during initial setup
-        stickers.sync_big_board_stickers()
+        # Queue up (or resume) a chunked sticker sync of the big board (but
+        # only big board, don't waste time on completed and pipeline). It runs
+        # in its own tasks, so setup doesn't wait for it to finish.
+        board_sync.sync_board_stickers('BIG_BOARD')
+
+        # (Re)build the doc id => card index used when new project docs are
+        # submitted
+        deferred.defer(doc_index.rebuild)
+
+
+class SyncStickers(RequestHandler):
+    def get(self):
+        """Dump progress of the latest sticker sync of each board as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(board_sync.get_all_progress(),
+                indent=2))
+
+    def post(self):
+        """Start (or resume) sticker syncs for one board or all of 'em.
+
+        Pass board=BOARD_NAME to sync a single board and restart=1 to start
+        over instead of resuming an unfinished sync.
+        """
+        board_name = self.request.get("board")
+        board_names = ([board_name] if board_name else
+                sorted(trello_util.BOARD_NAME_TO_ID))
+        resume = not self.request.get("restart")
+
+        for name in board_names:
+            board_sync.sync_board_stickers(name, resume=resume)
+
+        self.success("Queued sticker sync for: %s" % ", ".join(board_names))
+
+
+class Stats(RequestHandler):
+    def get(self):
+        """Dump this instance's perf counters (see perf_stats.py) as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(perf_stats.snapshot(), indent=2,
+                sort_keys=True))
 
 
 class CreateRetro(RequestHandler):
@@ -79,32 +122,84 @@ class UpdateBoardWebHook(RequestHandler):
         self.post()
 
     def post(self):
-        """Handle 'your board was updated!' webhook triggered by Trello."""
-        # TODO(kamens): this webhook doesn't do much error handling.
+        """Handle 'your board was updated!' webhook triggered by Trello.
+
+        This just queues up the event for ProcessUpdateBoardWebHook and returns
+        right away so Trello doesn't time out and retry its delivery.
+        """
         request_body = self.request.body
         logging.info("WebHook body: (%s)" % request_body)
 
         # Trello sends webhook data as JSON body payload
-        body_json = json.loads(request_body)
+        try:
+            body_json = json.loads(request_body)
+        except ValueError:
+            logging.info("Ignoring this webhook from Trello due to bad JSON")
+            return
+
+        # List actions don't go to any handler, but do make cached copies of
+        # the board's lists stale
+        webhooks.invalidate_changed_lists(body_json)
 
         # Try to pull the webhook's action type and card id out of webhook data
-        try:
-            action_type = body_json["action"]["type"]
-            card_id = body_json["action"]["data"]["card"]["id"]
-            board_id = body_json["action"]["data"]["board"]["id"]
-        except KeyError:
+        event = webhook_queue.WebhookEvent.from_webhook_body(body_json)
+        if not event:
             # If missing expected data from webhook, just bail
             logging.info("Ignoring this webhook from Trello "
                          "due to missing action type or card id")
             return
 
-        webhooks.trigger_update_handlers(action_type, card_id, board_id)
+        # Trello redelivers webhooks it thinks failed, so skip any action
+        # we've already received before doing any more work.
+        if not webhook_queue.claim_delivery(event):
+            logging.info("Ignoring duplicate delivery of %s" % event)
+            self.success("WebHook already received")
+            return
+
+        try:
+            webhook_queue.enqueue(event)
+        except Exception:
+            # Let Trello's retry of this delivery through
+            webhook_queue.release_delivery(event)
+            raise
 
         self.success("WebHook received")
 
 
+class ProcessUpdateBoardWebHook(RequestHandler):
+    def post(self):
+        """Run webhook handlers for an event (triggered by task queue).
+
+        Any exception raised here fails the task, which is then retried
+        according to the webhook-updates queue's policy in queue.yaml.
+        """
+        event = webhook_queue.WebhookEvent.from_params(self.request.params)
+        webhook_queue.process(event)
+
+        self.success("WebHook processed")
+
+
+class CatchUpWebHooks(RequestHandler):
+    def get(self):
+        """Replay any Trello actions we missed webhooks for (run by cron)."""
+        catch_up.catch_up_all_boards()
+        self.success("Queued catch-up for all boards")
+
+
+class DeleteExpiredWebHookActions(RequestHandler):
+    def get(self):
+        """Forget Trello actions too old to be redelivered (run by cron)."""
+        deferred.defer(webhook_queue.delete_expired_actions)
+        self.success("Queued deletion of expired webhook actions")
+
+
 app = webapp2.WSGIApplication([
     ('/setup', Setup),
     ('/webhook/update_board', UpdateBoardWebHook),
+    ('/webhook/process_update', ProcessUpdateBoardWebHook),
+    ('/webhook/catch_up', CatchUpWebHooks),
+    ('/webhook/cleanup', DeleteExpiredWebHookActions),
     ('/retro/create', CreateRetro),
+    ('/stats', Stats),
+    ('/sync/stickers', SyncStickers),
 ], debug=True)
@@ -0,0 +1,40 @@
+"""In-process counters for keeping an eye on how much work we're doing.
+
+These are per-instance and reset whenever an instance spins up, which is
+plenty for checking how often we're hitting Trello and Google vs. skipping
+work. See main.Stats for dumping 'em.
+"""
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+
+
+def incr(name, delta=1):
+    """Increment the named counter by delta."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + delta
+
+
+def set_gauge(name, value):
+    """Set the named counter to value, e.g. for levels rather than totals."""
+    with _lock:
+        _counters[name] = value
+
+
+def get(name):
+    """Return the named counter's current value."""
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot():
+    """Return a copy of all counters."""
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    """Reset all counters (handy for tests and benchmarks)."""
+    with _lock:
+        _counters.clear()
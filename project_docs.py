@@ -2,10 +2,32 @@
 import logging
 import re
 
+import lxml.etree
 import pyquery
 
 import google_drive
 
+# Subsection titles that our project docs tend to have (these are all in our
+# project doc template)
+#
+# TODO(kamens): figure out way for this list to not fall gradually
+# out-of-date as our project doc template is updated.
+EXPECTED_SUBSECTIONS = [
+        "Problem statement",
+        "Objective",
+        "Timeframe",
+        "Resourcing",
+        "Other goals",
+        "Non-goals",
+        "Dependencies"
+        ]
+
+# Number of expected subsections a doc needs to count as a project doc
+REQUIRED_SUBSECTIONS = 2
+
+# Size of the chunks of html fed to StreamingProjectDocVerifier's parser
+FEED_CHUNK_BYTES = 16 * 1024
+
 
 class ProjectDoc(object):
     """Stores all data representing a project doc."""
@@ -91,21 +113,7 @@ class ProjectDocVerifier(object):
 
     def _has_expected_subsections(self):
         """Return True if doc has subsections our project docs tend to have."""
-        # List the subsection titles that our project docs tend to have (these
-        # are all in our project doc template)
-        #
-        # TODO(kamens): figure out way for this list to not fall gradually
-        # out-of-date as our project doc template is updated.
-        expected_subsections = [
-                "Problem statement",
-                "Objective",
-                "Timeframe",
-                "Resourcing",
-                "Other goals",
-                "Non-goals",
-                "Dependencies"
-                ]
-        expected_subsections = map(lambda s: s.lower(), expected_subsections)
+        expected_subsections = map(lambda s: s.lower(), EXPECTED_SUBSECTIONS)
 
         # Grab all subsections (text blocks inside <h1>s) in doc being verified
         h1s = self.pq("h1")
@@ -129,26 +137,163 @@ class ProjectDocVerifier(object):
         count_matching_subsections += count_matching_paragraph_subsections
 
         # If we have at least two of the expected subsections, call it good
-        required_subsections = 2
-        return count_matching_subsections >= required_subsections
+        return count_matching_subsections >= REQUIRED_SUBSECTIONS
+
+
+class StreamingProjectDocVerifier(object):
+    """Same as ProjectDocVerifier, but w/o parsing the whole doc up front.
+
+    Building a full pyquery DOM of a long doc (especially one w/ big embedded
+    images) is slow and memory-hungry, and it's unnecessary: all we need are
+    the doc's title and subsection headings. This feeds the html to an lxml
+    parser a chunk at a time, keeping track of what's been found so far (see
+    _ProjectDocParserTarget) w/o ever building a tree.
+
+    Parsing only stops early once a title containing "initiative" turns up,
+    since nothing later in the doc can change the answer after that. Any
+    other doc is parsed to the end, as such a title could still follow.
+    """
+    def __init__(self, doc_id, html):
+        self.doc_id = doc_id
+        self.html = html
+
+    def is_project_doc(self):
+        logging.info("Verifying whether %s is a project doc." % self.doc_id)
+
+        if not self.html:
+            logging.info("Not a project doc: empty HTML body")
+            return False
+
+        target = _ProjectDocParserTarget()
+        parser = lxml.etree.HTMLParser(target=target)
+        for start in range(0, len(self.html), FEED_CHUNK_BYTES):
+            parser.feed(self.html[start:start + FEED_CHUNK_BYTES])
+            if target.is_initiative:
+                break
+        else:
+            parser.close()
+
+        if not target.has_title:
+            logging.info("Not a project doc: doesn't have title")
+            return False
+
+        if not target.has_expected_subsections:
+            logging.info("Not a project doc: missing expected subsections")
+            return False
+
+        logging.info("Looks like a project doc!")
+        return True
+
+
+class _ProjectDocParserTarget(object):
+    """lxml parser target that looks for a doc's title and subsections.
+
+    Text is gathered the same way pyquery's text() does it, so we match
+    exactly what ProjectDocVerifier would: each run of text between tags is
+    stripped, and non-empty runs are joined w/ single spaces.
+    """
+    def __init__(self):
+        self.expected_subsections = [s.lower() for s in EXPECTED_SUBSECTIONS]
+
+        self.title_texts = []
+        self.h1_texts = set()
+        self.paragraph_subsections = set()
+        self.count_matching_h1_subsections = 0
+
+        # Stack of (tag, class names) for the elements we're inside of, the
+        # element whose text is being gathered (if any), and that text
+        self._open_tags = []
+        self._gathering = None
+        self._fragments = []
+        self._data = []
+
+    @property
+    def has_title(self):
+        return bool(self.title_texts) and not self.is_initiative
+
+    @property
+    def is_initiative(self):
+        # Ignore any initiative proposals
+        return "initiative" in " ".join(self.title_texts).lower()
+
+    @property
+    def has_expected_subsections(self):
+        return (self.count_matching_h1_subsections +
+                len(self.paragraph_subsections) >= REQUIRED_SUBSECTIONS)
+
+    def start(self, tag, attrib):
+        self._flush_data()
+        classes = attrib.get("class", "").split()
+        self._open_tags.append((tag, classes))
+        if self._gathering is None and tag in ("h1", "p"):
+            self._gathering = len(self._open_tags) - 1
+
+    def end(self, tag):
+        self._flush_data()
+        if not self._open_tags:
+            return
+
+        closed_tag, classes = self._open_tags.pop()
+        if self._gathering == len(self._open_tags):
+            self._gathering = None
+            self._found_text(closed_tag, classes,
+                    " ".join(self._fragments))
+            self._fragments = []
+
+    def data(self, data):
+        if self._gathering is not None:
+            self._data.append(data)
+
+    def close(self):
+        pass
+
+    def _flush_data(self):
+        fragment = "".join(self._data).strip()
+        if fragment:
+            self._fragments.append(fragment)
+        self._data = []
+
+    def _found_text(self, tag, classes, text):
+        if tag == "h1":
+            text = text.lower()
+            if text not in self.h1_texts:
+                self.h1_texts.add(text)
+                self.count_matching_h1_subsections += len([s
+                        for s in self.expected_subsections
+                        if text.startswith(s)])
+        elif tag == "p":
+            if text and "title" in classes and self._in_body():
+                self.title_texts.append(text)
+            if text.lower() in self.expected_subsections:
+                self.paragraph_subsections.add(text.lower())
+
+    def _in_body(self):
+        return any(tag == "body" for tag, _ in self._open_tags)
 
 
 def pull_project_docs_data(doc_ids):
-    """Pull project docs data for specified Google Docs from Drive API."""
+    """Pull project docs data for specified Google Docs from Drive API.
+
+    Docs are pulled all at once (see google_drive.pull_docs_data), and one
+    that fails to be pulled is just skipped.
+    """
     docs = []
 
-    for doc_id in doc_ids:
+    doc_ids = list(doc_ids)
+    docs_data = google_drive.pull_docs_data(doc_ids)
+
+    for doc_id, doc_data in zip(doc_ids, docs_data):
         title = None
         html = None
 
-        try:
-            title, html = google_drive.pull_doc_data(doc_id)
-        except Exception as e:
+        if isinstance(doc_data, Exception):
             # TODO(kamens): more specific and better error handling
             logging.error("Failed to pull data for google doc id (%s): %s" %
-                    (doc_id, e))
+                    (doc_id, doc_data))
+        else:
+            title, html = doc_data
 
-        verifier = ProjectDocVerifier(doc_id, html)
+        verifier = StreamingProjectDocVerifier(doc_id, html)
         if verifier.is_project_doc():
             doc = ProjectDoc(doc_id, title, html)
             docs.append(doc)
@@ -1,7 +1,14 @@
 """Unit tests for testing Google drive project doc interactions."""
 
+import logging
+import mock
+import time
 import unittest
 
+from google.appengine.ext import testbed
+
+import doc_html_cache
+import google_drive
 import project_docs
 
 
@@ -82,6 +89,17 @@ class ProjectDocsTitleTest(unittest.TestCase):
 
 class ProjectDocsTest(unittest.TestCase):
 
+    def setUp(self):
+        # Exported doc html is cached in memcache
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        doc_html_cache.clear()
+
+    def tearDown(self):
+        doc_html_cache.clear()
+        self.testbed.deactivate()
+
     def test_single_project_doc_pull(self):
         doc_id = "1aZReJLIcfJU4y3VpGI2oXfuOaf8BJ8DJDrCNHiBDPkI"
         docs = project_docs.pull_project_docs_data([doc_id])
@@ -115,3 +133,138 @@ class ProjectDocsTest(unittest.TestCase):
         """Verify that non-project docs are properly filtered and excluded."""
         docs = project_docs.pull_project_docs_data(EXAMPLE_NON_PROJECT_DOCS)
         self.assertEqual(len(docs), 0)
+
+    def test_streaming_verifier_matches_pyquery_verifier(self):
+        """Both verifiers agree on all our real example docs."""
+        doc_ids = EXAMPLE_PROJECT_DOCS.keys() + EXAMPLE_NON_PROJECT_DOCS
+        pyquery_seconds = streaming_seconds = 0
+
+        for doc_id, doc_data in zip(doc_ids,
+                google_drive.pull_docs_data(doc_ids)):
+            html = None if isinstance(doc_data, Exception) else doc_data[1]
+
+            start = time.time()
+            expected = project_docs.ProjectDocVerifier(doc_id,
+                    html).is_project_doc()
+            pyquery_seconds += time.time() - start
+
+            start = time.time()
+            actual = project_docs.StreamingProjectDocVerifier(doc_id,
+                    html).is_project_doc()
+            streaming_seconds += time.time() - start
+
+            self.assertEqual(expected, actual, doc_id)
+
+        logging.info("Verified %s example docs: %.3fs w/ pyquery, %.3fs "
+                "streaming" % (len(doc_ids), pyquery_seconds,
+                    streaming_seconds))
+
+
+def _doc_html(title=None, headings=(), paragraphs=(), title_first=True,
+        image_bytes=0, last_title=None):
+    """Return html shaped like Google Docs' html exports."""
+    body = []
+    if title is not None:
+        body.append('<p class="c4 title" id="h.1"><span class="c2">%s</span>'
+                '</p>' % title)
+    for heading in headings:
+        body.append('<h1 class="c1" id="h.2"><span>%s</span></h1>' % heading)
+        body.append('<p class="c0"><span>Blah blah blah.</span></p>')
+    for paragraph in paragraphs:
+        body.append('<p class="c0"><span class="c3">%s</span></p>' %
+                paragraph)
+    if not title_first:
+        body.reverse()
+    if image_bytes:
+        body.append('<p class="c0"><span><img src="data:image/png;base64,%s">'
+                '</span></p>' % ("A" * image_bytes))
+        body += ['<p class="c0"><span>More words.</span></p>'] * 2000
+    if last_title is not None:
+        body.append('<p class="c4 title" id="h.3"><span class="c2">%s</span>'
+                '</p>' % last_title)
+
+    return ('<html><head><meta content="text/html; charset=UTF-8" '
+            'http-equiv="content-type"><style type="text/css">'
+            '.title{font-size:26pt}</style></head><body class="c5">%s</body>'
+            '</html>' % "".join(body))
+
+
+# Docs shaped like ones that've tripped up the verifier in the past, and
+# whether each one is a project doc
+EXAMPLE_HTML_DOCS = [
+    (_doc_html("Monkey", ["Problem statement", "Objective"]), True),
+    (_doc_html("Monkey", ["Objectives and key results", "Timeframe"]), True),
+    (_doc_html("Monkey initiative", ["Problem statement", "Objective"]),
+        False),
+    (_doc_html(None, ["Problem statement", "Objective"]), False),
+    (_doc_html("", ["Problem statement", "Objective"]), False),
+    (_doc_html("Monkey", ["Problem statement"]), False),
+    (_doc_html("Monkey", ["Objective", "Objective"]), False),
+    (_doc_html("Monkey", ["Problem <b>statement</b>", "Non-goals"]), True),
+    (_doc_html("Monkey", paragraphs=["Problem statement", "Resourcing"]),
+        True),
+    (_doc_html("Monkey", ["Dependencies"], ["Non-goals"]), True),
+    (_doc_html("Monkey", paragraphs=["Problem statement is hard",
+        "Resourcing"]), False),
+    (_doc_html("Caf\xc3\xa9 \xe2\x98\x83", ["Problem statement",
+        "Objective"]), True),
+    (_doc_html("Monkey", ["Problem statement", "Objective"],
+        title_first=False), True),
+    (_doc_html("Monkey", ["Problem statement", "Objective"],
+        image_bytes=500000), True),
+    (_doc_html("Monkey", ["Timeframe"], image_bytes=500000), False),
+    (_doc_html("Monkey", ["Problem statement", "Objective"],
+        last_title="Monkey initiative"), False),
+    (_doc_html("Monkey", ["Problem statement", "Objective"],
+        image_bytes=500000, last_title="Monkey initiative"), False),
+    ("", False),
+]
+
+
+class StreamingProjectDocVerifierTest(unittest.TestCase):
+
+    def test_matches_pyquery_verifier(self):
+        for i, (html, is_project_doc) in enumerate(EXAMPLE_HTML_DOCS):
+            self.assertEqual(is_project_doc, project_docs.ProjectDocVerifier(
+                    "doc%s" % i, html).is_project_doc(), i)
+            self.assertEqual(is_project_doc,
+                    project_docs.StreamingProjectDocVerifier(
+                        "doc%s" % i, html).is_project_doc(), i)
+
+    def test_long_docs(self):
+        html = _doc_html("Monkey", ["Problem statement", "Objective"],
+                image_bytes=2000000)
+
+        start = time.time()
+        expected = project_docs.ProjectDocVerifier("doc",
+                html).is_project_doc()
+        pyquery_seconds = time.time() - start
+
+        start = time.time()
+        actual = project_docs.StreamingProjectDocVerifier("doc",
+                html).is_project_doc()
+        streaming_seconds = time.time() - start
+
+        self.assertTrue(expected)
+        self.assertTrue(actual)
+
+        # Timings are only logged, since they vary w/ the machine's load
+        logging.info("Verified %sKB doc: %.3fs w/ pyquery, %.3fs streaming" %
+                (len(html) / 1024, pyquery_seconds, streaming_seconds))
+
+
+class PullProjectDocsDataTest(unittest.TestCase):
+
+    @mock.patch('google_drive.pull_docs_data')
+    def test_failed_docs_are_skipped(self, pull_docs_data):
+        pull_docs_data.return_value = [("Monkey", "<html></html>"),
+                IOError("404")]
+
+        with mock.patch.object(project_docs.StreamingProjectDocVerifier,
+                'is_project_doc', autospec=True,
+                side_effect=lambda verifier: verifier.html is not None):
+            docs = project_docs.pull_project_docs_data(["doc1", "doc2"])
+
+        pull_docs_data.assert_called_once_with(["doc1", "doc2"])
+        self.assertEqual(["doc1"], [doc.doc_id for doc in docs])
+        self.assertEqual("Monkey", docs[0].title)
@@ -1,6 +1,7 @@
 """Tool for interacting with Trello's project proposals board."""
 import logging
 
+import doc_index
 import google_app_script
 import google_drive
 import project_docs
@@ -14,7 +15,7 @@ def create_cards_from_doc_ids(doc_ids):
 
     for doc in docs:
         already_existed = True
-        card = trello_util.get_card_by_doc_id(doc.doc_id)
+        card = doc_index.get_card_by_doc_id(doc.doc_id)
 
         if not card:
             # A new card was created!
@@ -24,6 +25,10 @@ def create_cards_from_doc_ids(doc_ids):
             card = _add_card(doc.title, desc)
             already_existed = False
 
+            # Our own card writes don't trigger webhook handlers, so index
+            # the new card ourselves.
+            doc_index.index_card(card._id, [doc.doc_id])
+
         # Regardless of whether or not a card was created, try to make sure a
         # link exists from the Google Doc to the Trello Card
         try:
@@ -55,11 +60,10 @@ def _add_card(name, desc=None):
     if not name:
         return
 
-    board = trello_util.get_proposals_board()
-
     # Enter the project into the pipeline by adding a card to the proposals
     # board's first list (coincidentally named "Proposal").
-    proposal_list = board.lists[0]
+    proposal_list_id = trello_util.get_board_lists('PROPOSALS_BOARD')[0]['id']
+    proposal_list = trello_util.get_client().get_list(proposal_list_id)
 
     card = proposal_list.add_card(name, desc)
 
@@ -0,0 +1,205 @@
+"""Keeps us under Trello's API rate limit, w/ webhook work getting first dibs.
+
+Trello allows 100 requests per 10 seconds per token. Every Trello request we
+make goes through trello_util.TrelloConnectionPool, which asks a RateLimiter
+for permission first. The RateLimiter keeps a token bucket shared by all
+threads in the instance and, optionally, a per-window request count in
+memcache shared by all instances. Requests that'd go over budget wait their
+turn instead of failing.
+
+Interactive work (handling webhooks) can spend the whole budget, while bulk
+work (board-wide syncs) leaves BULK_RESERVE requests' worth of budget for
+interactive work. If Trello still answers w/ a 429, the request is retried
+after the Retry-After it asked for (or an exponential backoff w/ jitter).
+"""
+import logging
+import random
+import threading
+import time
+
+from google.appengine.api import memcache
+
+import perf_stats
+
+# Request priorities
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# Trello's limit is 100 requests per 10 seconds per token. Leave a little
+# headroom for requests made from outside this app (e.g. when debugging).
+WINDOW_SECONDS = 10
+REQUESTS_PER_WINDOW = 90
+
+# Number of requests per window that bulk work leaves for interactive work
+BULK_RESERVE = 30
+
+# Set to True to also count requests across all instances via memcache
+SHARE_ACROSS_INSTANCES = False
+
+# Give up waiting for budget (and let the request go ahead anyway) after this
+# long, so a bad clock or a stuck memcache count can't wedge requests forever
+MAX_WAIT_SECONDS = 30
+
+# Backoff for retrying 429s that don't tell us how long to wait
+BACKOFF_BASE_SECONDS = 1
+MAX_RETRIES = 4
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket: capacity tokens, refilled at a steady rate."""
+    def __init__(self, capacity, refill_per_second, clock=time.time):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = float(capacity)
+        self._last_refill = clock()
+        self._paused_until = 0
+
+    @property
+    def available(self):
+        """Number of whole tokens currently available."""
+        with self._lock:
+            self._refill()
+            return int(self._tokens)
+
+    def try_acquire(self, reserve=0):
+        """Try to take a token while leaving at least reserve tokens behind.
+
+        Returns 0 if a token was taken, or else the number of seconds until
+        one should be available.
+        """
+        with self._lock:
+            now = self._clock()
+            if now < self._paused_until:
+                return self._paused_until - now
+
+            self._refill()
+            if self._tokens - 1 >= reserve:
+                self._tokens -= 1
+                return 0
+
+            return (reserve + 1 - self._tokens) / self.refill_per_second
+
+    def pause(self, seconds):
+        """Empty the bucket and hand out no tokens for a while.
+
+        The bucket starts refilling from empty once the pause is over, so
+        the pause itself doesn't count as refill time.
+        """
+        with self._lock:
+            self._tokens = 0
+            self._paused_until = max(self._paused_until,
+                    self._clock() + seconds)
+            self._last_refill = self._paused_until
+
+    def _refill(self):
+        now = self._clock()
+        if now <= self._last_refill:
+            # Still paused
+            return
+        self._tokens = min(self.capacity, self._tokens +
+                (now - self._last_refill) * self.refill_per_second)
+        self._last_refill = now
+
+
+class RateLimiter(object):
+    """Hands out permission to send requests, bulk requests getting last dibs.
+    """
+    def __init__(self, bucket, bulk_reserve, share_across_instances=False,
+            clock=time.time, sleep=time.sleep):
+        self.bucket = bucket
+        self.bulk_reserve = bulk_reserve
+        self.share_across_instances = share_across_instances
+        self._clock = clock
+        self._sleep = sleep
+
+    def acquire(self, priority):
+        """Block until a request of the given priority may be sent."""
+        reserve = self.bulk_reserve if priority == BULK else 0
+        start = self._clock()
+
+        while True:
+            wait_seconds = self.bucket.try_acquire(reserve)
+            if not wait_seconds and self.share_across_instances:
+                wait_seconds = self._try_acquire_shared(reserve)
+
+            if not wait_seconds:
+                break
+
+            waited_seconds = self._clock() - start
+            if waited_seconds >= MAX_WAIT_SECONDS:
+                logging.warning("Gave up waiting for Trello rate limit budget "
+                        "after %.1fs" % waited_seconds)
+                break
+
+            perf_stats.incr("rate_limit.%s.waits" % priority)
+            self._sleep(min(wait_seconds, MAX_WAIT_SECONDS - waited_seconds))
+
+        perf_stats.set_gauge("rate_limit.budget", self.bucket.available)
+
+    def back_off(self, attempt, retry_after_seconds=None):
+        """Pause all requests after Trello told us we're over its limit."""
+        perf_stats.incr("rate_limit.429s")
+        seconds = get_backoff_seconds(attempt, retry_after_seconds)
+        logging.warning("Trello rate limit hit, backing off for %.1fs" %
+                seconds)
+        self.bucket.pause(seconds)
+
+    def _try_acquire_shared(self, reserve):
+        """Count a request against the current window's budget in memcache.
+
+        Returns 0 if it fits, or else the number of seconds until the next
+        window starts.
+        """
+        now = self._clock()
+        window = int(now // WINDOW_SECONDS)
+        key = "trello-rate-limit:%s" % window
+
+        memcache.add(key, 0, time=WINDOW_SECONDS * 2)
+        count = memcache.incr(key)
+        if count is None or count <= REQUESTS_PER_WINDOW - reserve:
+            # If memcache is unavailable, fall back to the local bucket alone
+            return 0
+
+        return (window + 1) * WINDOW_SECONDS - now
+
+
+def get_backoff_seconds(attempt, retry_after_seconds=None):
+    """Return how long to wait before retry number attempt (starting at 0).
+
+    Honors Trello's Retry-After if it sent one, and adds jitter so that
+    threads that got 429'd together don't all retry together.
+    """
+    backoff = BACKOFF_BASE_SECONDS * (2 ** attempt)
+    if retry_after_seconds is not None:
+        backoff = max(backoff, retry_after_seconds)
+    return backoff + random.uniform(0, BACKOFF_BASE_SECONDS)
+
+
+def get_retry_after_seconds(response):
+    """Return (is_rate_limited, Retry-After seconds or None) for a response.
+
+    response is the httplib2 response to a failed Trello request (see
+    trello_util.TrelloConnectionPool), or None if we never got one.
+    """
+    if response is None or response.status != 429:
+        return (False, None)
+
+    # httplib2 lowercases header names
+    retry_after = response.get("retry-after")
+    try:
+        return (True, float(retry_after))
+    except (TypeError, ValueError):
+        return (True, None)
+
+
+_limiter = RateLimiter(
+        TokenBucket(REQUESTS_PER_WINDOW,
+            float(REQUESTS_PER_WINDOW) / WINDOW_SECONDS),
+        BULK_RESERVE, share_across_instances=SHARE_ACROSS_INSTANCES)
+
+
+def get_limiter():
+    """Return the process-wide Trello RateLimiter."""
+    return _limiter
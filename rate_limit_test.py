@@ -0,0 +1,103 @@
+"""Unit tests for staying under Trello's API rate limit."""
+
+import httplib2
+import mock
+import unittest
+
+import rate_limit
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = rate_limit.TokenBucket(10, 1.0, clock=self.clock)
+
+    def test_bucket_refills_over_time(self):
+        for _ in range(10):
+            self.assertEqual(0, self.bucket.try_acquire())
+        self.assertEqual(1.0, self.bucket.try_acquire())
+
+        self.clock.sleep(2)
+        self.assertEqual(2, self.bucket.available)
+
+    def test_reserve_is_left_behind(self):
+        for _ in range(7):
+            self.assertEqual(0, self.bucket.try_acquire(reserve=3))
+        self.assertEqual(1.0, self.bucket.try_acquire(reserve=3))
+
+        # ...but can still be used by anybody not leaving a reserve
+        self.assertEqual(0, self.bucket.try_acquire())
+
+    def test_pause(self):
+        self.bucket.pause(5)
+        self.assertEqual(5, self.bucket.try_acquire())
+        self.assertEqual(0, self.bucket.available)
+
+        # Refilling starts from empty once the pause is over, rather than
+        # crediting the whole pause at once
+        self.clock.sleep(5)
+        self.assertEqual(0, self.bucket.available)
+        self.assertEqual(1, self.bucket.try_acquire())
+        self.clock.sleep(1)
+        self.assertEqual(0, self.bucket.try_acquire())
+        self.assertEqual(0, self.bucket.available)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = rate_limit.RateLimiter(
+                rate_limit.TokenBucket(10, 1.0, clock=self.clock), 5,
+                clock=self.clock, sleep=self.clock.sleep)
+
+    def test_bulk_work_waits_before_interactive_work(self):
+        for _ in range(5):
+            self.limiter.acquire(rate_limit.BULK)
+        self.assertEqual(1000.0, self.clock.now)
+
+        # Bulk work now has to wait for the bucket to refill past the
+        # reserve, while interactive work can go ahead right away
+        for _ in range(5):
+            self.limiter.acquire(rate_limit.INTERACTIVE)
+        self.assertEqual(1000.0, self.clock.now)
+
+        self.limiter.acquire(rate_limit.BULK)
+        self.assertEqual(1006.0, self.clock.now)
+
+    def test_back_off_pauses_requests(self):
+        with mock.patch('random.uniform', return_value=0):
+            self.limiter.back_off(0, retry_after_seconds=4)
+        self.limiter.acquire(rate_limit.INTERACTIVE)
+
+        # 4s of backoff, then 1s to refill a token
+        self.assertEqual(1005.0, self.clock.now)
+
+    def test_get_backoff_seconds(self):
+        with mock.patch('random.uniform', return_value=0):
+            self.assertEqual(1, rate_limit.get_backoff_seconds(0))
+            self.assertEqual(8, rate_limit.get_backoff_seconds(3))
+            self.assertEqual(10, rate_limit.get_backoff_seconds(0, 10))
+
+    def test_get_retry_after_seconds(self):
+        self.assertEqual((False, None),
+                rate_limit.get_retry_after_seconds(None))
+        self.assertEqual((False, None), rate_limit.get_retry_after_seconds(
+                httplib2.Response({"status": "400"})))
+
+        self.assertEqual((True, 7.0), rate_limit.get_retry_after_seconds(
+                httplib2.Response({"status": "429", "retry-after": "7"})))
+        self.assertEqual((True, None), rate_limit.get_retry_after_seconds(
+                httplib2.Response({"status": "429"})))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Refresh the Google API discovery docs bundled w/ the app.
+
+google_auth.py builds our Drive and Directory services from the discovery
+docs in discovery_docs/ rather than downloading 'em on every cold start. Run
+this from the repo root whenever we start using a new API (add it to
+BUNDLED_APIS) or want newer copies:
+
+    python refresh_discovery_docs.py
+
+After saving each doc, this also times building its service by downloading
+the doc (what googleapiclient.discovery.build does) vs. from the bundled
+copy, so we can keep an eye on how much startup time the bundling saves.
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'third_party'))
+
+import googleapiclient.discovery
+import httplib2
+import uritemplate
+
+import google_auth
+
+# (api name, version) of every Google API we build services for
+BUNDLED_APIS = [
+    ("drive", "v2"),
+    ("admin", "directory_v1"),
+]
+
+
+def refresh_discovery_doc(api_name, version):
+    """Download an API's discovery doc and save it to discovery_docs/."""
+    url = uritemplate.expand(googleapiclient.discovery.DISCOVERY_URI,
+            {"api": api_name, "apiVersion": version})
+    response, content = httplib2.Http().request(url)
+    if response.status != 200:
+        raise Exception("Couldn't download discovery doc for %s %s: %s" %
+                (api_name, version, response.status))
+
+    path = google_auth.get_discovery_doc_path(api_name, version)
+    with open(path, "w") as f:
+        json.dump(json.loads(content), f, indent=1, sort_keys=True)
+    print "Saved %s (%s bytes)" % (path, os.path.getsize(path))
+
+
+def time_builds(api_name, version):
+    """Print how long building the API's service takes both ways."""
+    start = time.time()
+    googleapiclient.discovery.build(api_name, version, http=httplib2.Http())
+    downloaded_ms = (time.time() - start) * 1000
+
+    start = time.time()
+    with open(google_auth.get_discovery_doc_path(api_name, version)) as f:
+        googleapiclient.discovery.build_from_document(json.load(f),
+                http=httplib2.Http())
+    bundled_ms = (time.time() - start) * 1000
+
+    print "%s %s: %.0fms downloaded, %.0fms bundled" % (api_name, version,
+            downloaded_ms, bundled_ms)
+
+
+def main():
+    if not os.path.isdir(google_auth.DISCOVERY_DOCS_DIR):
+        os.makedirs(google_auth.DISCOVERY_DOCS_DIR)
+
+    for api_name, version in BUNDLED_APIS:
+        refresh_discovery_doc(api_name, version)
+        time_builds(api_name, version)
+
+
+if __name__ == '__main__':
+    main()
@@ -60,7 +60,8 @@ def send_retro_reminder_for_card(card_id):
     prioritizing PMs) and makes sure a retro doc doesn't already exist on the
     card first.
     """
-    card = trello_util.get_card_by_id(card_id)
+    # Grab the card and its members' names in a single round-trip
+    card, full_names = trello_util.get_card_with_member_names(card_id)
     if not card:
         logging.warning("Not sending retro reminder, couldn't find card: %s" %
                 card_id)
@@ -70,8 +71,6 @@ def send_retro_reminder_for_card(card_id):
         logging.warning("Not sending retro reminder, retro already exists.")
         return False
 
-    # TODO(kamens): prefetch members
-    full_names = map(lambda m: m.fullname, card.members)
     if not full_names:
         logging.warning("Not sending retro reminder, couldn't find member " +
                 "names for card id: %s" % card_id)
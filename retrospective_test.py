@@ -7,6 +7,7 @@ from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import urlfetch_stub
 from google.appengine.ext import testbed
 
+import doc_html_cache
 import google_drive
 import retrospective
 import trello_util
@@ -39,8 +40,13 @@ class RetrospectiveEmailTest(unittest.TestCase):
         self.testbed.init_mail_stub()
         self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
 
+        # Exported doc html is cached in memcache
+        self.testbed.init_memcache_stub()
+        doc_html_cache.clear()
+
     def tearDown(self):
         self.mock_patch.stop()
+        doc_html_cache.clear()
         self.testbed.deactivate()
 
     def test_manipulating_links_in_trello_desc(self):
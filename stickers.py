@@ -11,27 +11,87 @@ sequence of green, purple, red, yellow, or white stickers, respectively).
 import logging
 import random
 import re
+import sys
+
+from third_party import trollop
 
 import custom_stickers
+import perf_stats
+import thread_pool
 import trello_util
 
+# Max number of sticker pastes/removals sent to Trello at once for one card
+MAX_STICKER_WORKERS = 6
+
+# Max number of cards sync'd at once during board-wide syncs. Each of these may
+# use up to MAX_STICKER_WORKERS threads of its own.
+MAX_CARD_WORKERS = 4
+
 
 def update(client, card):
-    """Update all stickers on card to match card's description."""
+    """Update stickers on card to match card's description.
+
+    Only the stickers that are wrong or out of place get removed and re-pasted
+    (see get_sticker_edits), so e.g. going from ||GGGY|| to ||GGGG|| costs one
+    removal and one paste rather than four of each.
+
+    Removals and pastes are each sent to Trello concurrently, but all
+    removals finish before any pastes start. Stickers are laid out by the
+    position and z-index we give 'em, not by the order they're pasted in.
+    """
     custom_stickers.CustomStickers.populate_trello_properties(client)
-    if needs_update(card):
-        logging.info("Updating stickers for: '%s'" % card.name)
-        remove_all(client, card)
-        sticker_post_data = create_sticker_post_data(client, card)
-        add(client, card, sticker_post_data)
-    else:
+
+    current_stickers = get_ordered_stickers(card)
+    current_sticker_string = _get_sticker_string_from_sticker_list(
+            current_stickers)
+    desired_sticker_string = get_sticker_string_from_desc(card)
+
+    if current_sticker_string == desired_sticker_string:
         logging.info("Skipping sticker update for: '%s'" % card.name)
+        return
+
+    logging.info("Updating stickers for: '%s'" % card.name)
+    remove_indexes, paste_indexes = get_sticker_edits(current_sticker_string,
+            desired_sticker_string)
+    sticker_post_data = create_sticker_post_data(client, card) or []
+
+    remove(client, card, [current_stickers[i] for i in remove_indexes])
+    add(client, card, [sticker_post_data[i] for i in paste_indexes])
 
+    perf_stats.incr("stickers.kept",
+            len(current_stickers) - len(remove_indexes))
+    perf_stats.incr("stickers.removed", len(remove_indexes))
+    perf_stats.incr("stickers.pasted", len(paste_indexes))
 
-def needs_update(card):
-    """Return True if card's stickers do not match card's description."""
-    return (get_sticker_string_from_desc(card) !=
-            get_sticker_string_from_stickers(card))
+
+def get_sticker_edits(current_sticker_string, desired_sticker_string):
+    """Return the minimal edits that turn one sticker string into another.
+
+    Every sticker's position on the card is determined by its index in the
+    sticker string and by the string's length (see _get_sticker_offset), so
+    a sticker can only be kept if it's the right color *and* would be pasted
+    in the exact same spot.
+
+    Returns tuple of (indexes of current stickers to remove, indexes of
+    desired stickers to paste).
+    """
+    same_layout = (_get_sticker_offset(len(current_sticker_string)) ==
+            _get_sticker_offset(len(desired_sticker_string)))
+
+    kept_indexes = set()
+    for i in range(min(len(current_sticker_string),
+            len(desired_sticker_string))):
+        # The first sticker is always in the same spot regardless of layout
+        in_place = same_layout or i == 0
+        if in_place and (current_sticker_string[i].upper() ==
+                desired_sticker_string[i].upper()):
+            kept_indexes.add(i)
+
+    remove_indexes = [i for i in range(len(current_sticker_string))
+            if i not in kept_indexes]
+    paste_indexes = [i for i in range(len(desired_sticker_string))
+            if i not in kept_indexes]
+    return (remove_indexes, paste_indexes)
 
 
 def add(client, card, sticker_post_data):
@@ -39,14 +99,50 @@ def add(client, card, sticker_post_data):
 
     sticker_post_data: list of POST data objects created by
         create_sticker_post_data."""
-    for sticker_post in sticker_post_data:
-        card.paste_sticker(**sticker_post)
-
-
-def remove_all(client, card):
-    """Remove all stickers from card."""
-    for sticker in card.stickers:
-        card.remove_sticker(sticker)
+    try:
+        thread_pool.map_in_parallel(
+                lambda sticker_post: card.paste_sticker(**sticker_post),
+                sticker_post_data, _get_max_sticker_workers(client))
+    except trollop.TrelloError:
+        # Trello rejected a paste. If that's because our cached custom sticker
+        # ids are stale (e.g. the stickers were re-uploaded), make sure
+        # they're refetched on retry. Timeouts and the like never get here.
+        exc_info = sys.exc_info()
+        try:
+            custom_stickers.CustomStickers.invalidate_if_stale(client)
+        except Exception:
+            logging.exception("Unable to check for stale custom sticker ids")
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def remove(client, card, stickers):
+    """Remove the given stickers from card."""
+    thread_pool.map_in_parallel(card.remove_sticker, stickers,
+            _get_max_sticker_workers(client))
+
+
+def _get_max_sticker_workers(client):
+    """Return how many of card's sticker edits may be sent to Trello at once.
+
+    A plain trollop client sends every request over one httplib2.Http, which
+    isn't thread-safe, so only clients that check out a connection per
+    request (see trello_util.TrelloConnectionPool) are used concurrently.
+    """
+    if isinstance(client, trello_util.PooledTrelloConnection):
+        return MAX_STICKER_WORKERS
+    return 1
+
+
+def get_ordered_stickers(card):
+    """Return card's stickers in the order they appear in the sticker string.
+
+    We paste each sticker w/ its index in the sticker string as its z-index
+    (see create_sticker_post_data), so that's what we order by. Trello itself
+    returns stickers in the order they were pasted, which no longer matches
+    once individual stickers are replaced.
+    """
+    return sorted(card.stickers,
+            key=lambda sticker: getattr(sticker, "zIndex", 0))
 
 
 def get_sticker_string_from_stickers(card):
@@ -54,8 +150,12 @@ def get_sticker_string_from_stickers(card):
 
     This is used to compare to the ||GPGWW||-formatted string in the card's
     description in order to figure out if the card's stickers need updating."""
+    return _get_sticker_string_from_sticker_list(get_ordered_stickers(card))
+
+
+def _get_sticker_string_from_sticker_list(stickers):
     s = ""
-    for sticker in card.stickers:
+    for sticker in stickers:
         custom_sticker = custom_stickers.CustomStickers.from_trello_image_url(
                 sticker.imageUrl)
         s += custom_sticker.shortname
@@ -64,8 +164,16 @@ def get_sticker_string_from_stickers(card):
 
 def get_sticker_string_from_desc(card):
     """Pull the ||GPGWW||-formatted string out of card's description."""
+    return get_sticker_string(card.desc)
+
+
+def get_sticker_string(desc):
+    """Pull the ||GPGWW||-formatted string out of a description string."""
+    if not desc:
+        return ""
+
     sticker_string_match = re.search("\|\|([GPRWY]+)\|\|",
-            card.desc, re.M | re.I)
+            desc, re.M | re.I)
     if not sticker_string_match:
         # No big board sticker data on the card
         return ""
@@ -85,17 +193,9 @@ def create_sticker_post_data(client, card):
     sticker_post_data = []
     margin_left = 1
     margin_top = 5
-    offset = 18
+    offset = _get_sticker_offset(len(sticker_string))
     count = 0
 
-    # Hacky little fix for cards w/ lots of stickers.
-    # TODO(kamens): actually measure Trello's x position limit and
-    # calculate correct offset per card depending on # of stickers
-    if len(sticker_string) > 10:
-        offset = 6
-    elif len(sticker_string) > 6:
-        offset = 10
-
     for sticker_letter in sticker_string.upper():
         custom_sticker = custom_stickers.CustomStickers.from_shortname(
                 sticker_letter)
@@ -108,16 +208,20 @@ def create_sticker_post_data(client, card):
     return sticker_post_data
 
 
+def _get_sticker_offset(sticker_count):
+    """Return horizontal distance between stickers on a card w/ this many."""
+    # Hacky little fix for cards w/ lots of stickers.
+    # TODO(kamens): actually measure Trello's x position limit and
+    # calculate correct offset per card depending on # of stickers
+    if sticker_count > 10:
+        return 6
+    elif sticker_count > 6:
+        return 10
+    return 18
+
+
 def sync_card_stickers(card_id):
     """Sync Trello card stickers w/ ||GPW||-formatted string in description."""
     client = trello_util.get_client()
     card = client.get_card(card_id)
     update(client, card)
-
-
-def sync_big_board_stickers():
-    """Sync all Trello stickers on big board."""
-    client = trello_util.get_client()
-    big_board = trello_util.get_big_board()
-    for card in big_board.cards:
-        update(client, card)
@@ -0,0 +1,174 @@
+"""Unit tests for sync'ing Trello card stickers w/ card descriptions."""
+
+import mock
+import threading
+import unittest
+
+from third_party import trollop
+
+import stickers
+import trello_util
+
+# Max time a simulated sticker edit waits for another one to overlap it
+OVERLAP_TIMEOUT_SECONDS = 5
+
+
+def _sticker(filename, z_index):
+    return mock.Mock(imageUrl="https://trello.com/stickers/%s" % filename,
+            zIndex=z_index)
+
+
+class StickerEditsTest(unittest.TestCase):
+
+    def test_single_changed_sticker(self):
+        self.assertEqual(([11], [11]),
+                stickers.get_sticker_edits("GGGGGGGGGGGY", "GGGGGGGGGGGG"))
+
+    def test_no_changes(self):
+        self.assertEqual(([], []), stickers.get_sticker_edits("GPW", "GPW"))
+
+    def test_adding_and_removing_stickers(self):
+        self.assertEqual(([], [3]), stickers.get_sticker_edits("GPW", "GPWW"))
+        self.assertEqual(([2], []), stickers.get_sticker_edits("GPW", "GP"))
+        self.assertEqual(([0, 1], []), stickers.get_sticker_edits("GP", ""))
+        self.assertEqual(([], [0, 1]), stickers.get_sticker_edits("", "GP"))
+
+    def test_layout_changes_move_all_but_first_sticker(self):
+        # Going from 6 to 7 stickers squishes 'em closer together
+        self.assertEqual(([1, 2, 3, 4, 5], [1, 2, 3, 4, 5, 6]),
+                stickers.get_sticker_edits("GGGGGG", "GGGGGGG"))
+
+
+class UpdateStickersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_patch = mock.patch(
+                'custom_stickers.CustomStickers.populate_trello_properties')
+        self.mock_patch.start()
+
+    def tearDown(self):
+        self.mock_patch.stop()
+
+    def test_update_only_touches_changed_stickers(self):
+        # Stickers come back from Trello in paste order, not z-index order
+        yellow = _sticker("yellow.png", 2)
+        card = mock.Mock(desc="Hi ||GPG||", stickers=[
+                _sticker("green.png", 0), yellow, _sticker("purple.png", 1)])
+
+        self.assertEqual("GPY",
+                stickers.get_sticker_string_from_stickers(card))
+
+        stickers.update(None, card)
+
+        card.remove_sticker.assert_called_once_with(yellow)
+        self.assertEqual(1, card.paste_sticker.call_count)
+        position = card.paste_sticker.call_args[1]["position"]
+        self.assertEqual(2, position[2])
+
+    def test_update_removes_stickers_missing_from_desc(self):
+        card = mock.Mock(desc="No stickers", stickers=[
+                _sticker("green.png", 0), _sticker("purple.png", 1)])
+
+        stickers.update(None, card)
+
+        self.assertEqual(2, card.remove_sticker.call_count)
+        self.assertFalse(card.paste_sticker.called)
+
+    @mock.patch('custom_stickers.CustomStickers.invalidate_if_stale')
+    def test_rejected_pastes_check_for_stale_sticker_ids(self,
+            invalidate_if_stale):
+        client = mock.Mock()
+        card = mock.Mock()
+        card.paste_sticker.side_effect = trollop.TrelloError("invalid value")
+
+        with self.assertRaises(trollop.TrelloError):
+            stickers.add(client, card, [{"name": "id-G"}])
+        invalidate_if_stale.assert_called_once_with(client)
+
+        # Failures that aren't Trello rejecting the paste, like timeouts,
+        # don't say anything about our sticker ids
+        invalidate_if_stale.reset_mock()
+        card.paste_sticker.side_effect = IOError("timed out")
+        with self.assertRaises(IOError):
+            stickers.add(client, card, [{"name": "id-G"}])
+        self.assertFalse(invalidate_if_stale.called)
+
+    def test_only_pooled_clients_edit_stickers_concurrently(self):
+        self.assertEqual(1, stickers._get_max_sticker_workers(mock.Mock()))
+        self.assertEqual(stickers.MAX_STICKER_WORKERS,
+                stickers._get_max_sticker_workers(
+                    mock.Mock(spec=trello_util.PooledTrelloConnection)))
+
+
+class OverlapCountingCard(object):
+    """Stand-in for a trollop card that counts overlapping sticker edits.
+
+    If wait_for_overlap is set, each edit waits (up to OVERLAP_TIMEOUT_SECONDS)
+    until two edits have been seen in flight at once, so overlap doesn't
+    depend on how the threads happen to get scheduled.
+    """
+    def __init__(self, desc, stickers, wait_for_overlap=False):
+        self.name = "Slow card"
+        self.desc = desc
+        self.stickers = stickers
+        self.wait_for_overlap = wait_for_overlap
+        self.lock = threading.Lock()
+        self.overlapped = threading.Event()
+        self.request_count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _fake_request(self):
+        with self.lock:
+            self.request_count += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            if self.in_flight > 1:
+                self.overlapped.set()
+
+        if self.wait_for_overlap:
+            self.overlapped.wait(OVERLAP_TIMEOUT_SECONDS)
+
+        with self.lock:
+            self.in_flight -= 1
+
+    def paste_sticker(self, name, position, rotate):
+        self._fake_request()
+
+    def remove_sticker(self, sticker):
+        self._fake_request()
+
+
+class StickerConcurrencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_patch = mock.patch(
+                'custom_stickers.CustomStickers.populate_trello_properties')
+        self.mock_patch.start()
+
+    def tearDown(self):
+        self.mock_patch.stop()
+
+    def _full_resync(self, max_workers, wait_for_overlap=False):
+        """Replace 12 yellow stickers w/ 12 green ones, returning the card."""
+        card = OverlapCountingCard("||GGGGGGGGGGGG||",
+                [_sticker("yellow.png", i) for i in range(12)],
+                wait_for_overlap=wait_for_overlap)
+
+        # Only pooled clients are safe to send concurrent requests through
+        client = mock.Mock(spec=trello_util.PooledTrelloConnection)
+
+        with mock.patch('stickers.MAX_STICKER_WORKERS', max_workers):
+            stickers.update(client, card)
+
+        self.assertEqual(24, card.request_count)
+        return card
+
+    def test_serial_sync_never_overlaps(self):
+        card = self._full_resync(1)
+        self.assertEqual(1, card.max_in_flight)
+
+    def test_concurrent_sync_overlaps_requests(self):
+        card = self._full_resync(6, wait_for_overlap=True)
+        self.assertGreater(card.max_in_flight, 1)
+        self.assertLessEqual(card.max_in_flight, 6)
@@ -0,0 +1,82 @@
+"""Tiny bounded thread pool for running independent API calls at once.
+
+Most of our time is spent waiting on Trello and Google round-trips, and App
+Engine's python27 runtime (w/ threadsafe: true in app.yaml) lets a request run
+its own threads as long as they finish before the request does. map_in_parallel
+starts a handful of short-lived threads, waits for all of 'em, and hands back
+results in order.
+"""
+import Queue
+import sys
+import threading
+import time
+
+# Outcomes of calls made by call_in_parallel
+DONE = "done"
+FAILED = "failed"
+
+
+def map_in_parallel(func, items, max_workers):
+    """Call func on each item using at most max_workers threads at once.
+
+    Returns list of results in the same order as items. If any call raises,
+    all remaining calls still run and then the first exception (in item
+    order) is re-raised.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    exc_infos = [None] * len(items)
+
+    pending_indexes = Queue.Queue()
+    for i in range(len(items)):
+        pending_indexes.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = pending_indexes.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results[i] = func(items[i])
+            except Exception:
+                exc_infos[i] = sys.exc_info()
+
+    threads = [threading.Thread(target=worker)
+            for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for exc_info in exc_infos:
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    return results
+
+
+def call_in_parallel(funcs, max_workers):
+    """Call each of funcs (w/o args) using at most max_workers threads at once.
+
+    Unlike map_in_parallel, a call that raises doesn't fail the rest: every
+    call's outcome is handed back on its own. Like map_in_parallel, this
+    waits for every call to finish, since App Engine doesn't let threads
+    outlive the request that started 'em.
+
+    Returns list of (outcome, value, seconds) tuples in the same order as
+    funcs, where outcome is DONE (value is the result) or FAILED (value is
+    the exception's sys.exc_info()), and seconds is how long the call took.
+    """
+    def call(func):
+        start = time.time()
+        try:
+            return (DONE, func(), time.time() - start)
+        except Exception:
+            return (FAILED, sys.exc_info(), time.time() - start)
+
+    return map_in_parallel(call, funcs, max_workers)
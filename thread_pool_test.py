@@ -0,0 +1,76 @@
+"""Unit tests for our tiny bounded thread pool."""
+
+import threading
+import time
+import unittest
+
+import thread_pool
+
+
+class MapInParallelTest(unittest.TestCase):
+
+    def test_results_are_in_order(self):
+        self.assertEqual([1, 4, 9, 16],
+                thread_pool.map_in_parallel(lambda x: x * x, [1, 2, 3, 4], 3))
+        self.assertEqual([], thread_pool.map_in_parallel(lambda x: x, [], 3))
+
+    def test_worker_count_is_bounded(self):
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+
+        def slow(x):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        thread_pool.map_in_parallel(slow, range(20), 4)
+        self.assertEqual(4, max_running[0])
+
+    def test_errors_are_raised_after_all_calls_finish(self):
+        called = []
+
+        def maybe_fail(x):
+            called.append(x)
+            if x == 2:
+                raise ValueError("two")
+            return x
+
+        with self.assertRaises(ValueError):
+            thread_pool.map_in_parallel(maybe_fail, [1, 2, 3, 4], 2)
+        self.assertEqual([1, 2, 3, 4], sorted(called))
+
+
+class CallInParallelTest(unittest.TestCase):
+
+    def test_outcomes(self):
+        def fail():
+            raise ValueError("nope")
+
+        outcomes = thread_pool.call_in_parallel([lambda: 1, fail], 2)
+
+        self.assertEqual((thread_pool.DONE, 1), outcomes[0][:2])
+        self.assertEqual(thread_pool.FAILED, outcomes[1][0])
+        self.assertIsInstance(outcomes[1][1][1], ValueError)
+
+    def test_calls_are_timed(self):
+        outcomes = thread_pool.call_in_parallel(
+                [lambda: None, lambda: time.sleep(0.05)], 2)
+        self.assertGreaterEqual(outcomes[1][2], 0.05)
+
+    def test_calls_run_concurrently(self):
+        # Each call waits for the other, which only works if they run at once
+        both_started = threading.Event()
+        started = []
+
+        def call():
+            started.append(True)
+            if len(started) == 2:
+                both_started.set()
+            return both_started.wait(5)
+
+        outcomes = thread_pool.call_in_parallel([call, call], 2)
+        self.assertEqual([True, True], [value for _, value, _ in outcomes])
@@ -0,0 +1,117 @@
+"""In-process read-through cache for Trello objects we read over and over.
+
+Things like the proposals board's lists hardly ever change, and a single
+webhook can have a couple handlers reading the same card. Rather than
+refetching 'em from Trello every time, reads go through get_or_fetch(), which
+keeps each object around for a per-kind TTL (see TTL_SECONDS).
+
+The webhook dispatcher (webhooks.trigger_update_handlers) invalidates a card
+as soon as a Trello action touches it, and so do our own writes through
+trello_util.CardSnapshot. A board's lists are invalidated as soon as a
+webhook for a list action on the board comes in (see
+webhooks.invalidate_changed_lists). This cache is per-instance, though, so
+the TTLs still bound how stale an entry can get when the webhook for a
+change was processed by some other instance. Anything that writes based on
+what it reads, like sticker syncs, should keep reading straight from Trello.
+"""
+import collections
+import threading
+import time
+
+import perf_stats
+
+# How long each kind of cached Trello object is kept, in seconds
+TTL_SECONDS = {
+    # Board lists, keyed by board id
+    "lists": 10 * 60,
+    # Card snapshots along w/ their members' full names, keyed by card id
+    "card_members": 60,
+}
+
+# Max number of entries kept in the cache. The least recently used entry is
+# dropped to make room for a new one.
+MAX_ENTRIES = 500
+
+
+class TTLCache(object):
+    """Thread-safe, size-bounded LRU cache whose entries expire per kind.
+
+    Entries are keyed by (kind, Trello object id) so that invalidate() can
+    drop everything cached about a single object.
+    """
+    def __init__(self, ttl_seconds, max_entries, clock=time.time):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.clock = clock
+        self._lock = threading.Lock()
+        # (kind, object id) => (expiration time, value), oldest first
+        self._entries = collections.OrderedDict()
+
+    def get(self, kind, object_id):
+        """Return tuple of (found, value) for the cached object."""
+        with self._lock:
+            entry = self._entries.pop((kind, object_id), None)
+            if not entry:
+                return (False, None)
+
+            expires, value = entry
+            if expires <= self.clock():
+                perf_stats.incr("trello_cache.%s.expired" % kind)
+                return (False, None)
+
+            # Move to the back of the line for LRU eviction
+            self._entries[(kind, object_id)] = entry
+            return (True, value)
+
+    def set(self, kind, object_id, value):
+        expires = self.clock() + self.ttl_seconds[kind]
+        with self._lock:
+            self._entries.pop((kind, object_id), None)
+            self._entries[(kind, object_id)] = (expires, value)
+
+            while len(self._entries) > self.max_entries:
+                (evicted_kind, _), _ = self._entries.popitem(last=False)
+                perf_stats.incr("trello_cache.%s.evictions" % evicted_kind)
+
+    def invalidate(self, object_id):
+        """Drop every kind of entry cached for the Trello object."""
+        with self._lock:
+            for kind in self.ttl_seconds:
+                if self._entries.pop((kind, object_id), None):
+                    perf_stats.incr("trello_cache.%s.invalidations" % kind)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache = TTLCache(TTL_SECONDS, MAX_ENTRIES)
+
+
+def get_or_fetch(kind, object_id, fetch):
+    """Return the cached object, or call fetch() and cache what it returns.
+
+    Exceptions raised by fetch() aren't cached.
+    """
+    found, value = _cache.get(kind, object_id)
+    if found:
+        perf_stats.incr("trello_cache.%s.hits" % kind)
+        return value
+
+    perf_stats.incr("trello_cache.%s.misses" % kind)
+    value = fetch()
+    _cache.set(kind, object_id, value)
+    return value
+
+
+def invalidate(object_id):
+    """Drop everything cached about the Trello object w/ this id."""
+    _cache.invalidate(object_id)
+
+
+def clear():
+    """Drop everything, e.g. between unit tests."""
+    _cache.clear()
@@ -0,0 +1,123 @@
+"""Unit tests for the in-process cache of Trello objects."""
+
+import mock
+import unittest
+
+import perf_stats
+import trello_cache
+import trello_util
+import webhook_queue
+import webhooks
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = trello_cache.TTLCache({"lists": 60, "card_members": 10},
+                3, clock=self.clock)
+        perf_stats.reset()
+
+    def test_entries_expire_per_kind(self):
+        self.cache.set("lists", "board1", ["list1"])
+        self.cache.set("card_members", "card1", "card")
+
+        self.clock.now += 30
+        self.assertEqual((True, ["list1"]), self.cache.get("lists", "board1"))
+        self.assertEqual((False, None),
+                self.cache.get("card_members", "card1"))
+        self.assertEqual(1,
+                perf_stats.get("trello_cache.card_members.expired"))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        for card_id in ["card1", "card2", "card3"]:
+            self.cache.set("card_members", card_id, card_id)
+
+        # Reading card1 makes card2 the least recently used
+        self.cache.get("card_members", "card1")
+        self.cache.set("card_members", "card4", "card4")
+
+        self.assertEqual(3, len(self.cache))
+        self.assertEqual((False, None),
+                self.cache.get("card_members", "card2"))
+        self.assertEqual((True, "card1"),
+                self.cache.get("card_members", "card1"))
+        self.assertEqual(1,
+                perf_stats.get("trello_cache.card_members.evictions"))
+
+    def test_invalidate_drops_every_kind(self):
+        self.cache.set("lists", "id1", "lists")
+        self.cache.set("card_members", "id1", "card")
+        self.cache.set("card_members", "id2", "other card")
+
+        self.cache.invalidate("id1")
+
+        self.assertEqual((False, None), self.cache.get("lists", "id1"))
+        self.assertEqual((False, None), self.cache.get("card_members", "id1"))
+        self.assertEqual((True, "other card"),
+                self.cache.get("card_members", "id2"))
+
+
+class ReadThroughTest(unittest.TestCase):
+
+    def setUp(self):
+        trello_cache.clear()
+        perf_stats.reset()
+
+    def tearDown(self):
+        trello_cache.clear()
+
+    def test_get_or_fetch(self):
+        fetch = mock.Mock(return_value="card")
+        self.assertEqual("card",
+                trello_cache.get_or_fetch("card_members", "card1", fetch))
+        self.assertEqual("card",
+                trello_cache.get_or_fetch("card_members", "card1", fetch))
+
+        self.assertEqual(1, fetch.call_count)
+        self.assertEqual(1, perf_stats.get("trello_cache.card_members.hits"))
+        self.assertEqual(1,
+                perf_stats.get("trello_cache.card_members.misses"))
+
+    def test_errors_are_not_cached(self):
+        fetch = mock.Mock(side_effect=[IOError(), "card"])
+        with self.assertRaises(IOError):
+            trello_cache.get_or_fetch("card_members", "card1", fetch)
+        self.assertEqual("card",
+                trello_cache.get_or_fetch("card_members", "card1", fetch))
+
+    @mock.patch('trello_util.get_bot_member_id', return_value="bot")
+    def test_webhooks_invalidate_cards_they_touch(self, get_bot_member_id):
+        fetch = mock.Mock(return_value="card")
+        trello_cache.get_or_fetch("card_members", "card1", fetch)
+        trello_cache.get_or_fetch("card_members", "card2", fetch)
+
+        # Even echoes of our own writes mean our copy is out-of-date
+        webhooks.trigger_update_handlers(webhook_queue.WebhookEvent(
+                "updateCard", "card1", "board1", member_id="bot"))
+
+        trello_cache.get_or_fetch("card_members", "card1", fetch)
+        trello_cache.get_or_fetch("card_members", "card2", fetch)
+        self.assertEqual(3, fetch.call_count)
+
+    def test_card_snapshot_writes_invalidate_card(self):
+        client = mock.Mock()
+        card = trello_util.CardSnapshot(client, {"id": "card1"})
+        trello_cache.get_or_fetch("card_members", "card1",
+                lambda: (card, []))
+
+        card.update_desc("new desc")
+
+        fetch = mock.Mock(return_value=(card, []))
+        trello_cache.get_or_fetch("card_members", "card1", fetch)
+        self.assertEqual(1, fetch.call_count)
+        client.get_card.return_value.update_desc.assert_called_once_with(
+                "new desc")
@@ -1,9 +1,16 @@
 """Trello utils, namely retrieving the big board and the proposals board."""
+import json
+import logging
+import threading
+import urllib
 
-
+from google.appengine.api import memcache
 from third_party import trollop
 
+import perf_stats
+import rate_limit
 import secrets
+import trello_cache
 
 BOARD_NAME_TO_ID = {
     # https://trello.com/b/ddoFIElb/pipeline-2-big-board
@@ -44,16 +51,106 @@ class CustomEmoji(object):
     RETRO_RACCOON = "retroraccoon"
 
 
+# Card fields included in board snapshots (see get_board_snapshots)
+SNAPSHOT_CARD_FIELDS = ['id', 'name', 'desc', 'idMembers']
+
+# Number of cards fetched per request when paging through a board's cards
+# (Trello allows up to 1000)
+CARD_PAGE_SIZE = 300
+
+# Boards that only ever grow, and so are paged through rather than fetched all
+# at once
+ARCHIVE_BOARD_NAMES = ['COMPLETED_BOARD']
+
+# Max number of GETs Trello accepts in a single /batch request
+MAX_BATCH_SIZE = 10
+
+# Max number of idle Trello connections kept open for reuse by each instance
+MAX_IDLE_CONNECTIONS = 10
+
+# Memcache key and in-process copy of the Trello member id we act as
+BOT_MEMBER_ID_CACHE_KEY = "trello-bot-member-id"
+_bot_member_id = None
+
+
+class StickerSnapshot(object):
+    """Lightweight copy of a sticker's data from a board snapshot."""
+    def __init__(self, sticker_json):
+        self._id = sticker_json['id']
+        self.imageUrl = sticker_json.get('imageUrl', '')
+        self.zIndex = sticker_json.get('zIndex', 0)
+
+
+class CardSnapshot(object):
+    """Lightweight copy of the card fields we use, from a board snapshot.
+
+    This quacks enough like a trollop card for stickers.update, and any
+    edits are sent to Trello through a (lazy, unfetched) trollop card.
+    """
+    def __init__(self, client, card_json):
+        self._client = client
+        self._id = card_json['id']
+        self.name = card_json.get('name', '')
+        self.desc = card_json.get('desc', '')
+        self.member_ids = card_json.get('idMembers', [])
+        self.stickers = [StickerSnapshot(s)
+                for s in card_json.get('stickers', [])]
+
+    @property
+    def url(self):
+        return get_url_by_card_id(self._id)
+
+    def paste_sticker(self, *args, **kwargs):
+        trello_cache.invalidate(self._id)
+        return self._client.get_card(self._id).paste_sticker(*args, **kwargs)
+
+    def remove_sticker(self, sticker):
+        trello_cache.invalidate(self._id)
+        return self._client.get_card(self._id).remove_sticker(sticker)
+
+    def update_desc(self, desc):
+        self.desc = desc
+        trello_cache.invalidate(self._id)
+        return self._client.get_card(self._id).update_desc(desc)
+
+    def __repr__(self):
+        return "<CardSnapshot: %s \"%s\">" % (self._id, self.name)
+
+
 def get_board_id_by_name(name):
     return BOARD_NAME_TO_ID.get(name, None)
 
 
+def get_board_by_name(name):
+    board_id = get_board_id_by_name(name)
+    if not board_id:
+        return None
+
+    client = get_client()
+
+    return client.get_board(board_id)
+
+
 def get_big_board():
-    return _get_board_by_name('BIG_BOARD')
+    return get_board_by_name('BIG_BOARD')
 
 
 def get_proposals_board():
-    return _get_board_by_name('PROPOSALS_BOARD')
+    return get_board_by_name('PROPOSALS_BOARD')
+
+
+def get_board_lists(name):
+    """Return the named board's open lists as dicts w/ 'id' and 'name'.
+
+    Lists hardly ever change, so these are cached (see trello_cache.py).
+    """
+    board_id = get_board_id_by_name(name)
+
+    def fetch():
+        return json.loads(get_client().get('/boards/%s/lists' % board_id,
+                {'fields': 'id,name'}))
+
+    return trello_cache.get_or_fetch("lists", board_id, fetch)
 
 
 def get_url_by_card_id(card_id):
@@ -65,31 +162,398 @@ def get_card_by_id(card_id):
     return client.get_card(card_id)
 
 
-def get_card_by_doc_id(doc_id):
-    """Return the card, if it exists, corresponding to this project doc id."""
-    # TODO(marcia): Should we bother about maintaining one connection vs one
-    # connection per board? I dunno how this trollop thing works. Let's go with
-    # this for now.
+def get_board_card_ids(name, client=None):
+    """Return ids of all open cards on the named board in one request."""
+    client = client or get_client()
+    cards = json.loads(client.get('/boards/%s/cards' %
+            get_board_id_by_name(name), {'fields': 'id'}))
+    return [card['id'] for card in cards]
+
 
-    # Go through each board and try to find the doc id in a card's description.
-    for name in BOARD_NAME_TO_ID.keys():
-        board = _get_board_by_name(name)
+def get_board_snapshots(names):
+    """Return dict of board name => snapshot for each named board.
 
-        # TODO(marcia): There is a practical limit to the # of cards on the
-        # big board and proposals board, but not as much to the completed
-        # projects board. Will we run into perf problems later on?
-        for card in board.cards:
-            if doc_id in card.desc:
-                return card
+    Snapshots for up to MAX_BATCH_SIZE boards are fetched in one round-trip.
+    """
+    client = get_client()
+    batch = TrelloBatch(client)
+    requests = dict((name, batch.get(*_get_board_snapshot_request(name)))
+            for name in names)
+    batch.execute()
 
-    return None
+    return dict((name, [CardSnapshot(client, card)
+            for card in request.result()])
+            for name, request in requests.iteritems())
 
 
-def get_client():
-    client = trollop.TrelloConnection(secrets.trello_api_key,
-        secrets.trello_oauth_token)
+def _get_board_snapshot_request(name):
+    return ('/boards/%s/cards' % get_board_id_by_name(name), {
+        'fields': ','.join(SNAPSHOT_CARD_FIELDS),
+        'stickers': 'true',
+    })
 
-    return client
+
+def get_card_with_member_names(card_id):
+    """Return tuple of (CardSnapshot, list of card members' full names).
+
+    The card and its members are fetched in a single round-trip, and cached
+    until the card is touched again (see trello_cache.py). Returns (None, [])
+    if the card can't be found.
+    """
+    try:
+        return trello_cache.get_or_fetch("card_members", card_id,
+                lambda: _fetch_card_with_member_names(card_id))
+    except TrelloBatchError as e:
+        logging.warning("Couldn't load card %s: %s" % (card_id, e))
+        return (None, [])
+
+
+def get_card_snapshot(card_id):
+    """Return a CardSnapshot of the card, fresh from Trello.
+
+    Raises TrelloBatchError w/ Trello's status code if the card couldn't be
+    loaded (e.g. 404 once it's been deleted), or the request's own error if
+    Trello couldn't be reached at all.
+    """
+    client = get_client()
+    batch = TrelloBatch(client)
+    request = batch.get('/cards/%s' % card_id,
+            {'fields': ','.join(SNAPSHOT_CARD_FIELDS)})
+    batch.execute()
+    return CardSnapshot(client, request.result())
+
+
+def _fetch_card_with_member_names(card_id):
+    client = get_client()
+    batch = TrelloBatch(client)
+    card_request = batch.get('/cards/%s' % card_id,
+            {'fields': ','.join(SNAPSHOT_CARD_FIELDS)})
+    members_request = batch.get('/cards/%s/members' % card_id,
+            {'fields': 'fullName'})
+    batch.execute()
+
+    card = CardSnapshot(client, card_request.result())
+    members = members_request.result()
+    return (card, [member['fullName'] for member in members])
+
+
+def iter_board_cards(name, page_size=CARD_PAGE_SIZE, client=None,
+        before=None, since=None, stickers=False):
+    """Yield a CardSnapshot for each open card on the board, newest first.
+
+    Cards are fetched a page at a time using Trello's limit/before params, so
+    only one page is ever held in memory no matter how big the board gets,
+    and callers that stop iterating early skip fetching the rest.
+
+    Arguments:
+        before, since: if given, only cards w/ ids older than before and/or
+            newer than since are fetched
+        stickers: if True, each card's stickers are fetched along w/ it
+    """
+    client = client or get_client()
+    path = '/boards/%s/cards' % get_board_id_by_name(name)
+    params = {
+        'fields': ','.join(SNAPSHOT_CARD_FIELDS),
+        'limit': page_size,
+    }
+    if before:
+        params['before'] = before
+    if since:
+        params['since'] = since
+    if stickers:
+        params['stickers'] = 'true'
+
+    while True:
+        page = json.loads(client.get(path, params))
+        perf_stats.incr("trello.card_pages")
+
+        for card_json in page:
+            yield CardSnapshot(client, card_json)
+
+        if len(page) < page_size:
+            return
+
+        # Card ids start w/ their creation timestamp, so the next page is
+        # everything created before the oldest card in this one.
+        params['before'] = min(card_json['id'] for card_json in page)
+
+
+def iter_active_board_cards():
+    """Yield a CardSnapshot for each open card on every non-archive board.
+
+    Snapshots of the active boards are fetched together in one batch.
+    """
+    active_board_names = [name for name in BOARD_NAME_TO_ID
+            if name not in ARCHIVE_BOARD_NAMES]
+    for cards in get_board_snapshots(active_board_names).itervalues():
+        for card in cards:
+            yield card
+
+
+def iter_all_board_cards():
+    """Yield a CardSnapshot for each open card on every board we know of.
+
+    The active boards come first (see iter_active_board_cards), then the
+    ever-growing archive boards (see ARCHIVE_BOARD_NAMES) are paged through.
+    """
+    for card in iter_active_board_cards():
+        yield card
+
+    for name in ARCHIVE_BOARD_NAMES:
+        if name in BOARD_NAME_TO_ID:
+            for card in iter_board_cards(name):
+                yield card
+
+
+class TrelloBatchError(Exception):
+    """Raised for a single GET that failed as part of a batch request."""
+    def __init__(self, status_code, message):
+        super(TrelloBatchError, self).__init__("%s: %s" % (status_code,
+                message))
+        self.status_code = status_code
+
+
+class TrelloBatchRequest(object):
+    """A single GET that'll be sent as part of a TrelloBatch."""
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self._response = None
+        self._error = None
+        self._done = False
+
+    @property
+    def route(self):
+        """Route for this GET as understood by Trello's batch endpoint."""
+        if not self.params:
+            return self.path
+        # urlencode escapes any commas in params, which would otherwise be
+        # mistaken for separators b/w batched routes.
+        return "%s?%s" % (self.path, urllib.urlencode(self.params))
+
+    def result(self):
+        """Return this GET's parsed JSON response, or raise its error."""
+        if not self._done:
+            raise Exception("Batch hasn't been executed yet: %s" % self.path)
+        if self._error:
+            raise self._error
+        return self._response
+
+
+class TrelloBatch(object):
+    """Collects independent GETs and sends 'em to Trello's /batch endpoint.
+
+    Add GETs w/ get(), send 'em all w/ execute(), and then read each one's
+    response from the returned TrelloBatchRequest. Trello takes up to
+    MAX_BATCH_SIZE GETs per round-trip, so larger batches are split up. A
+    failed GET only fails its own TrelloBatchRequest.
+    """
+    def __init__(self, client=None):
+        self.client = client or get_client()
+        self.requests = []
+
+    def get(self, path, params=None):
+        request = TrelloBatchRequest(path, params)
+        self.requests.append(request)
+        return request
+
+    def execute(self):
+        pending_requests = [r for r in self.requests if not r._done]
+        for i in range(0, len(pending_requests), MAX_BATCH_SIZE):
+            self._execute_chunk(pending_requests[i:i + MAX_BATCH_SIZE])
+
+    def _execute_chunk(self, requests):
+        try:
+            responses = json.loads(self.client.get('/batch', {
+                'urls': ','.join(r.route for r in requests)}))
+        except Exception as e:
+            # The whole round-trip failed, so every request in it did, too
+            responses = [e] * len(requests)
+
+        perf_stats.incr("trello.batch.requests", len(requests))
+        perf_stats.incr("trello.batch.round_trips_saved", len(requests) - 1)
+
+        if len(responses) != len(requests):
+            logging.warning("Trello batch returned %s responses for %s "
+                    "requests" % (len(responses), len(requests)))
+            # Fail any requests left w/o a response now, rather than leave
+            # 'em unexecuted for callers to trip over later
+            missing = TrelloBatchError(None, "No response in batch of %s "
+                    "requests" % len(requests))
+            responses = (responses[:len(requests)] +
+                    [missing] * (len(requests) - len(responses)))
+
+        for request, response in zip(requests, responses):
+            request._done = True
+            if isinstance(response, Exception):
+                request._error = response
+            elif len(response) == 1 and "200" in response:
+                request._response = response["200"]
+            else:
+                # Failed GETs come back as e.g. {"404": "not found"} or
+                # {"statusCode": 400, "message": "invalid id"}
+                status_code, message = response.items()[0]
+                if "statusCode" in response:
+                    status_code = response["statusCode"]
+                    message = response.get("message", response)
+                request._error = TrelloBatchError(status_code, message)
+
+
+def get_bot_member_id():
+    """Return the Trello member id of the account we act as (bigboard@).
+
+    Actions taken by this member are our own writes, e.g. pasting stickers.
+    The id never changes, so it's looked up once and then kept in memcache and
+    in memory.
+    """
+    global _bot_member_id
+    if _bot_member_id:
+        return _bot_member_id
+
+    member_id = memcache.get(BOT_MEMBER_ID_CACHE_KEY)
+    if not member_id:
+        client = get_client()
+        member_id = json.loads(client.get('/members/me',
+                {'fields': 'id'}))['id']
+        memcache.set(BOT_MEMBER_ID_CACHE_KEY, member_id)
+
+    _bot_member_id = member_id
+    return _bot_member_id
+
+
+class TrelloConnectionPool(object):
+    """Thread-safe pool of keep-alive Trello connections shared by a process.
+
+    Each trollop connection holds its own HTTP session, so reusing 'em means
+    reusing open connections to Trello instead of redoing the TLS handshake
+    for every new client. Connections are checked out for a single request
+    at a time, so threads never share one mid-request.
+
+    Every request waits for budget from the rate limiter first (see
+    rate_limit.py), and requests that get 429'd are retried.
+    """
+    def __init__(self, max_idle_connections, rate_limiter=None):
+        self.max_idle_connections = max_idle_connections
+        self.rate_limiter = rate_limiter or rate_limit.get_limiter()
+        self._lock = threading.Lock()
+        self._idle_connections = []
+        self._connection_count = 0
+
+    def request(self, priority, *args, **kwargs):
+        """Send a request over an idle connection (or a new one if none).
+
+        Arguments:
+            priority: rate_limit.INTERACTIVE or rate_limit.BULK
+            *args, **kwargs: passed along to trollop's request()
+        """
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(priority)
+            connection = self._checkout()
+            try:
+                response = connection.request(*args, **kwargs)
+            except Exception as e:
+                is_rate_limited, retry_after_seconds = False, None
+                if isinstance(e, trollop.TrelloError):
+                    is_rate_limited, retry_after_seconds = (
+                            rate_limit.get_retry_after_seconds(
+                                connection.client.last_response))
+                if not is_rate_limited:
+                    # Don't hand a connection in an unknown state to anybody
+                    # else
+                    perf_stats.incr("trello.connections_discarded")
+                    raise
+
+                self._checkin(connection)
+                if attempt >= rate_limit.MAX_RETRIES:
+                    raise
+
+                self.rate_limiter.back_off(attempt, retry_after_seconds)
+                attempt += 1
+                continue
+
+            perf_stats.incr("trello.requests")
+            perf_stats.incr("trello.connection.%s.requests" %
+                    connection.pool_number)
+            self._checkin(connection)
+            return response
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle_connections:
+                # Most recently used first, since it's most likely still open
+                return self._idle_connections.pop()
+            self._connection_count += 1
+            pool_number = self._connection_count
+
+        connection = trollop.TrelloConnection(secrets.trello_api_key,
+            secrets.trello_oauth_token)
+        connection.client = _ResponseRecordingHttp(connection.client)
+        connection.pool_number = pool_number
+        perf_stats.incr("trello.connections_created")
+        return connection
+
+    def _checkin(self, connection):
+        with self._lock:
+            if len(self._idle_connections) < self.max_idle_connections:
+                self._idle_connections.append(connection)
+
+
+class _ResponseRecordingHttp(object):
+    """Wraps a trollop connection's httplib2.Http to keep its last response.
+
+    Trollop raises a TrelloError w/ just the response body when Trello
+    answers w/ anything but a 200, so this is how the pool gets at the
+    status and headers of failed requests (e.g. a 429's Retry-After).
+    """
+    def __init__(self, http):
+        self._http = http
+        self.last_response = None
+
+    def request(self, *args, **kwargs):
+        self.last_response = None
+        response, content = self._http.request(*args, **kwargs)
+        self.last_response = response
+        return (response, content)
+
+
+class PooledTrelloConnection(trollop.TrelloConnection):
+    """Trello client that sends every request through a TrelloConnectionPool.
+
+    This is stateless apart from the pool and its priority, so one instance
+    can be shared by every thread in the process. Trollop objects (cards,
+    boards) remember the client that created 'em, so their requests get the
+    same priority.
+    """
+    def __init__(self, pool, priority):
+        trollop.TrelloConnection.__init__(self, secrets.trello_api_key,
+            secrets.trello_oauth_token)
+        self.pool = pool
+        self.priority = priority
+
+    def request(self, *args, **kwargs):
+        return self.pool.request(self.priority, *args, **kwargs)
+
+
+_pool = None
+_clients = {}
+_client_lock = threading.Lock()
+
+
+def get_client(priority=rate_limit.INTERACTIVE):
+    """Return the process-wide Trello client (see TrelloConnectionPool).
+
+    Pass priority=rate_limit.BULK for background work, like board-wide
+    syncs, that should yield rate limit budget to webhook handling.
+    """
+    global _pool
+    with _client_lock:
+        if not _pool:
+            _pool = TrelloConnectionPool(MAX_IDLE_CONNECTIONS)
+        if priority not in _clients:
+            _clients[priority] = PooledTrelloConnection(_pool, priority)
+
+        return _clients[priority]
 
 
 def get_description_snippet(emoji, label, doc_url):
@@ -105,13 +569,3 @@ def get_description_snippet(emoji, label, doc_url):
             emoji_link_markdown += "[:%s:](%s)" % (single_emoji, doc_url)
 
     return '- %s [%s](%s)' % (emoji_link_markdown, label, doc_url)
-
-
-def _get_board_by_name(name):
-    board_id = get_board_id_by_name(name)
-    if not board_id:
-        return None
-
-    client = get_client()
-
-    return client.get_board(board_id)
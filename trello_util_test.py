@@ -1,10 +1,16 @@
 """Unit tests for testing Google drive project doc interactions."""
 
+import httplib2
+import json
+import mock
+import threading
 import unittest
 
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import urlfetch_stub
 
+import perf_stats
+import rate_limit
 import trello_util
 
 
@@ -33,44 +39,249 @@ class TrelloUtilTest(unittest.TestCase):
                 "[:warning:](moo.com) [Monkey](moo.com)",
                 snippet)
 
-    def test_find_card_on_proposal_board(self):
-        # This is the how-to product planning doc id on the proposal board's
-        # intro card. Even though it is more of a meta doc as opposed to a true
-        # "project doc", it suffices for this test because it will likely live
-        # on the proposals board for long (TM) time.
-        doc_id = "1O2lyurmBIjycX7voCiJGiFZT3QOFaeTD8OKKLzUP42s"
 
-        card = trello_util.get_card_by_doc_id(doc_id)
+class TrelloConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        super(TrelloConnectionPoolTest, self).setUp()
+        self.mock_patch = mock.patch.object(trello_util.trollop,
+                'TrelloConnection')
+        self.TrelloConnection = self.mock_patch.start()
+        self.TrelloConnection.return_value.request.return_value = "{}"
+        self.rate_limiter = mock.Mock()
+        perf_stats.reset()
+
+    def tearDown(self):
+        self.mock_patch.stop()
+        super(TrelloConnectionPoolTest, self).tearDown()
+
+    def test_connections_are_reused(self):
+        pool = trello_util.TrelloConnectionPool(2,
+                rate_limiter=self.rate_limiter)
+        for _ in range(5):
+            self.assertEqual("{}", pool.request(rate_limit.INTERACTIVE,
+                    'GET', '/members/me'))
+
+        self.assertEqual(1, self.TrelloConnection.call_count)
+        self.assertEqual(5, perf_stats.get("trello.connection.1.requests"))
+
+    def test_concurrent_requests_get_their_own_connections(self):
+        pool = trello_util.TrelloConnectionPool(2,
+                rate_limiter=self.rate_limiter)
+        both_checked_out = threading.Event()
+        connections = [mock.Mock(), mock.Mock()]
+        self.TrelloConnection.side_effect = connections
+
+        def request(*args, **kwargs):
+            # Hold on to the connection until both threads have one
+            if pool._connection_count == 2:
+                both_checked_out.set()
+            both_checked_out.wait(1)
+        for connection in connections:
+            connection.request.side_effect = request
+
+        threads = [threading.Thread(target=pool.request,
+                args=(rate_limit.INTERACTIVE, 'GET', '/'))
+                for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(2, self.TrelloConnection.call_count)
+        self.assertEqual(2, len(pool._idle_connections))
+
+    def test_failed_connections_are_discarded(self):
+        pool = trello_util.TrelloConnectionPool(2,
+                rate_limiter=self.rate_limiter)
+        self.TrelloConnection.return_value.request.side_effect = IOError()
+
+        with self.assertRaises(IOError):
+            pool.request(rate_limit.INTERACTIVE, 'GET', '/members/me')
+        self.assertEqual([], pool._idle_connections)
+
+
+class RateLimitedRequestTest(unittest.TestCase):
+    """Sends requests through real trollop connections w/ fake responses."""
+    def setUp(self):
+        super(RateLimitedRequestTest, self).setUp()
+        self.mock_patch = mock.patch('httplib2.Http.request')
+        self.http_request = self.mock_patch.start()
+        self.rate_limiter = mock.Mock()
+        self.pool = trello_util.TrelloConnectionPool(2,
+                rate_limiter=self.rate_limiter)
+        perf_stats.reset()
+
+    def tearDown(self):
+        self.mock_patch.stop()
+        super(RateLimitedRequestTest, self).tearDown()
+
+    def test_rate_limited_requests_are_retried(self):
+        self.http_request.side_effect = [
+            (httplib2.Response({"status": "429", "retry-after": "3"}),
+                "API_TOKEN_LIMIT_EXCEEDED"),
+            (httplib2.Response({"status": "200"}), "{}"),
+        ]
+
+        self.assertEqual("{}", self.pool.request(rate_limit.BULK, 'GET', '/'))
+        self.rate_limiter.back_off.assert_called_once_with(0, 3.0)
+        self.assertEqual(2, self.rate_limiter.acquire.call_count)
+        self.rate_limiter.acquire.assert_called_with(rate_limit.BULK)
+
+        # Getting rate limited doesn't mean the connection's broken
+        self.assertEqual(1, perf_stats.get("trello.connections_created"))
+
+    def test_other_errors_are_not_retried(self):
+        self.http_request.return_value = (
+                httplib2.Response({"status": "404"}), "not found")
+
+        with self.assertRaises(trello_util.trollop.TrelloError):
+            self.pool.request(rate_limit.BULK, 'GET', '/cards/nope')
+        self.assertFalse(self.rate_limiter.back_off.called)
+        self.assertEqual(1, perf_stats.get("trello.connections_discarded"))
+
+    def test_too_many_rate_limited_retries_give_up(self):
+        self.http_request.return_value = (
+                httplib2.Response({"status": "429"}), "")
+
+        with self.assertRaises(trello_util.trollop.TrelloError):
+            self.pool.request(rate_limit.BULK, 'GET', '/')
+        self.assertEqual(rate_limit.MAX_RETRIES,
+                self.rate_limiter.back_off.call_count)
+
+
+class BoardSnapshotTest(unittest.TestCase):
+    @mock.patch('trello_util.get_client')
+    def test_board_cards_with_stickers(self, get_client):
+        client = get_client.return_value
+        client.get.return_value = json.dumps([{
+            "id": "card1",
+            "name": "Monkey",
+            "desc": "||GP||",
+            "idMembers": ["member1"],
+            "stickers": [
+                {"id": "s2", "imageUrl": "purple.png", "zIndex": 1},
+                {"id": "s1", "imageUrl": "green.png", "zIndex": 0},
+            ],
+        }])
+
+        cards = list(trello_util.iter_board_cards("BIG_BOARD",
+                before="card9", since="card0", stickers=True))
+
+        # Everything came back in one request
+        client.get.assert_called_once_with(
+                "/boards/%s/cards" % trello_util.BOARD_NAME_TO_ID["BIG_BOARD"],
+                {"fields": "id,name,desc,idMembers", "stickers": "true",
+                    "before": "card9", "since": "card0",
+                    "limit": trello_util.CARD_PAGE_SIZE})
+
+        self.assertEqual(1, len(cards))
+        self.assertEqual("card1", cards[0]._id)
+        self.assertEqual("||GP||", cards[0].desc)
+        self.assertEqual(["member1"], cards[0].member_ids)
+        self.assertEqual(["s2", "s1"], [s._id for s in cards[0].stickers])
+
+        # Edits go through a trollop card
+        cards[0].remove_sticker(cards[0].stickers[0])
+        client.get_card.assert_called_once_with("card1")
+        client.get_card.return_value.remove_sticker.assert_called_once_with(
+                cards[0].stickers[0])
+
+    @mock.patch('trello_util.get_client')
+    def test_iter_board_cards_pages_through_board(self, get_client):
+        pages = [
+            [{"id": "c5", "desc": "a"}, {"id": "c4", "desc": "b"}],
+            [{"id": "c3", "desc": "c"}, {"id": "c2", "desc": "doc1"}],
+            [{"id": "c1", "desc": "d"}],
+        ]
+        requested_params = []
+
+        def get(path, params):
+            requested_params.append(dict(params))
+            return json.dumps(pages[len(requested_params) - 1])
+        get_client.return_value.get.side_effect = get
+
+        cards = trello_util.iter_board_cards("COMPLETED_BOARD", page_size=2)
+        self.assertEqual(["c5", "c4", "c3", "c2", "c1"],
+                [card._id for card in cards])
+        self.assertEqual([None, "c4", "c2"],
+                [params.get("before") for params in requested_params])
+        self.assertEqual(2, requested_params[0]["limit"])
+
+        # Stopping early means later pages are never fetched
+        requested_params = []
+        for card in trello_util.iter_board_cards("COMPLETED_BOARD",
+                page_size=2):
+            if card.desc == "doc1":
+                break
+        self.assertEqual(2, len(requested_params))
+
+
+class TrelloBatchTest(unittest.TestCase):
+    def setUp(self):
+        super(TrelloBatchTest, self).setUp()
+        perf_stats.reset()
+
+    def test_batch_splits_results_and_failures(self):
+        client = mock.Mock()
+        client.get.return_value = json.dumps([
+            {"200": {"id": "card1"}},
+            {"404": "The requested resource was not found."},
+            {"statusCode": 400, "name": "ERROR", "message": "invalid id"},
+        ])
+
+        batch = trello_util.TrelloBatch(client)
+        found = batch.get("/cards/card1", {"fields": "id,name"})
+        missing = batch.get("/cards/card2")
+        invalid = batch.get("/cards/%%%")
+        batch.execute()
+
+        client.get.assert_called_once_with("/batch", {"urls":
+            "/cards/card1?fields=id%2Cname,/cards/card2,/cards/%%%"})
 
-        # Yup we got the card!
-        self.assertIsNotNone(card)
+        self.assertEqual({"id": "card1"}, found.result())
+        with self.assertRaises(trello_util.TrelloBatchError) as e:
+            missing.result()
+        self.assertEqual("404", e.exception.status_code)
+        with self.assertRaises(trello_util.TrelloBatchError) as e:
+            invalid.result()
+        self.assertEqual(400, e.exception.status_code)
 
-        # The name and url of the card are as we expect.
-        self.assertIn("Product Planning doc", card.name)
+        self.assertEqual(2, perf_stats.get("trello.batch.round_trips_saved"))
 
-        # 138 corresponds to the stable numeric id of the card
-        self.assertIn("138", card.url)
+    def test_large_batches_are_split(self):
+        client = mock.Mock()
+        client.get.side_effect = lambda path, params: json.dumps(
+                [{"200": route} for route in params["urls"].split(",")])
 
-    def test_find_card_on_big_board(self):
-        # This is the support initiative doc, which should always be on the
-        # big board.
-        doc_id = "1dnBtGHySsjkt8ZmleDB8XF6cYc2yB7sN1pMErMG7_ls"
+        batch = trello_util.TrelloBatch(client)
+        requests = [batch.get("/cards/%s" % i) for i in range(15)]
+        batch.execute()
 
-        card = trello_util.get_card_by_doc_id(doc_id)
+        self.assertEqual(2, client.get.call_count)
+        self.assertEqual(["/cards/%s" % i for i in range(15)],
+                [r.result() for r in requests])
 
-        # Yup we got the card!
-        self.assertIsNotNone(card)
+    def test_missing_responses_fail_their_requests(self):
+        client = mock.Mock()
+        client.get.return_value = json.dumps([{"200": {"id": "card0"}}])
 
-        # The name and url of the card are as we expect.
-        self.assertIn("Support", card.name)
+        batch = trello_util.TrelloBatch(client)
+        requests = [batch.get("/cards/card%s" % i) for i in range(3)]
+        batch.execute()
 
-        # 21 corresponds to the stable numeric id of the card
-        self.assertIn("21", card.url)
+        self.assertEqual({"id": "card0"}, requests[0].result())
+        for request in requests[1:]:
+            with self.assertRaises(trello_util.TrelloBatchError):
+                request.result()
 
-    def test_do_not_find_card_by_doc_id(self):
-        # Ah, our eng principles doc! Shouldn't be on any of our boards.(TM)
-        doc_id = "1PW4NYn9pYNam2EuGEsTN9pTgwTfFnT_R9OZLJJICWQU"
+    def test_failed_round_trip_fails_every_request(self):
+        client = mock.Mock()
+        client.get.side_effect = IOError("Trello is down")
 
-        card = trello_util.get_card_by_doc_id(doc_id)
+        batch = trello_util.TrelloBatch(client)
+        requests = [batch.get("/cards/%s" % i) for i in range(3)]
+        batch.execute()
 
-        self.assertIsNone(card)
+        for request in requests:
+            with self.assertRaises(IOError):
+                request.result()
@@ -0,0 +1,382 @@
+"""Queue for acknowledging Trello webhooks now and processing them later.
+
+Trello waits on our response to every webhook delivery, and retries ones that
+take too long. Rather than running sticker syncs, retro reminders, etc. inline,
+UpdateBoardWebHook just checks the payload, enqueues a compact WebhookEvent
+record, and returns. A worker endpoint (see main.ProcessUpdateBoardWebHook)
+pops events off the "webhook-updates" queue (see queue.yaml for its retry
+policy) and runs the usual handlers in webhooks.py.
+
+Trello retries deliveries and the task queue retries tasks, so the same action
+can show up more than once. Deliveries are deduped by Trello action id before
+being enqueued (see claim_delivery), and processing an action that was already
+processed is skipped. Which actions were received and processed is stored in
+the datastore (see WebhookAction), w/ memcache in front of it, so an evicted
+memcache key can't get an action (and its retro email) handled twice.
+
+InProcessQueue is a local stand-in for the App Engine task queue that can be
+swapped in via set_queue() for unit tests and benchmarks.
+"""
+import datetime
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import google_drive
+import perf_stats
+import stickers
+import webhooks
+
+# Set to False to go back to running webhook handlers inline in the request
+# that Trello is waiting on.
+ASYNC_INGESTION = True
+
+# Name of the push queue (see queue.yaml) and the worker URL it hits
+QUEUE_NAME = 'webhook-updates'
+WORKER_URL = '/webhook/process_update'
+
+# How long we remember that a Trello action has been processed, so it isn't
+# handled again when Trello redelivers its webhook, a task is retried, or it's
+# replayed by catch_up.py
+PROCESSED_ACTION_SECONDS = 2 * 24 * 60 * 60
+
+# Actions received this long ago that still haven't been processed are treated
+# as missed, since the webhook-updates queue gives up on tasks after an hour
+# (task_age_limit in queue.yaml). A redelivery or catch_up.py can claim 'em
+# again.
+CLAIM_TIMEOUT_SECONDS = 2 * 60 * 60
+
+# Max number of expired WebhookActions deleted per batch
+DELETE_BATCH_SIZE = 500
+
+
+class WebhookAction(ndb.Model):
+    """Trello action we've received and/or processed, keyed by action id.
+
+    Entities are deleted by delete_expired_actions once they haven't been
+    touched for PROCESSED_ACTION_SECONDS.
+    """
+    received = ndb.DateTimeProperty(indexed=False)
+    processed = ndb.DateTimeProperty(indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class WebhookEvent(object):
+    """Compact record of the bits of a Trello webhook our handlers care about.
+
+    Trello's webhook bodies include full copies of the board, the card, and
+    the acting member. We only hang on to what's needed to dispatch.
+    """
+    def __init__(self, action_type, card_id, board_id, member_id=None,
+            changed_fields=None, old_sticker_string=None,
+            sticker_string=None, old_doc_ids=None, doc_ids=None,
+            action_id=None):
+        self.action_type = action_type
+        self.card_id = card_id
+        self.board_id = board_id
+        # Trello member who took the action
+        self.member_id = member_id
+        # Names of card fields changed by an updateCard action, e.g. ["desc"]
+        self.changed_fields = changed_fields or []
+        # ||GPW||-formatted sticker strings from before and after a
+        # description edit, or None if the payload didn't include them
+        self.old_sticker_string = old_sticker_string
+        self.sticker_string = sticker_string
+        # Ids of Google Docs linked from the card's description before and
+        # after this action, or None if the payload didn't include them
+        self.old_doc_ids = old_doc_ids
+        self.doc_ids = doc_ids
+        # Trello's unique id for the action
+        self.action_id = action_id
+
+    @property
+    def sticker_string_changed(self):
+        """Return False if we know this action didn't touch sticker strings.
+
+        Trello's updateCard payloads list every changed field under
+        data.old, and include the old and new description when the
+        description is edited. That's enough to tell that most updates don't
+        affect stickers without fetching anything from Trello.
+        """
+        if self.action_type != "updateCard" or not self.changed_fields:
+            return True
+
+        if "desc" not in self.changed_fields:
+            return False
+
+        if self.old_sticker_string is None or self.sticker_string is None:
+            # Description changed but payload didn't say what to. Assume the
+            # worst.
+            return True
+
+        return self.old_sticker_string != self.sticker_string
+
+    @staticmethod
+    def from_webhook_body(body_json):
+        """Build an event from a Trello webhook's JSON body.
+
+        Returns None if the body is missing the action type, card id or board
+        id.
+        """
+        try:
+            action = body_json["action"]
+            data = action["data"]
+            event = WebhookEvent(action["type"], data["card"]["id"],
+                    data["board"]["id"],
+                    member_id=action.get("idMemberCreator"),
+                    changed_fields=sorted(data.get("old", {})),
+                    action_id=action.get("id"))
+
+            if "desc" in data.get("old", {}) and "desc" in data["card"]:
+                event.old_sticker_string = stickers.get_sticker_string(
+                        data["old"]["desc"])
+                event.sticker_string = stickers.get_sticker_string(
+                        data["card"]["desc"])
+                event.old_doc_ids = google_drive.extract_doc_ids(
+                        data["old"]["desc"])
+
+            if "desc" in data["card"]:
+                event.doc_ids = google_drive.extract_doc_ids(
+                        data["card"]["desc"])
+
+            return event
+        except (KeyError, TypeError, AttributeError):
+            return None
+
+    @staticmethod
+    def from_params(params):
+        """Rebuild an event from task params created by to_params."""
+        changed_fields = filter(None,
+                params.get("changed_fields", "").split(","))
+        return WebhookEvent(params["action_type"], params["card_id"],
+                params["board_id"], member_id=params.get("member_id"),
+                changed_fields=changed_fields,
+                old_sticker_string=params.get("old_sticker_string"),
+                sticker_string=params.get("sticker_string"),
+                old_doc_ids=_split_list_param(params.get("old_doc_ids")),
+                doc_ids=_split_list_param(params.get("doc_ids")),
+                action_id=params.get("action_id") or None)
+
+    def to_params(self):
+        """Return dict of task params that represents this event."""
+        params = {
+            "action_type": self.action_type,
+            "card_id": self.card_id,
+            "board_id": self.board_id,
+            "member_id": self.member_id or "",
+            "changed_fields": ",".join(self.changed_fields),
+            "action_id": self.action_id or "",
+        }
+
+        # Sticker strings and doc ids are left out entirely when unknown so
+        # they come back as None rather than "" (which means "none").
+        if self.old_sticker_string is not None:
+            params["old_sticker_string"] = self.old_sticker_string
+        if self.sticker_string is not None:
+            params["sticker_string"] = self.sticker_string
+        if self.old_doc_ids is not None:
+            params["old_doc_ids"] = ",".join(self.old_doc_ids)
+        if self.doc_ids is not None:
+            params["doc_ids"] = ",".join(self.doc_ids)
+
+        return params
+
+    def __repr__(self):
+        return "<WebhookEvent: %s card=%s board=%s>" % (self.action_type,
+                self.card_id, self.board_id)
+
+
+def _split_list_param(value):
+    """Split comma-separated task param, keeping None for missing params."""
+    if value is None:
+        return None
+    return filter(None, value.split(","))
+
+
+class TaskQueue(object):
+    """Sends events to the App Engine push queue drained by WORKER_URL."""
+    def add(self, event):
+        taskqueue.add(queue_name=QUEUE_NAME, url=WORKER_URL, method='POST',
+                params=event.to_params())
+
+
+class InProcessQueue(object):
+    """In-memory stand-in for TaskQueue, for use in tests and benchmarks.
+
+    Events just sit in a list until run_all() is called.
+    """
+    def __init__(self):
+        self.events = []
+
+    def add(self, event):
+        self.events.append(event)
+
+    def run_all(self):
+        """Process all queued events (including ones queued while running).
+
+        Returns the number of events processed.
+        """
+        count = 0
+        while self.events:
+            process(self.events.pop(0))
+            count += 1
+        return count
+
+
+_queue = TaskQueue()
+
+
+def set_queue(queue):
+    """Swap in a different queue, e.g. an InProcessQueue.
+
+    Returns the previously active queue so callers can restore it.
+    """
+    global _queue
+    previous_queue = _queue
+    _queue = queue
+    return previous_queue
+
+
+def enqueue(event):
+    """Enqueue an event for processing by the webhook worker.
+
+    If ASYNC_INGESTION is off, the event is processed immediately instead.
+    """
+    if not ASYNC_INGESTION:
+        process(event)
+        return
+
+    _queue.add(event)
+
+
+def process(event):
+    """Run all webhook handlers for a previously enqueued event.
+
+    Events whose action was already processed, e.g. by an earlier run of the
+    same task, are skipped.
+    """
+    if was_processed(event.action_id):
+        logging.info("Skipping already processed %s" % event)
+        perf_stats.incr("webhooks.duplicate_tasks_skipped")
+        return
+
+    logging.info("Processing %s" % event)
+    webhooks.trigger_update_handlers(event)
+    mark_processed(event.action_id)
+
+
+def _received_key(action_id):
+    return "webhook-action-received:%s" % action_id
+
+
+def claim_delivery(event):
+    """Return True if this is the first delivery of the event's action.
+
+    Trello retries webhook deliveries it doesn't think went through, so the
+    same action can show up more than once. Events w/o an action id can't be
+    deduped and are always claimed. So are actions whose earlier claim is
+    over CLAIM_TIMEOUT_SECONDS old and still hasn't been processed.
+    """
+    if not event.action_id:
+        return True
+
+    key = _received_key(event.action_id)
+    if not memcache.get(key) and _claim_action(event.action_id):
+        memcache.set(key, True, time=CLAIM_TIMEOUT_SECONDS)
+        return True
+
+    perf_stats.incr("webhooks.duplicate_deliveries_skipped")
+    return False
+
+
+@ndb.transactional
+def _claim_action(action_id):
+    now = datetime.datetime.utcnow()
+    action = WebhookAction.get_by_id(action_id)
+    if action:
+        if action.processed:
+            return False
+        if action.received and now - action.received < datetime.timedelta(
+                seconds=CLAIM_TIMEOUT_SECONDS):
+            return False
+        logging.warning("Reclaiming action %s, which was received at %s but "
+                "never processed" % (action_id, action.received))
+        perf_stats.incr("webhooks.stale_claims")
+
+    WebhookAction(id=action_id, received=now).put()
+    return True
+
+
+def release_delivery(event):
+    """Forget a claimed delivery so a retry of it will be handled."""
+    if event.action_id:
+        memcache.delete(_received_key(event.action_id))
+        _release_action(event.action_id)
+
+
+@ndb.transactional
+def _release_action(action_id):
+    action = WebhookAction.get_by_id(action_id)
+    if action and not action.processed:
+        action.key.delete()
+
+
+def _processed_key(action_id):
+    return "webhook-action-processed:%s" % action_id
+
+
+def mark_processed(action_id):
+    """Remember that the Trello action w/ this id has been handled."""
+    if action_id:
+        _mark_action_processed(action_id)
+        memcache.set(_processed_key(action_id), True,
+                time=PROCESSED_ACTION_SECONDS)
+
+
+@ndb.transactional
+def _mark_action_processed(action_id):
+    action = (WebhookAction.get_by_id(action_id) or
+            WebhookAction(id=action_id))
+    action.processed = datetime.datetime.utcnow()
+    action.put()
+
+
+def was_processed(action_id):
+    """Return True if the Trello action w/ this id was recently handled."""
+    if not action_id:
+        return False
+
+    if memcache.get(_processed_key(action_id)):
+        return True
+
+    action = WebhookAction.get_by_id(action_id)
+    if action and action.processed:
+        memcache.set(_processed_key(action_id), True,
+                time=PROCESSED_ACTION_SECONDS)
+        return True
+
+    return False
+
+
+def delete_expired_actions():
+    """Delete WebhookActions untouched for PROCESSED_ACTION_SECONDS (cron).
+
+    Returns the number of actions deleted.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=PROCESSED_ACTION_SECONDS)
+    query = WebhookAction.query(WebhookAction.updated < cutoff)
+
+    count = 0
+    while True:
+        keys = query.fetch(DELETE_BATCH_SIZE, keys_only=True)
+        if not keys:
+            break
+        ndb.delete_multi(keys)
+        count += len(keys)
+
+    logging.info("Deleted %s expired webhook actions" % count)
+    perf_stats.incr("webhooks.expired_actions_deleted", count)
+    return count
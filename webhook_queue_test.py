@@ -0,0 +1,163 @@
+"""Unit tests for queueing up Trello webhooks for later processing."""
+
+import datetime
+import mock
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import perf_stats
+import webhook_queue
+
+
+EXAMPLE_WEBHOOK_BODY = {
+    "action": {
+        "type": "updateCard",
+        "idMemberCreator": "member1",
+        "data": {
+            "card": {"id": "card1"},
+            "board": {"id": "board1"},
+            "old": {"desc": "||GG||"},
+        },
+    },
+}
+
+
+class WebhookEventTest(unittest.TestCase):
+
+    def test_event_from_webhook_body(self):
+        event = webhook_queue.WebhookEvent.from_webhook_body(
+                EXAMPLE_WEBHOOK_BODY)
+        self.assertEqual("updateCard", event.action_type)
+        self.assertEqual("card1", event.card_id)
+        self.assertEqual("board1", event.board_id)
+        self.assertEqual("member1", event.member_id)
+        self.assertEqual(["desc"], event.changed_fields)
+
+    def test_event_from_incomplete_webhook_body(self):
+        self.assertIsNone(webhook_queue.WebhookEvent.from_webhook_body(
+                {"action": {"type": "updateBoard", "data": {}}}))
+        self.assertIsNone(webhook_queue.WebhookEvent.from_webhook_body({}))
+
+    def test_params_round_trip(self):
+        event = webhook_queue.WebhookEvent.from_webhook_body(
+                EXAMPLE_WEBHOOK_BODY)
+        event = webhook_queue.WebhookEvent.from_params(event.to_params())
+        self.assertEqual("updateCard", event.action_type)
+        self.assertEqual("card1", event.card_id)
+        self.assertEqual("board1", event.board_id)
+        self.assertEqual("member1", event.member_id)
+        self.assertEqual(["desc"], event.changed_fields)
+
+
+class InProcessQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = webhook_queue.InProcessQueue()
+        self.previous_queue = webhook_queue.set_queue(self.queue)
+
+        self.mock_patch = mock.patch('webhooks.trigger_update_handlers')
+        self.trigger_update_handlers = self.mock_patch.start()
+
+    def tearDown(self):
+        self.mock_patch.stop()
+        webhook_queue.set_queue(self.previous_queue)
+
+    def test_enqueue_defers_handlers(self):
+        event = webhook_queue.WebhookEvent.from_webhook_body(
+                EXAMPLE_WEBHOOK_BODY)
+        webhook_queue.enqueue(event)
+
+        # Nothing runs until the queue is drained
+        self.assertFalse(self.trigger_update_handlers.called)
+
+        self.assertEqual(1, self.queue.run_all())
+        self.trigger_update_handlers.assert_called_once_with(event)
+        self.assertEqual([], self.queue.events)
+
+
+class DedupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        perf_stats.reset()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def _event(self, action_id="action1"):
+        return webhook_queue.WebhookEvent("updateCard", "card1", "board1",
+                action_id=action_id)
+
+    def test_duplicate_deliveries_are_not_claimed(self):
+        self.assertTrue(webhook_queue.claim_delivery(self._event()))
+        self.assertFalse(webhook_queue.claim_delivery(self._event()))
+        self.assertTrue(webhook_queue.claim_delivery(self._event("action2")))
+        self.assertEqual(1,
+                perf_stats.get("webhooks.duplicate_deliveries_skipped"))
+
+        # Released deliveries can be claimed again
+        webhook_queue.release_delivery(self._event())
+        self.assertTrue(webhook_queue.claim_delivery(self._event()))
+
+        # Events w/o action ids can't be deduped
+        self.assertTrue(webhook_queue.claim_delivery(self._event(None)))
+        self.assertTrue(webhook_queue.claim_delivery(self._event(None)))
+
+    @mock.patch('webhooks.trigger_update_handlers')
+    def test_processed_actions_are_not_reprocessed(self,
+            trigger_update_handlers):
+        webhook_queue.process(self._event())
+        webhook_queue.process(self._event())
+
+        self.assertEqual(1, trigger_update_handlers.call_count)
+        self.assertEqual(1, perf_stats.get("webhooks.duplicate_tasks_skipped"))
+
+    @mock.patch('webhooks.trigger_update_handlers')
+    def test_failed_actions_are_reprocessed(self, trigger_update_handlers):
+        trigger_update_handlers.side_effect = [Exception(), None]
+        with self.assertRaises(Exception):
+            webhook_queue.process(self._event())
+        webhook_queue.process(self._event())
+
+        self.assertEqual(2, trigger_update_handlers.call_count)
+
+    @mock.patch('webhooks.trigger_update_handlers')
+    def test_dedup_survives_memcache_eviction(self, trigger_update_handlers):
+        self.assertTrue(webhook_queue.claim_delivery(self._event()))
+        memcache.flush_all()
+        self.assertFalse(webhook_queue.claim_delivery(self._event()))
+
+        webhook_queue.process(self._event())
+        memcache.flush_all()
+        self.assertTrue(webhook_queue.was_processed("action1"))
+        webhook_queue.process(self._event())
+        self.assertEqual(1, trigger_update_handlers.call_count)
+
+        # Released deliveries are forgotten by the datastore, too
+        webhook_queue.release_delivery(self._event("action2"))
+        self.assertTrue(webhook_queue.claim_delivery(self._event("action2")))
+        webhook_queue.release_delivery(self._event("action2"))
+        memcache.flush_all()
+        self.assertTrue(webhook_queue.claim_delivery(self._event("action2")))
+
+    def test_expired_actions_are_deleted(self):
+        webhook_queue.mark_processed("action1")
+        webhook_queue.mark_processed("action2")
+        self.assertEqual(0, webhook_queue.delete_expired_actions())
+
+        expired = datetime.datetime.utcnow() + datetime.timedelta(
+                seconds=webhook_queue.PROCESSED_ACTION_SECONDS + 1)
+        with mock.patch('webhook_queue.datetime') as mock_datetime:
+            mock_datetime.timedelta = datetime.timedelta
+            mock_datetime.datetime.utcnow.return_value = expired
+            with mock.patch('webhook_queue.DELETE_BATCH_SIZE', 1):
+                self.assertEqual(2, webhook_queue.delete_expired_actions())
+
+        self.assertIsNone(webhook_queue.WebhookAction.get_by_id("action1"))
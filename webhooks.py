@@ -3,15 +3,41 @@
 See https://trello.com/docs/gettingstarted/webhooks.html for more.
 """
 import logging
+import time
 
+from google.appengine.ext import deferred
+
+import coalescing
+import doc_index
+import perf_stats
 import retrospective
 import secrets
-import stickers
+import thread_pool
+import trello_cache
 import trello_util
 
 # The webhook URL that'll be registered and fired any time a board is updated
 ABSOLUTE_WEBHOOK_URL = 'http://khan-big-board.appspot.com/webhook/update_board'
 
+# Card fields that only change when stickers are pasted or removed
+STICKER_FIELDS = ["stickers"]
+
+# Max number of webhooks added or removed at once during setup
+MAX_SETUP_WORKERS = 7
+
+# Max number of handlers run at once for a single event
+MAX_HANDLER_WORKERS = 4
+
+# Queue that failed handlers are retried on. This is the queue webhook events
+# are processed from (webhook_queue.QUEUE_NAME), so retries get the same
+# retry limits (see queue.yaml).
+HANDLER_RETRY_QUEUE = "webhook-updates"
+
+# Trello actions that change a board's lists, and so its cached lists (see
+# trello_util.get_board_lists)
+LIST_ACTION_TYPES = ["createList", "updateList", "moveListToBoard",
+        "moveListFromBoard"]
+
 
 def _add_update_board_webhook(client, board_id):
     """Add a webhook to big board identified by its Trello board id."""
@@ -20,86 +46,289 @@ def _add_update_board_webhook(client, board_id):
     board.add_webhook(ABSOLUTE_WEBHOOK_URL)
 
 
-def _remove_all_webhooks(client, oauth_token):
-    """Remove all webhooks associated with this oauth token."""
-    logging.info("Removing all webhooks")
-    token = client.get_token(oauth_token)
-    for webhook in token.webhooks:
-        logging.info("Removing webhook: %s" % webhook)
-        webhook.delete()
+def _remove_webhook(webhook):
+    logging.info("Removing webhook: %s" % webhook)
+    webhook.delete()
+
 
+def get_webhook_changes(existing_webhooks, desired_board_ids):
+    """Return what needs to change to get from existing to desired webhooks.
 
-class StickerWebhookHandler(object):
+    Arguments:
+        existing_webhooks: trollop webhooks currently registered for our
+            token
+        desired_board_ids: ids of boards that should each have exactly one
+            webhook pointed at ABSOLUTE_WEBHOOK_URL
+
+    Returns tuple of (ids of boards missing a webhook, webhooks to remove).
+    Webhooks pointed elsewhere, for boards we don't know about, or
+    duplicating another webhook are removed.
+    """
+    covered_board_ids = set()
+    webhooks_to_remove = []
+    for webhook in existing_webhooks:
+        if (webhook.callbackURL == ABSOLUTE_WEBHOOK_URL and
+                webhook.idModel in desired_board_ids and
+                webhook.idModel not in covered_board_ids):
+            covered_board_ids.add(webhook.idModel)
+        else:
+            webhooks_to_remove.append(webhook)
+
+    board_ids_to_add = [board_id for board_id in desired_board_ids
+            if board_id not in covered_board_ids]
+    return (board_ids_to_add, webhooks_to_remove)
+
+
+class WebhookHandler(object):
+    """Base class for webhook handlers, which register w/ @register_handler.
+
+    Handlers declare which actions they care about, and are only ever called
+    for those. should_handle can then skip events based on their payload.
+
+    Every handler must define a static handle(event) method that does its
+    work. It's called w/ a webhook_queue.WebhookEvent, and any exception it
+    raises gets the handler retried on its own (see retry_handler).
+    """
+    # Trello action types handled, e.g. "updateCard"
+    action_types = []
+    # Names of boards (see trello_util.BOARD_NAME_TO_ID) whose actions are
+    # handled, or None to handle actions on any board
+    board_names = None
+    # How long this handler is expected to take at most. Handlers that run
+    # past it are still waited on, since an event isn't processed until
+    # every handler is done, but they're logged and counted as overdue.
+    deadline_seconds = 20
+
+    @staticmethod
+    def should_handle(event):
+        return True
+
+
+# Registered handler classes in registration order, and an index of 'em by
+# (action type, board id), where a board id of None matches any board
+_handlers = []
+_handlers_by_route = {}
+
+
+def register_handler(handler):
+    """Class decorator that adds a WebhookHandler to the dispatch index."""
+    if not callable(getattr(handler, "handle", None)):
+        raise TypeError("%s doesn't define handle(event)" % handler.__name__)
+
+    board_ids = [None]
+    if handler.board_names is not None:
+        board_ids = [trello_util.get_board_id_by_name(name)
+                for name in handler.board_names]
+
+    for action_type in handler.action_types:
+        for board_id in board_ids:
+            _handlers_by_route.setdefault((action_type, board_id),
+                    []).append(handler)
+
+    _handlers.append(handler)
+    return handler
+
+
+def get_handlers(event):
+    """Return handlers registered for the event's action type and board."""
+    handlers = (_handlers_by_route.get((event.action_type, None), []) +
+            _handlers_by_route.get((event.action_type, event.board_id), []))
+    return sorted(handlers, key=_handlers.index)
+
+
+@register_handler
+class StickerWebhookHandler(WebhookHandler):
     """Webhook handler for keeping card stickers up-to-date on card edit."""
 
+    # Should sync stickers any time card is updated, created, or moved
+    action_types = ["moveCardToBoard", "createCard", "updateCard"]
+
     @staticmethod
-    def should_handle(action_type, card_id, board_id):
-        """Should sync stickers any time card is updated, created, or moved."""
-        return action_type in ["moveCardToBoard", "createCard", "updateCard"]
+    def should_handle(event):
+        """Skip updates that we can tell didn't change the sticker string.
+
+        That's most of 'em, and we can tell from the webhook payload w/o
+        hitting Trello.
+        """
+        if not event.sticker_string_changed:
+            perf_stats.incr("webhooks.unchanged_sticker_strings_skipped")
+            return False
+
+        return True
 
     @staticmethod
-    def handle(action_type, card_id, board_id):
-        """Sync card stickers."""
-        stickers.sync_card_stickers(card_id)
+    def handle(event):
+        """Sync card stickers (coalescing bursts of edits to the same card)."""
+        coalescing.request_sticker_sync(event.card_id)
 
 
-class RetrospectiveWebhookHandler(object):
+@register_handler
+class RetrospectiveWebhookHandler(WebhookHandler):
     """Webhook handler for firing off retro reminders on project completion."""
 
-    @staticmethod
-    def should_handle(action_type, card_id, board_id):
-        """Should fire reminders when a card is moved to completed."""
-        completed_board_id = trello_util.get_board_id_by_name(
-                "COMPLETED_BOARD")
-        return (action_type == "moveCardToBoard" and
-                board_id == completed_board_id)
+    # Should fire reminders when a card is moved to completed
+    action_types = ["moveCardToBoard"]
+    board_names = ["COMPLETED_BOARD"]
 
     @staticmethod
-    def handle(action_type, card_id, board_id):
+    def handle(event):
         """Send retrospective reminder to somebody on the card."""
-        retrospective.send_retro_reminder_for_card(card_id)
+        retrospective.send_retro_reminder_for_card(event.card_id)
+
 
+@register_handler
+class DocIndexWebhookHandler(WebhookHandler):
+    """Webhook handler for keeping the doc id => card index up-to-date."""
 
-def trigger_update_handlers(action_type, card_id, board_id):
+    action_types = ["createCard", "updateCard"]
+
+    @staticmethod
+    def should_handle(event):
+        """Should index any card whose payload includes its description."""
+        return event.doc_ids is not None
+
+    @staticmethod
+    def handle(event):
+        """Point the card's linked docs at the card in doc_index."""
+        doc_index.index_card(event.card_id, event.doc_ids,
+                old_doc_ids=event.old_doc_ids)
+
+
+def is_echo(event):
+    """Return True if an action was caused by our own writes to a card.
+
+    Every sticker we paste or remove and every description we update fires
+    another webhook back at us. Those echoes never need handling, so we skip
+    any action taken by our own Trello member as well as any update that
+    only touched card stickers.
+    """
+    if (event.changed_fields and
+            set(event.changed_fields) <= set(STICKER_FIELDS)):
+        return True
+
+    return (bool(event.member_id) and
+            event.member_id == trello_util.get_bot_member_id())
+
+
+def invalidate_changed_lists(body_json):
+    """Drop the cached lists of a board a webhook says had its lists change.
+
+    List actions aren't about any card, so they never become WebhookEvents.
+    This runs on the raw webhook body instead.
+
+    Returns True if anything was invalidated.
+    """
+    try:
+        action = body_json["action"]
+        if action["type"] not in LIST_ACTION_TYPES:
+            return False
+        board_id = action["data"]["board"]["id"]
+    except (KeyError, TypeError):
+        return False
+
+    logging.info("Invalidating cached lists of board %s after %s" %
+            (board_id, action["type"]))
+    trello_cache.invalidate(board_id)
+    return True
+
+
+def trigger_update_handlers(event):
     """Webhook handler fired when any card is updated.
 
-    Dispatches to different handlers depending on the event type, source Trello
-    board, etc.
+    Dispatches to the handlers registered for the event's action type and
+    source Trello board. Echoes of our own writes (see is_echo) are skipped
+    before any handler runs, but still drop any cached copy of the card they
+    touched.
+
+    Matching handlers run concurrently, so handling takes about as long as
+    the slowest handler rather than all of 'em put together. This only
+    returns once every handler is done. Each handler is timed against its
+    deadline, and one that fails doesn't stop the rest from running. Instead,
+    the failed handler alone is retried in its own task (see retry_handler).
+
+    Arguments:
+        event: webhook_queue.WebhookEvent describing the Trello action
+    """
+    trello_cache.invalidate(event.card_id)
+
+    if is_echo(event):
+        logging.info("Skipping echo of our own %s on card %s" %
+                (event.action_type, event.card_id))
+        perf_stats.incr("webhooks.echoes_skipped")
+        return
+
+    handlers = [handler for handler in get_handlers(event)
+            if handler.should_handle(event)]
+
+    outcomes = thread_pool.call_in_parallel(
+            [lambda handler=handler: _run_handler(handler, event)
+                for handler in handlers],
+            MAX_HANDLER_WORKERS)
+
+    for handler, (outcome, value, seconds) in zip(handlers, outcomes):
+        if seconds > handler.deadline_seconds:
+            logging.warning("%s took %.1fs for %s, past its %ss deadline" %
+                    (handler.__name__, seconds, event,
+                        handler.deadline_seconds))
+            perf_stats.incr("webhooks.handlers.%s.overdue" %
+                    handler.__name__)
+
+        if outcome == thread_pool.FAILED:
+            logging.error("%s failed for %s, retrying it on its own" %
+                    (handler.__name__, event), exc_info=value)
+            deferred.defer(retry_handler, handler.__name__, event,
+                    _queue=HANDLER_RETRY_QUEUE)
+
+
+def retry_handler(handler_name, event):
+    """Rerun a single handler that failed (triggered by task queue).
+
+    Any exception fails the task, which is then retried.
     """
-    for handler in [StickerWebhookHandler, RetrospectiveWebhookHandler]:
-        if handler.should_handle(action_type, card_id, board_id):
-            handler.handle(action_type, card_id, board_id)
+    handler = [h for h in _handlers if h.__name__ == handler_name][0]
+    _run_handler(handler, event)
+
+
+def _run_handler(handler, event):
+    """Run a handler, keeping track of how long it takes and if it fails."""
+    start = time.time()
+    try:
+        handler.handle(event)
+    except Exception:
+        perf_stats.incr("webhooks.handlers.%s.failures" % handler.__name__)
+        raise
+    finally:
+        perf_stats.incr("webhooks.handlers.%s.calls" % handler.__name__)
+        perf_stats.incr("webhooks.handlers.%s.ms" % handler.__name__,
+                int((time.time() - start) * 1000))
 
 
 def setup():
-    """Setup initial hooks between this webhook server and all Trello boards.
+    """Setup hooks between this webhook server and all Trello boards.
 
     After this is run, all updates to cards on the big board (or project
     pipeline board, etc) will fire webhooks that get handled by this server.
     These webhooks keep each card's stickers up-to-date.
 
-    This initial setup also does a one-time update of all stickers for all
-    cards on the big board.
+    This only adds or removes the webhooks that differ from what we want (one
+    per board in BOARD_NAME_TO_ID), so it's safe to rerun. Missing webhooks
+    are added before unwanted ones are removed, so every board keeps firing
+    webhooks the whole time.
     """
     client = trello_util.get_client()
+    token = client.get_token(secrets.trello_oauth_token)
+
+    board_ids_to_add, webhooks_to_remove = get_webhook_changes(
+            token.webhooks, sorted(set(trello_util.BOARD_NAME_TO_ID.values())))
+
+    logging.info("Adding %s webhooks, removing %s" %
+            (len(board_ids_to_add), len(webhooks_to_remove)))
 
-    # Remove any existing webhooks for the bigboard@khanacademy.org Trello user
-    # so we don't wind up registering multiple webhooks.
-    _remove_all_webhooks(client, secrets.trello_oauth_token)
-
-    # Add new webhooks that'll fire any time an update happens on any board.
-    _add_update_board_webhook(client,
-            trello_util.get_board_id_by_name('BIG_BOARD'))
-    _add_update_board_webhook(client,
-            trello_util.get_board_id_by_name('PROPOSALS_BOARD'))
-    _add_update_board_webhook(client,
-            trello_util.get_board_id_by_name('COMPLETED_BOARD'))
-    _add_update_board_webhook(client,
-            trello_util.get_board_id_by_name('ENG_MGMT_LITTLE_BOARD'))
-    _add_update_board_webhook(client,
-            trello_util.get_board_id_by_name('X_ON_MOBILE_MINI_BOARD'))
-    _add_update_board_webhook(client,
-            trello_util.get_board_id_by_name('ADOPTION_TEAM_BOARD'))
-    _add_update_board_webhook(client,
-            trello_util.get_board_id_by_name('CONTENT_TEAM_BOARD'))
+    thread_pool.map_in_parallel(
+            lambda board_id: _add_update_board_webhook(client, board_id),
+            board_ids_to_add, MAX_SETUP_WORKERS)
+    thread_pool.map_in_parallel(_remove_webhook, webhooks_to_remove,
+            MAX_SETUP_WORKERS)
 
+    perf_stats.incr("webhooks.setup.added", len(board_ids_to_add))
+    perf_stats.incr("webhooks.setup.removed", len(webhooks_to_remove))
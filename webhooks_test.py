@@ -0,0 +1,297 @@
+"""Unit tests for dispatching Trello webhooks to our handlers."""
+
+import mock
+import threading
+import time
+import unittest
+
+import perf_stats
+import trello_cache
+import trello_util
+import webhook_queue
+import webhooks
+
+
+def _event(member_id="human", changed_fields=None, old_desc=None, desc=None,
+        action_type="updateCard"):
+    """Build a WebhookEvent the same way we would from a Trello payload."""
+    data = {
+        "card": {"id": "card1"},
+        "board": {"id": "board1"},
+        "old": dict((f, "") for f in changed_fields or []),
+    }
+    if old_desc is not None:
+        data["old"]["desc"] = old_desc
+    if desc is not None:
+        data["card"]["desc"] = desc
+
+    return webhook_queue.WebhookEvent.from_webhook_body({
+        "action": {
+            "type": action_type,
+            "idMemberCreator": member_id,
+            "data": data,
+        },
+    })
+
+
+class EchoSuppressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_patch = mock.patch('trello_util.get_bot_member_id',
+                return_value="bot")
+        self.mock_patch.start()
+
+    def tearDown(self):
+        self.mock_patch.stop()
+
+    def test_is_echo(self):
+        # Actions taken by our own bot member
+        self.assertTrue(webhooks.is_echo(_event("bot", ["desc"])))
+        self.assertTrue(webhooks.is_echo(_event("bot")))
+
+        # Actions that only touched stickers
+        self.assertTrue(webhooks.is_echo(_event("human", ["stickers"])))
+
+        # Real edits made by real people
+        self.assertFalse(webhooks.is_echo(_event("human", ["desc"])))
+        self.assertFalse(webhooks.is_echo(
+                _event("human", ["desc", "stickers"])))
+        self.assertFalse(webhooks.is_echo(_event("human")))
+        self.assertFalse(webhooks.is_echo(_event(None)))
+
+    @mock.patch('doc_index.index_card')
+    @mock.patch('webhooks.StickerWebhookHandler.handle')
+    def test_echoes_are_not_handled(self, handle, index_card):
+        webhooks.trigger_update_handlers(
+                _event("bot", old_desc="||G||", desc="||GG||"))
+        self.assertFalse(handle.called)
+
+        event = _event("human", old_desc="||G||", desc="||GG||")
+        webhooks.trigger_update_handlers(event)
+        handle.assert_called_once_with(event)
+        index_card.assert_called_once_with("card1", [], old_doc_ids=[])
+
+
+class DispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patches = [
+            mock.patch('trello_util.get_bot_member_id', return_value="bot"),
+            mock.patch('webhooks.StickerWebhookHandler.handle'),
+            mock.patch('webhooks.RetrospectiveWebhookHandler.handle'),
+            mock.patch('webhooks.DocIndexWebhookHandler.handle'),
+            mock.patch('webhooks.deferred.defer'),
+        ]
+        (_, self.sticker_handle, self.retro_handle, self.doc_index_handle,
+                self.defer) = [patch.start() for patch in self.patches]
+        perf_stats.reset()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def test_handlers_are_routed_by_action_type_and_board(self):
+        completed_board_id = trello_util.get_board_id_by_name(
+                "COMPLETED_BOARD")
+        event = webhook_queue.WebhookEvent("moveCardToBoard", "card1",
+                completed_board_id)
+        self.assertEqual([webhooks.StickerWebhookHandler,
+                webhooks.RetrospectiveWebhookHandler],
+                webhooks.get_handlers(event))
+
+        event.board_id = "some other board"
+        self.assertEqual([webhooks.StickerWebhookHandler],
+                webhooks.get_handlers(event))
+
+        self.assertEqual([],
+                webhooks.get_handlers(_event(action_type="deleteCard")))
+
+    def test_handlers_must_define_handle(self):
+        class NoopWebhookHandler(webhooks.WebhookHandler):
+            action_types = ["updateCard"]
+
+        with self.assertRaises(TypeError):
+            webhooks.register_handler(NoopWebhookHandler)
+        self.assertEqual([webhooks.StickerWebhookHandler,
+                webhooks.DocIndexWebhookHandler],
+                webhooks.get_handlers(_event()))
+
+    def test_failed_handler_does_not_stop_others(self):
+        self.sticker_handle.side_effect = Exception("Trello's down")
+        event = _event(old_desc="||G||", desc="||GG||")
+
+        webhooks.trigger_update_handlers(event)
+
+        self.doc_index_handle.assert_called_once_with(event)
+        self.defer.assert_called_once_with(webhooks.retry_handler,
+                "StickerWebhookHandler", event,
+                _queue=webhook_queue.QUEUE_NAME)
+        self.assertEqual(1, perf_stats.get(
+                "webhooks.handlers.StickerWebhookHandler.failures"))
+        self.assertEqual(1, perf_stats.get(
+                "webhooks.handlers.DocIndexWebhookHandler.calls"))
+
+        # Only the failed handler is retried
+        self.sticker_handle.side_effect = None
+        webhooks.retry_handler("StickerWebhookHandler", event)
+        self.assertEqual(2, self.sticker_handle.call_count)
+        self.assertEqual(1, self.doc_index_handle.call_count)
+
+    def test_handlers_run_concurrently(self):
+        completed_board_id = trello_util.get_board_id_by_name(
+                "COMPLETED_BOARD")
+        event = webhook_queue.WebhookEvent("moveCardToBoard", "card1",
+                completed_board_id)
+
+        # Each handler waits for the other, which only works if they run at
+        # once
+        both_started = threading.Event()
+        started = []
+
+        def handle(event):
+            started.append(event)
+            if len(started) == 2:
+                both_started.set()
+            self.assertTrue(both_started.wait(5))
+        self.sticker_handle.side_effect = handle
+        self.retro_handle.side_effect = handle
+
+        webhooks.trigger_update_handlers(event)
+        self.assertEqual([event, event], started)
+        self.assertFalse(self.defer.called)
+
+    def test_overdue_handlers_are_waited_on_and_reported(self):
+        finished = []
+        self.sticker_handle.side_effect = (
+                lambda event: time.sleep(0.01) or finished.append(event))
+        event = _event(old_desc="||G||", desc="||GG||")
+
+        with mock.patch.object(webhooks.StickerWebhookHandler,
+                'deadline_seconds', 0):
+            webhooks.trigger_update_handlers(event)
+
+        # The event isn't done until the slow handler is
+        self.assertEqual([event], finished)
+        self.assertEqual(1, perf_stats.get(
+                "webhooks.handlers.StickerWebhookHandler.overdue"))
+        self.assertFalse(self.defer.called)
+
+
+class StickerWebhookHandlerTest(unittest.TestCase):
+
+    def test_should_handle_sticker_string_changes(self):
+        should_handle = webhooks.StickerWebhookHandler.should_handle
+
+        # Sticker string changed
+        self.assertTrue(should_handle(
+                _event(old_desc="Yay ||GY||", desc="Yay ||GG||")))
+        self.assertTrue(should_handle(_event(old_desc="Yay", desc="||G||")))
+
+        # Description changed, but not its sticker string
+        self.assertFalse(should_handle(
+                _event(old_desc="Yay ||GY||", desc="Boo ||GY||")))
+        self.assertFalse(should_handle(_event(old_desc="Yay", desc="Boo")))
+
+        # Description didn't change at all
+        self.assertFalse(should_handle(_event(changed_fields=["name"])))
+
+        # Description changed, but payload didn't include the new one
+        self.assertTrue(should_handle(_event(old_desc="||G||")))
+
+        # Always sync new and moved cards
+        self.assertTrue(should_handle(_event(action_type="createCard")))
+        self.assertTrue(should_handle(_event(action_type="moveCardToBoard")))
+
+    def test_sticker_strings_survive_task_params(self):
+        event = _event(old_desc="Yay", desc="Boo")
+        event = webhook_queue.WebhookEvent.from_params(event.to_params())
+        self.assertEqual("", event.old_sticker_string)
+        self.assertEqual("", event.sticker_string)
+        self.assertFalse(event.sticker_string_changed)
+
+        event = _event(changed_fields=["name"])
+        event = webhook_queue.WebhookEvent.from_params(event.to_params())
+        self.assertIsNone(event.sticker_string)
+
+
+class DocIndexWebhookHandlerTest(unittest.TestCase):
+
+    def test_should_handle_desc_changes(self):
+        should_handle = webhooks.DocIndexWebhookHandler.should_handle
+        doc_url = "https://docs.google.com/document/d/doc1/edit"
+
+        event = _event(old_desc="", desc="Doc: %s" % doc_url)
+        self.assertTrue(should_handle(event))
+        self.assertEqual(["doc1"], event.doc_ids)
+        self.assertEqual([], event.old_doc_ids)
+
+        # Payload doesn't include the card's description
+        self.assertFalse(should_handle(_event(changed_fields=["name"])))
+        self.assertFalse(should_handle(_event(action_type="createCard")))
+
+
+class ListInvalidationTest(unittest.TestCase):
+
+    def setUp(self):
+        trello_cache.clear()
+
+    def tearDown(self):
+        trello_cache.clear()
+
+    def test_list_actions_invalidate_board_lists(self):
+        trello_cache.get_or_fetch("lists", "board1", lambda: ["To do"])
+
+        # Card actions leave a board's lists alone
+        self.assertFalse(webhooks.invalidate_changed_lists({"action": {
+            "type": "updateCard",
+            "data": {"board": {"id": "board1"}, "card": {"id": "card1"}},
+        }}))
+        self.assertEqual(["To do"], trello_cache.get_or_fetch("lists",
+                "board1", lambda: ["Doing"]))
+
+        self.assertTrue(webhooks.invalidate_changed_lists({"action": {
+            "type": "updateList",
+            "data": {"board": {"id": "board1"}, "list": {"id": "list1"}},
+        }}))
+        self.assertEqual(["Doing"], trello_cache.get_or_fetch("lists",
+                "board1", lambda: ["Doing"]))
+
+    def test_malformed_bodies_are_ignored(self):
+        self.assertFalse(webhooks.invalidate_changed_lists({}))
+        self.assertFalse(webhooks.invalidate_changed_lists(
+                {"action": {"type": "createList"}}))
+
+
+class SetupTest(unittest.TestCase):
+
+    def _webhook(self, board_id, url=webhooks.ABSOLUTE_WEBHOOK_URL):
+        return mock.Mock(idModel=board_id, callbackURL=url)
+
+    def test_get_webhook_changes(self):
+        kept = self._webhook("board1")
+        duplicate = self._webhook("board1")
+        elsewhere = self._webhook("board2", url="http://example.com/hook")
+        unknown_board = self._webhook("board4")
+
+        board_ids_to_add, webhooks_to_remove = webhooks.get_webhook_changes(
+                [kept, duplicate, elsewhere, unknown_board],
+                ["board1", "board2", "board3"])
+
+        self.assertEqual(["board2", "board3"], board_ids_to_add)
+        self.assertEqual([duplicate, elsewhere, unknown_board],
+                webhooks_to_remove)
+
+    @mock.patch('trello_util.get_client')
+    def test_setup_only_touches_differences(self, get_client):
+        client = get_client.return_value
+        stale = self._webhook("board3")
+        client.get_token.return_value.webhooks = [self._webhook("b1"), stale]
+
+        with mock.patch('trello_util.BOARD_NAME_TO_ID',
+                {"BIG_BOARD": "b1", "PROPOSALS_BOARD": "b2"}):
+            webhooks.setup()
+
+        client.get_board.assert_called_once_with("b2")
+        client.get_board.return_value.add_webhook.assert_called_once_with(
+                webhooks.ABSOLUTE_WEBHOOK_URL)
+        stale.delete.assert_called_once_with()